@@ -0,0 +1,446 @@
+"""
+Worker-side executor for ``Action`` rows.
+
+Actions are claimed with ``SELECT ... FOR UPDATE SKIP LOCKED`` so any number of
+runner processes can poll the same table without blocking each other or picking
+up the same row twice. A claimed action carries a time-bounded lease
+(``lease_owner`` / ``lease_expires_at``); if a worker dies the lease runs out and
+the action becomes claimable again, up to ``max_attempts``.
+
+Usage:
+
+    from common_models.actions import ActionRunner, register_handler
+    from common_models.models import ActionType
+
+    @register_handler(ActionType.reindex_patient)
+    def reindex_patient(ctx):
+        ...
+        ctx.metrics['records'] = 42
+        return {'reindexed': True}
+
+    ActionRunner(type_limits={ActionType.pims_resync: 2}).run_forever()
+
+Producers should enqueue through ``enqueue_action`` so that repeated requests for
+the same work collapse into a single queued execution.
+"""
+import hashlib
+import json
+import logging
+import os
+import socket
+import time
+import traceback
+from datetime import timedelta
+
+from sqlalchemy import and_, or_, func, text, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from common_models.db import db
+from common_models.models import Action, ActionStatus, ActionType, TargetType
+
+logger = logging.getLogger(__name__)
+
+# Key for the transaction-scoped advisory lock taken while applying concurrency limits.
+CLAIM_LOCK_KEY = 0x616374696f6e
+
+_handlers = {}
+
+
+def register_handler(action_type):
+    """Decorator registering ``fn(ctx)`` as the default handler for ``action_type``."""
+    action_type = ActionType(action_type)
+
+    def decorator(fn):
+        _handlers[action_type] = fn
+        return fn
+    return decorator
+
+
+def normalize_context(context):
+    """Canonical form of an action context: ``None`` values dropped, keys sorted."""
+    if isinstance(context, dict):
+        return {str(k): normalize_context(v) for k, v in sorted(context.items(), key=lambda kv: str(kv[0]))
+                if v is not None}
+    if isinstance(context, (list, tuple)):
+        return [normalize_context(v) for v in context]
+    if isinstance(context, (ActionType, TargetType)):
+        return context.value
+    return context
+
+
+def action_dedupe_key(action_type, target_type=None, target_id=None, context=None):
+    """sha256 identifying equivalent actions: same type, same target, same normalized context."""
+    payload = json.dumps(
+        [ActionType(action_type).value,
+         TargetType(target_type).value if target_type is not None else None,
+         target_id,
+         normalize_context(context or {})],
+        sort_keys=True, separators=(',', ':'), default=str,
+    )
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def _pending_primary(session, dedupe_key):
+    # Locked until the waiter is committed: the runner claims with SKIP LOCKED, so it
+    # cannot start (and resolve the waiters of) the primary before the waiter exists.
+    # A primary claimed while we waited for the lock no longer matches and is skipped.
+    return (session.query(Action)
+            .filter(Action.dedupe_key == dedupe_key,
+                    Action.status == ActionStatus.queued,
+                    Action.coalesced_into_id.is_(None))
+            .order_by(Action.id)
+            .with_for_update()
+            .first())
+
+
+def enqueue_action(action_type, target_type=None, target_id=None, context=None,
+                   actor_user_id=None, correlation_id=None, ticket_id=None, coalesce=True):
+    """
+    Queue an action, coalescing it with an equivalent action that has not started yet.
+
+    The first request for a given dedupe key becomes the primary row that the runner
+    executes. Later requests while it is still queued are stored as waiter rows
+    pointing at it through ``coalesced_into_id``; they are never claimed and receive
+    the primary's final status when it finishes. Waiters without a
+    ``correlation_id`` inherit the primary's so the execution can be traced from
+    any request. Requests arriving after the primary has started queue a new one,
+    since their inputs may postdate the running execution.
+
+    Args:
+        action_type (ActionType): Action to run.
+        target_type (TargetType): Kind of target, if any.
+        target_id (int): Target id, if any.
+        context (dict): Handler inputs; normalized before hashing.
+        actor_user_id (int): Requesting user.
+        correlation_id (str): Caller's job/run id.
+        ticket_id (int): Related ticket.
+        coalesce (bool): Set to False to always queue a separate execution.
+
+    Returns:
+        Action: The caller's row. ``execution_id`` is the id of the action that runs.
+    """
+    session = db.session
+    action_type = ActionType(action_type)
+    target_type = TargetType(target_type) if target_type is not None else None
+    values = dict(
+        action_type=action_type,
+        status=ActionStatus.queued,
+        target_type=target_type,
+        target_id=target_id,
+        context=context,
+        actor_user_id=actor_user_id,
+        correlation_id=correlation_id,
+        ticket_id=ticket_id,
+        attempts=0,
+    )
+    if not coalesce:
+        action = Action(**values)
+        session.add(action)
+        session.commit()
+        return action
+
+    dedupe_key = action_dedupe_key(action_type, target_type, target_id, context)
+    values['dedupe_key'] = dedupe_key
+    postgres = session.get_bind().dialect.name == 'postgresql'
+
+    for _ in range(3):
+        if postgres:
+            # The partial unique index makes concurrent enqueuers race on the insert
+            # rather than on a check-then-insert.
+            inserted_id = session.execute(
+                pg_insert(Action.__table__)
+                .values(**values)
+                .on_conflict_do_nothing(
+                    index_elements=['dedupe_key'],
+                    index_where=text("status = 'queued' AND coalesced_into_id IS NULL"),
+                )
+                .returning(Action.__table__.c.id)
+            ).scalar()
+            if inserted_id is not None:
+                session.commit()
+                return session.get(Action, inserted_id)
+        primary = _pending_primary(session, dedupe_key)
+        if primary is None and not postgres:
+            primary = Action(**values)
+            session.add(primary)
+            session.commit()
+            return primary
+        if primary is None:
+            # Claimed between our insert attempt and the lookup; try to become the primary.
+            session.rollback()
+            continue
+        waiter = Action(**dict(values, coalesced_into_id=primary.id,
+                               correlation_id=correlation_id or primary.correlation_id))
+        session.add(waiter)
+        session.commit()
+        return waiter
+    raise RuntimeError(f"could not enqueue {action_type.value} for {target_type} {target_id}")
+
+
+class LeaseLost(RuntimeError):
+    """Raised when a runner no longer owns the lease of the action it is executing."""
+
+
+class ActionContext:
+    """
+    Handed to a handler while it executes an action.
+
+    Attributes:
+        action (Action): The claimed action.
+        metrics (dict): Free-form counters recorded under ``outcome['metrics']``.
+    """
+
+    def __init__(self, runner, action):
+        self.runner = runner
+        self.action = action
+        self.metrics = {}
+
+    def renew_lease(self):
+        """Extend the lease; long-running handlers should call this periodically."""
+        self.runner.renew_lease(self.action.id)
+
+
+class ActionRunner:
+    """
+    Claims queued actions, runs their handlers and records the outcome.
+
+    Attributes:
+        handlers (dict): ActionType -> handler; defaults to the registered handlers.
+        worker_id (str): Lease owner written on claimed rows.
+        lease_seconds (int): Lease length; renewed by ``ActionContext.renew_lease``.
+        batch_size (int): Maximum number of actions claimed per poll.
+        max_attempts (int): Claims allowed before an expired action is failed.
+        type_limits (dict): ActionType -> maximum concurrently running actions.
+        target_limits (dict): TargetType -> maximum concurrently running actions.
+    """
+
+    def __init__(self, handlers=None, worker_id=None, lease_seconds=300, batch_size=10,
+                 max_attempts=3, type_limits=None, target_limits=None):
+        self.handlers = {ActionType(k): v for k, v in (handlers or _handlers).items()}
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+        self.lease_seconds = lease_seconds
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.type_limits = {ActionType(k): v for k, v in (type_limits or {}).items()}
+        self.target_limits = {TargetType(k): v for k, v in (target_limits or {}).items()}
+
+    # -- claiming -----------------------------------------------------------
+
+    def _lease_expiry(self):
+        return func.now() + timedelta(seconds=self.lease_seconds)
+
+    def _remaining_capacity(self, session):
+        live = and_(Action.status == ActionStatus.running, Action.lease_expires_at >= func.now())
+        by_type = dict(self.type_limits)
+        by_target = dict(self.target_limits)
+        if by_type:
+            rows = (session.query(Action.action_type, func.count())
+                    .filter(live, Action.action_type.in_(list(by_type)))
+                    .group_by(Action.action_type))
+            for action_type, running in rows:
+                by_type[action_type] -= running
+        if by_target:
+            rows = (session.query(Action.target_type, func.count())
+                    .filter(live, Action.target_type.in_(list(by_target)))
+                    .group_by(Action.target_type))
+            for target_type, running in rows:
+                by_target[target_type] -= running
+        return by_type, by_target
+
+    def claim(self):
+        """
+        Claim up to ``batch_size`` actions in one short transaction.
+
+        Concurrency limits are evaluated under a transaction-scoped advisory lock so
+        two runners cannot both take the last free slot; without limits no lock is
+        taken and claims only contend on row locks, which SKIP LOCKED avoids.
+
+        Returns:
+            list[Action]: The claimed actions, leased to this runner.
+        """
+        session = db.session
+        limited = bool(self.type_limits or self.target_limits)
+        if limited and session.get_bind().dialect.name == 'postgresql':
+            session.execute(text("SELECT pg_advisory_xact_lock(:key)"), {'key': CLAIM_LOCK_KEY})
+        by_type, by_target = self._remaining_capacity(session) if limited else ({}, {})
+
+        claimable = or_(
+            Action.status == ActionStatus.queued,
+            and_(Action.status == ActionStatus.running, Action.lease_expires_at < func.now()),
+        )
+        # Over-fetch so rows skipped for concurrency limits do not starve the batch.
+        candidates = (session.query(Action)
+                      .filter(claimable,
+                              Action.coalesced_into_id.is_(None),
+                              Action.action_type.in_(list(self.handlers)))
+                      .order_by(Action.created_at, Action.id)
+                      .limit(self.batch_size * 4 if limited else self.batch_size)
+                      .with_for_update(skip_locked=True)
+                      .all())
+
+        claimed_ids, exhausted_ids = [], []
+        for action in candidates:
+            if len(claimed_ids) >= self.batch_size:
+                break
+            if (action.attempts or 0) >= self.max_attempts:
+                exhausted_ids.append(action.id)
+                continue
+            if by_type.get(action.action_type, 1) <= 0 or by_target.get(action.target_type, 1) <= 0:
+                continue
+            if action.action_type in by_type:
+                by_type[action.action_type] -= 1
+            if action.target_type in by_target:
+                by_target[action.target_type] -= 1
+            claimed_ids.append(action.id)
+
+        if exhausted_ids:
+            self._resolve_waiters(exhausted_ids, ActionStatus.failed)
+            session.execute(
+                update(Action)
+                .where(Action.id.in_(exhausted_ids))
+                .values(status=ActionStatus.failed, finished_at=func.now(),
+                        lease_owner=None, lease_expires_at=None,
+                        outcome={'error': {'error_class': 'LeaseExpired',
+                                           'error_msg': f'lease expired after {self.max_attempts} attempts'}})
+                .execution_options(synchronize_session=False)
+            )
+        if claimed_ids:
+            session.execute(
+                update(Action)
+                .where(Action.id.in_(claimed_ids))
+                .values(status=ActionStatus.running, started_at=func.now(),
+                        lease_owner=self.worker_id, lease_expires_at=self._lease_expiry(),
+                        attempts=func.coalesce(Action.attempts, 0) + 1)
+                .execution_options(synchronize_session=False)
+            )
+        session.commit()
+
+        if not claimed_ids:
+            return []
+        return (session.query(Action)
+                .filter(Action.id.in_(claimed_ids))
+                .order_by(Action.created_at, Action.id)
+                .populate_existing()
+                .all())
+
+    def renew_lease(self, action_id):
+        """Push the lease of ``action_id`` forward, raising ``LeaseLost`` if it is no longer ours."""
+        # Separate connection so the handler's pending work is not committed with it.
+        with db.engine.begin() as conn:
+            result = conn.execute(
+                update(Action)
+                .where(Action.id == action_id,
+                       Action.lease_owner == self.worker_id,
+                       Action.status == ActionStatus.running)
+                .values(lease_expires_at=self._lease_expiry())
+            )
+        if result.rowcount != 1:
+            raise LeaseLost(f"action {action_id} is no longer leased by {self.worker_id}")
+
+    # -- execution ----------------------------------------------------------
+
+    def _resolve_waiters(self, action_ids, status):
+        """Copy the final status of executed actions onto the requests coalesced into them."""
+        resolved = 0
+        for action_id in action_ids:
+            # One statement per primary keeps the outcome a plain JSON value on every backend.
+            resolved += db.session.execute(
+                update(Action)
+                .where(Action.coalesced_into_id == action_id,
+                       Action.status == ActionStatus.queued)
+                .values(status=status, finished_at=func.now(), outcome={'coalesced_into': action_id})
+                .execution_options(synchronize_session=False)
+            ).rowcount
+        return resolved
+
+    def _finish(self, action_id, status, outcome):
+        outcome['waiters'] = self._resolve_waiters([action_id], status)
+        result = db.session.execute(
+            update(Action)
+            .where(Action.id == action_id,
+                   Action.lease_owner == self.worker_id,
+                   Action.status == ActionStatus.running)
+            .values(status=status, finished_at=func.now(), outcome=outcome,
+                    lease_owner=None, lease_expires_at=None)
+            .execution_options(synchronize_session=False)
+        )
+        return result.rowcount == 1
+
+    def execute(self, action):
+        """
+        Run the handler for a claimed action and record the outcome.
+
+        The handler's writes and the status update share one transaction and the
+        update is fenced on ``lease_owner``, so if the lease was lost to another
+        runner the work is rolled back instead of being applied twice.
+        """
+        action_id = action.id
+        handler = self.handlers[action.action_type]
+        queued_ms = None
+        if action.created_at and action.started_at:
+            queued_ms = int((action.started_at - action.created_at).total_seconds() * 1000)
+        ctx = ActionContext(self, action)
+        outcome = {'worker': self.worker_id, 'attempt': action.attempts}
+
+        start = time.perf_counter()
+        try:
+            result = handler(ctx)
+            status = ActionStatus.succeeded
+            outcome['result'] = result
+        except LeaseLost:
+            db.session.rollback()
+            logger.warning("Lost lease on action %s; abandoning", action_id)
+            return False
+        except Exception as exc:
+            db.session.rollback()
+            status = ActionStatus.failed
+            outcome['error'] = {
+                'error_class': type(exc).__name__,
+                'error_msg': str(exc),
+                'stack_trace': traceback.format_exc(limit=20),
+            }
+        outcome['metrics'] = ctx.metrics
+        outcome['timing'] = {'queued_ms': queued_ms, 'run_ms': int((time.perf_counter() - start) * 1000)}
+
+        if not self._finish(action_id, status, outcome):
+            db.session.rollback()
+            logger.warning("Action %s lease expired before completion; discarding result", action_id)
+            return False
+        db.session.commit()
+        return True
+
+    def run_once(self):
+        """
+        Claim one batch and execute it. Returns the number of actions claimed.
+
+        The batch shares one lease expiry, so each lease is renewed just before its
+        action starts: an action whose lease ran out while earlier handlers ran and
+        was reclaimed by another runner is skipped instead of executed twice.
+        """
+        actions = self.claim()
+        for action in actions:
+            try:
+                self.renew_lease(action.id)
+            except LeaseLost:
+                logger.warning("Lease on action %s expired before it started; skipping", action.id)
+                continue
+            self.execute(action)
+        return len(actions)
+
+    def run_forever(self, poll_interval=1.0, max_idle_interval=15.0, stop=None):
+        """
+        Poll until ``stop()`` returns True, backing off while the queue is empty.
+
+        Args:
+            poll_interval (float): Sleep after an empty poll, in seconds.
+            max_idle_interval (float): Upper bound for the idle back-off.
+            stop (callable): Optional predicate checked between polls.
+        """
+        idle = poll_interval
+        while not (stop and stop()):
+            if self.run_once():
+                idle = poll_interval
+                continue
+            time.sleep(idle)
+            idle = min(idle * 2, max_idle_interval)
+
@@ -0,0 +1,313 @@
+"""
+Transitive closure of ``ConditionAffiliated``.
+
+``AffiliationClosure`` keeps, for every pair of conditions, the shortest hop
+count along ``condition_id -> affiliated_condition_id`` edges and the
+accumulated impact of the strongest shortest path (the product of the edge
+weights parsed from ``impact_on_primary_condition``). Per-source hop indexes
+make "everything reachable within k hops" a slice lookup instead of a recursive
+lazy-load walk.
+
+The closure is maintained incrementally: committed inserts of
+``ConditionAffiliated`` rows are folded in with a vectorized relaxation over the
+affected sources/targets, deletions recompute only the sources that could reach
+the removed edge.
+
+Usage:
+
+    from common_models.affiliations import affiliation_closure
+
+    closure = affiliation_closure()
+    for condition_id, hops, impact in closure.within(primary_id, k=2):
+        ...
+"""
+import threading
+from collections import Counter, defaultdict
+
+import numpy as np
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+
+from common_models.db import db
+from common_models.models import ConditionAffiliated
+
+UNREACHABLE = np.iinfo(np.int16).max
+
+# impact_on_primary_condition labels -> edge weight; numeric strings are used as-is.
+IMPACT_WEIGHTS = {
+    'critical': 1.0, 'severe': 1.0, 'high': 0.9, 'strong': 0.9,
+    'moderate': 0.6, 'medium': 0.6,
+    'low': 0.3, 'mild': 0.3, 'weak': 0.3,
+    'minimal': 0.1, 'none': 0.0,
+}
+DEFAULT_IMPACT_WEIGHT = 0.5
+
+_INFO_PENDING = '_affiliation_changes'
+
+
+def impact_weight(value):
+    """Edge weight in [0, 1] for an ``impact_on_primary_condition`` value."""
+    text = (value or '').strip().lower()
+    if not text:
+        return DEFAULT_IMPACT_WEIGHT
+    try:
+        number = float(text.rstrip('%'))
+        return min(max(number / 100 if text.endswith('%') or number > 1 else number, 0.0), 1.0)
+    except ValueError:
+        return IMPACT_WEIGHTS.get(text.split()[0], DEFAULT_IMPACT_WEIGHT)
+
+
+class AffiliationClosure:
+    """
+    All-pairs hop counts and accumulated impacts over affiliated conditions.
+
+    Attributes:
+        condition_ids (list): Condition id of each matrix position.
+        dist (np.ndarray): int16 (n, n) hop counts; ``UNREACHABLE`` when there is no path.
+        impact (np.ndarray): float32 (n, n) accumulated impact of the strongest shortest path.
+
+    ``dist`` and ``impact`` are views into buffers that grow geometrically, so
+    adding conditions one at a time stays amortized O(n^2) overall.
+    """
+
+    def __init__(self, edges=()):
+        self.condition_ids = []
+        self._pos = {}
+        self._edges = defaultdict(dict)  # u -> {v: weight}
+        self._rows = defaultdict(Counter)  # (u, v) -> {weight: affiliation rows backing the edge}
+        self._dist = np.zeros((0, 0), dtype=np.int16)
+        self._impact = np.zeros((0, 0), dtype=np.float32)
+        self.dist, self.impact = self._dist, self._impact
+        self._hop_index = {}
+        edges = list(edges)
+        self._reserve(len({c for u, v, _ in edges for c in (u, v)}))
+        for u, v, weight in edges:
+            u, v = self._node(u), self._node(v)
+            self._rows[u, v][weight] += 1
+            self._edges[u][v] = max(weight, self._edges[u].get(v, 0.0))
+        self._rebuild(range(len(self.condition_ids)))
+
+    @classmethod
+    def load(cls):
+        """Build from every ``ConditionAffiliated`` row in one query."""
+        rows = db.session.query(
+            ConditionAffiliated.condition_id,
+            ConditionAffiliated.affiliated_condition_id,
+            ConditionAffiliated.impact_on_primary_condition,
+        )
+        return cls((u, v, impact_weight(impact)) for u, v, impact in rows)
+
+    # -- structure ----------------------------------------------------------
+
+    def _reserve(self, n):
+        """Make room for ``n`` conditions, at least doubling the buffers when they grow."""
+        capacity = len(self._dist)
+        if n <= capacity:
+            return
+        capacity = max(n, 2 * capacity, 16)
+        used = len(self.condition_ids)
+        dist = np.full((capacity, capacity), UNREACHABLE, dtype=np.int16)
+        impact = np.zeros((capacity, capacity), dtype=np.float32)
+        dist[:used, :used] = self.dist
+        impact[:used, :used] = self.impact
+        self._dist, self._impact = dist, impact
+        self.dist, self.impact = dist[:used, :used], impact[:used, :used]
+
+    def _node(self, condition_id):
+        pos = self._pos.get(condition_id)
+        if pos is None:
+            pos = self._pos[condition_id] = len(self.condition_ids)
+            self._reserve(pos + 1)
+            self.condition_ids.append(condition_id)
+            n = pos + 1
+            self.dist, self.impact = self._dist[:n, :n], self._impact[:n, :n]
+            self.dist[pos, pos] = 0
+            self.impact[pos, pos] = 1.0
+        return pos
+
+    def _csr(self):
+        n = len(self.condition_ids)
+        indptr = np.zeros(n + 1, dtype=np.intp)
+        indices, weights = [], []
+        for u in range(n):
+            targets = self._edges.get(u, {})
+            indptr[u + 1] = indptr[u] + len(targets)
+            indices.extend(targets.keys())
+            weights.extend(targets.values())
+        return indptr, np.array(indices, dtype=np.intp), np.array(weights, dtype=np.float32)
+
+    def _rebuild(self, sources):
+        """Recompute the rows of ``sources`` with a layered BFS over a CSR adjacency."""
+        indptr, indices, weights = self._csr()
+        degree = np.diff(indptr)
+        for s in sources:
+            dist = np.full(len(self.condition_ids), UNREACHABLE, dtype=np.int16)
+            impact = np.zeros(len(self.condition_ids), dtype=np.float32)
+            dist[s], impact[s] = 0, 1.0
+            frontier = np.array([s], dtype=np.intp)
+            hop = 0
+            while frontier.size:
+                hop += 1
+                counts = degree[frontier]
+                total = counts.sum()
+                if not total:
+                    break
+                # Edge ids of every frontier node: each node's CSR run, concatenated.
+                src = np.repeat(frontier, counts)
+                edge_ids = np.repeat(indptr[frontier] - (np.cumsum(counts) - counts), counts) + np.arange(total)
+                dst = indices[edge_ids]
+                fresh = dist[dst] == UNREACHABLE
+                dst, src, w = dst[fresh], src[fresh], weights[edge_ids][fresh]
+                if not dst.size:
+                    break
+                dist[dst] = hop
+                np.maximum.at(impact, dst, impact[src] * w)
+                frontier = np.unique(dst)
+            self.dist[s] = dist
+            self.impact[s] = impact
+            self._hop_index.pop(s, None)
+
+    # -- incremental maintenance --------------------------------------------
+
+    def add_edge(self, condition_id, affiliated_condition_id, weight=DEFAULT_IMPACT_WEIGHT):
+        """Fold a new edge into the closure by relaxing every (reaches u) x (reached from v) pair."""
+        u, v = self._node(condition_id), self._node(affiliated_condition_id)
+        self._rows[u, v][weight] += 1
+        if weight <= self._edges[u].get(v, -1.0):
+            return
+        self._edges[u][v] = weight
+        sources = np.flatnonzero(self.dist[:, u] != UNREACHABLE)
+        targets = np.flatnonzero(self.dist[v] != UNREACHABLE)
+        cand_dist = (self.dist[sources, u].astype(np.int32)[:, None] + 1
+                     + self.dist[v, targets].astype(np.int32)[None, :])
+        cand_impact = self.impact[sources, u][:, None] * np.float32(weight) * self.impact[v, targets][None, :]
+        block = np.ix_(sources, targets)
+        current_dist = self.dist[block].astype(np.int32)
+        better = (cand_dist < current_dist) | ((cand_dist == current_dist) & (cand_impact > self.impact[block]))
+        if better.any():
+            self.dist[block] = np.where(better, np.minimum(cand_dist, UNREACHABLE - 1), current_dist).astype(np.int16)
+            self.impact[block] = np.where(better, cand_impact, self.impact[block])
+            for s in sources[better.any(axis=1)]:
+                self._hop_index.pop(s, None)
+
+    def remove_edge(self, condition_id, affiliated_condition_id, weight=None):
+        """
+        Drop one affiliation row behind an edge; recompute the sources that could reach it if the edge changed.
+
+        The edge stays while other rows back it, with the strongest remaining
+        weight. ``weight`` is the removed row's weight (the strongest if None).
+        """
+        u, v = self._pos.get(condition_id), self._pos.get(affiliated_condition_id)
+        if u is None or v is None or v not in self._edges[u]:
+            return
+        rows = self._rows[u, v]
+        if weight not in rows:
+            weight = max(rows, default=None)
+        if weight is not None:
+            rows[weight] -= 1
+            if rows[weight] <= 0:
+                del rows[weight]
+        if rows:
+            strongest = max(rows)
+            if strongest == self._edges[u][v]:
+                return
+            self._edges[u][v] = strongest
+        else:
+            del self._rows[u, v]
+            del self._edges[u][v]
+        self._rebuild(np.flatnonzero(self.dist[:, u] != UNREACHABLE))
+
+    # -- queries ------------------------------------------------------------
+
+    def _hops(self, s):
+        index = self._hop_index.get(s)
+        if index is None:
+            row = self.dist[s]
+            order = np.argsort(row, kind='stable')
+            reachable = row[order]
+            max_hop = int(reachable[reachable != UNREACHABLE].max(initial=0))
+            ends = np.searchsorted(reachable, np.arange(max_hop + 1), side='right')
+            index = self._hop_index[s] = (order, ends)
+        return index
+
+    def within(self, condition_id, k=None):
+        """
+        Conditions reachable from ``condition_id`` in at most ``k`` hops (all if None).
+
+        Returns:
+            list: (condition_id, hops, impact) tuples, nearest first.
+        """
+        s = self._pos.get(condition_id)
+        if s is None:
+            return []
+        order, ends = self._hops(s)
+        hop = len(ends) - 1 if k is None else min(k, len(ends) - 1)
+        if hop < 1:
+            return []
+        selected = order[1:ends[hop]]
+        return [(self.condition_ids[t], int(self.dist[s, t]), float(self.impact[s, t])) for t in selected]
+
+    def hops(self, condition_id, other_id):
+        """Shortest hop count between two conditions, or None when unreachable."""
+        s, t = self._pos.get(condition_id), self._pos.get(other_id)
+        if s is None or t is None or self.dist[s, t] == UNREACHABLE:
+            return None
+        return int(self.dist[s, t])
+
+
+_lock = threading.Lock()
+_closure = None
+
+
+def affiliation_closure():
+    """Process-wide ``AffiliationClosure``, built on first use and updated on commit."""
+    global _closure
+    with _lock:
+        if _closure is None:
+            _closure = AffiliationClosure.load()
+        return _closure
+
+
+def invalidate_affiliation_closure():
+    """Drop the process-wide closure; for writes that bypass the ORM events (Core, bulk loads)."""
+    global _closure
+    with _lock:
+        _closure = None
+
+
+def _queue(op):
+    def listener(mapper, connection, target):
+        session = object_session(target)
+        if session is not None:
+            session.info.setdefault(_INFO_PENDING, []).append(
+                (op, target.condition_id, target.affiliated_condition_id, impact_weight(target.impact_on_primary_condition))
+            )
+    return listener
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_pending(session):
+    global _closure
+    pending = session.info.pop(_INFO_PENDING, None)
+    if not pending or _closure is None:
+        return
+    with _lock:
+        for op, u, v, weight in pending:
+            if op == 'add':
+                _closure.add_edge(u, v, weight)
+            elif op == 'remove':
+                _closure.remove_edge(u, v, weight)
+            else:
+                # Endpoints or impact changed; old values are gone, so rebuild lazily.
+                _closure = None
+                return
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _drop_pending(session, previous_transaction):
+    session.info.pop(_INFO_PENDING, None)
+
+
+event.listen(ConditionAffiliated, 'after_insert', _queue('add'))
+event.listen(ConditionAffiliated, 'after_delete', _queue('remove'))
+event.listen(ConditionAffiliated, 'after_update', _queue('update'))
@@ -0,0 +1,294 @@
+"""
+Asyncio access to the shared models.
+
+The mapped classes (``Dog``, ``Appointments``, ``TaskRun``, ``ErrorLog``, ...)
+are plain declarative classes, so they work unchanged with an ``AsyncSession``.
+This module builds the async engine (asyncpg for Postgres, aiosqlite for
+SQLite) with the same pool presets as ``configure_pool``, and a session factory
+with ``expire_on_commit=False`` so committed objects stay readable without a
+refresh round trip.
+
+Lazy loads cannot run under asyncio (they raise ``MissingGreenlet``), so
+relationships must be loaded up front: ``eager`` turns relationship names into
+``selectinload`` (collections) / ``joinedload`` (many-to-one) options and, by
+default, ``raiseload('*')`` so a relationship that was not asked for fails with
+a clear error instead. ``COMMON_RELATIONSHIPS`` lists what each model loads when
+no names are given.
+
+Flask-SQLAlchemy features tied to ``db.session`` (``Model.query``, replica
+routing, the tenant guard, change and audit hooks) do not apply to async
+sessions; writes that must emit ``change_events`` still go through ``db.session``.
+
+Requires ``sqlalchemy[asyncio]`` and ``asyncpg`` or ``aiosqlite``.
+
+Usage:
+
+    from common_models.async_db import async_session, eager, fetch, init_async_db
+
+    init_async_db(DATABASE_URL, preset='web')     # once, at service start-up
+
+    async with async_session() as session:
+        dogs = await fetch(session, Dog, dog_ids, 'appointments', 'vets')
+        rows = (await session.execute(select(TaskRun).where(TaskRun.batch_id == batch_id))).scalars().all()
+"""
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+from sqlalchemy import create_engine, inspect as sa_inspect, select
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import Session, joinedload, raiseload, selectinload
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+from common_models.db import POOL_PRESETS, TimedCheckoutMixin, TimedQueuePool, db
+from common_models.models import (
+    Appointments, Dog, InterventionFact, PatientDiagnostics, PatientInterventions, Vet,
+)
+
+ASYNC_DRIVERS = {'postgresql': 'postgresql+asyncpg', 'sqlite': 'sqlite+aiosqlite'}
+
+ASYNC_POOL_NAME = 'async_primary'
+
+# model -> relationship paths loaded by ``eager(model)``; 'a.b' loads b through a.
+COMMON_RELATIONSHIPS = {
+    Dog: ('vets', 'owner'),
+    Vet: ('role',),
+    Appointments: ('dog',),
+    PatientDiagnostics: ('lab_results',),
+    PatientInterventions: ('facts',),
+    InterventionFact: ('patient_intervention',),
+}
+
+
+class TimedAsyncQueuePool(TimedCheckoutMixin, AsyncAdaptedQueuePool):
+    pass
+
+
+def async_url(url):
+    """``url`` with its synchronous driver swapped for the asyncio one."""
+    url = make_url(url)
+    backend = url.get_backend_name()
+    if url.get_driver_name() in ('asyncpg', 'aiosqlite', 'psycopg') or backend not in ASYNC_DRIVERS:
+        return url
+    return url.set(drivername=ASYNC_DRIVERS[backend])
+
+
+def _pool_options(url, preset, overrides, poolclass, name):
+    url = make_url(url)
+    if preset is None or (url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:')):
+        return dict(overrides)
+    options = dict(POOL_PRESETS[preset], **overrides)
+    options.setdefault('poolclass', poolclass)
+    options.setdefault('pool_logging_name', name)
+    return options
+
+
+def create_async_db_engine(url, preset='web', **overrides):
+    """
+    Async engine for ``url`` (a sync or async URL) with a ``POOL_PRESETS`` preset.
+
+    Args:
+        preset (str): Key of ``POOL_PRESETS``; None for the driver's default pool.
+        **overrides: Engine options replacing the preset's.
+    """
+    url = async_url(url)
+    return create_async_engine(url, **_pool_options(url, preset, overrides, TimedAsyncQueuePool, ASYNC_POOL_NAME))
+
+
+_engine = None
+_sessionmaker = None
+
+
+def init_async_db(url=None, app=None, preset='web', **overrides):
+    """
+    Create the process-wide async engine and session factory.
+
+    Args:
+        url (str): Database URL; ``app.config['SQLALCHEMY_DATABASE_URI']`` if None.
+        app (Flask): App to read the URL from.
+
+    Returns:
+        async_sessionmaker: The session factory.
+    """
+    global _engine, _sessionmaker
+    if url is None:
+        if app is None:
+            raise ValueError("init_async_db needs a url or an app")
+        url = app.config['SQLALCHEMY_DATABASE_URI']
+    _engine = create_async_db_engine(url, preset, **overrides)
+    _sessionmaker = async_sessionmaker(_engine, expire_on_commit=False)
+    return _sessionmaker
+
+
+def async_engine():
+    if _engine is None:
+        raise RuntimeError("init_async_db() has not been called")
+    return _engine
+
+
+@asynccontextmanager
+async def async_session():
+    """An ``AsyncSession`` from the process-wide factory, closed on exit."""
+    if _sessionmaker is None:
+        raise RuntimeError("init_async_db() has not been called")
+    async with _sessionmaker() as session:
+        yield session
+
+
+async def dispose_async_db():
+    global _engine, _sessionmaker
+    if _engine is not None:
+        await _engine.dispose()
+    _engine = _sessionmaker = None
+
+
+def eager(model, *paths, strict=True):
+    """
+    Loader options that load ``paths`` of ``model`` in the query itself.
+
+    Args:
+        paths (str): Relationship names, dotted for nested ones
+            ('appointments.dog'); ``COMMON_RELATIONSHIPS[model]`` if none given.
+        strict (bool): Add ``raiseload('*')`` so any other relationship raises on access.
+
+    Returns:
+        list: Options for ``select(model).options(*...)`` or ``session.get``.
+    """
+    options = []
+    for path in paths or COMMON_RELATIONSHIPS.get(model, ()):
+        loader, cls = None, model
+        for name in path.split('.'):
+            relationship = sa_inspect(cls).relationships[name]
+            strategy = selectinload if relationship.uselist else joinedload
+            attr = getattr(cls, name)
+            loader = strategy(attr) if loader is None else getattr(loader, strategy.__name__)(attr)
+            cls = relationship.mapper.class_
+        options.append(loader)
+    if strict:
+        options.append(raiseload('*'))
+    return options
+
+
+def _primary_key(model):
+    return sa_inspect(model).primary_key[0]
+
+
+async def fetch(session, model, ids, *paths, strict=True):
+    """``model`` rows with primary key in ``ids``, ``paths`` eagerly loaded, in ``ids`` order."""
+    ids = list(ids)
+    if not ids:
+        return []
+    pk = _primary_key(model)
+    result = await session.execute(select(model).where(pk.in_(ids)).options(*eager(model, *paths, strict=strict)))
+    rows = {getattr(row, pk.key): row for row in result.unique().scalars()}
+    return [rows[i] for i in ids if i in rows]
+
+
+async def fetch_one(session, model, id, *paths, strict=True):
+    """One ``model`` row by primary key with ``paths`` eagerly loaded, or None."""
+    return await session.get(model, id, options=eager(model, *paths, strict=strict))
+
+
+def _percentile(ordered, q):
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else 0.0
+
+
+def _summary(mode, latencies, elapsed, concurrency):
+    latencies = sorted(latencies)
+    return {
+        'mode': mode, 'requests': len(latencies), 'concurrency': concurrency,
+        'ms': int(elapsed * 1000),
+        'throughput_rps': round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        'p50_ms': round(_percentile(latencies, 0.50), 3),
+        'p95_ms': round(_percentile(latencies, 0.95), 3),
+        'p99_ms': round(_percentile(latencies, 0.99), 3),
+    }
+
+
+async def _run_async(url, stmt_for, ids, concurrency):
+    engine = create_async_db_engine(
+        url, 'web', pool_size=concurrency, max_overflow=0, pool_logging_name='benchmark_async'
+    )
+    factory = async_sessionmaker(engine, expire_on_commit=False)
+    gate = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(id):
+        async with gate:
+            start = time.perf_counter()
+            async with factory() as session:
+                (await session.execute(stmt_for(id))).unique().scalars().all()
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    try:
+        start = time.perf_counter()
+        await asyncio.gather(*(one(id) for id in ids))
+        elapsed = time.perf_counter() - start
+    finally:
+        await engine.dispose()
+    return _summary('async', latencies, elapsed, concurrency)
+
+
+def _run_threads(url, stmt_for, ids, concurrency):
+    engine = create_engine(url, **_pool_options(
+        url, 'web', {'pool_size': concurrency, 'max_overflow': 0}, TimedQueuePool, 'benchmark_threads'
+    ))
+
+    def one(id):
+        start = time.perf_counter()
+        with Session(engine) as session:
+            session.execute(stmt_for(id)).unique().scalars().all()
+        return (time.perf_counter() - start) * 1000
+
+    try:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            latencies = list(pool.map(one, ids))
+        elapsed = time.perf_counter() - start
+    finally:
+        engine.dispose()
+    return _summary('threads', latencies, elapsed, concurrency)
+
+
+def benchmark_concurrent_reads(url=None, model=Dog, paths=None, ids=None, requests=500, concurrency=20):
+    """
+    Concurrent read throughput: asyncio + ``AsyncSession`` versus a thread per request.
+
+    Each request loads one ``model`` row by primary key with ``paths`` eagerly
+    loaded, in a fresh session. Both modes get a pool of ``concurrency``
+    connections and the same request sequence. Must be called outside a running
+    event loop.
+
+    Args:
+        url (str): Database URL; ``db.engine``'s (needs an app context) if None.
+        paths (tuple): Relationships to load; ``COMMON_RELATIONSHIPS[model]`` if None.
+        ids (list): Primary keys to cycle through; the first 1000 of ``model`` if None.
+        requests (int): Reads per mode.
+
+    Returns:
+        list: One dict per mode with ``requests``, ``ms``, ``throughput_rps`` and
+        ``p50_ms`` / ``p95_ms`` / ``p99_ms``. Checkout waits are in ``pool_metrics``
+        under ``benchmark_threads`` and ``benchmark_async``.
+    """
+    if url is None:
+        url = db.engine.url.render_as_string(hide_password=False)
+    pk = _primary_key(model)
+    if ids is None:
+        ids = db.session.execute(select(pk).order_by(pk).limit(1000)).scalars().all()
+    if not ids:
+        return []
+    ids = [ids[i % len(ids)] for i in range(requests)]
+    options = eager(model, *(paths or ()), strict=False)
+
+    def stmt_for(id):
+        return select(model).where(pk == id).options(*options)
+
+    sync_url = make_url(url)
+    if sync_url.get_driver_name() in ('asyncpg', 'aiosqlite'):
+        sync_url = sync_url.set(drivername=sync_url.get_backend_name())
+    return [
+        _run_threads(sync_url, stmt_for, ids, concurrency),
+        asyncio.run(_run_async(url, stmt_for, ids, concurrency)),
+    ]
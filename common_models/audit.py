@@ -0,0 +1,256 @@
+"""
+Batched ``AuditLog`` writer.
+
+Column diffs are taken from SQLAlchemy attribute history during flush, restricted
+to a per-table column allowlist, and buffered on the session. Once the
+transaction commits the buffer is written with a single multi-row insert (or a
+``COPY`` on Postgres), either inline or from a background thread. Bulk edits of
+``Dog`` survey answers therefore cost one statement per transaction instead of
+one insert per column touched.
+
+Usage:
+
+    from common_models.audit import enable_audit
+
+    enable_audit({'dog': '*', 'patient_diagnoses': {'clinical_status', 'condition_id'}},
+                 background=True)
+"""
+import atexit
+import csv
+import io
+import logging
+import queue
+import threading
+from datetime import date, datetime
+
+from sqlalchemy import event, insert, inspect
+
+from common_models.db import db
+from common_models.models import AuditLog
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_AUDIT_ALLOWLIST = {'dog': '*'}
+
+AUDIT_COLUMNS = ('table_name', 'column_name', 'record_id', 'old_value', 'new_value', 'dog_id', 'action')
+
+_INFO_BUFFER = '_audit_buffer'
+
+
+def _text(value):
+    if value is None:
+        return None
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return str(value)
+
+
+def write_audit_rows(connection, rows, use_copy=True):
+    """
+    Write buffered audit rows on ``connection`` in one statement.
+
+    Uses ``COPY ... FROM STDIN`` when the connection is psycopg2-backed Postgres and
+    ``use_copy`` is set, otherwise a multi-row ``INSERT``.
+    """
+    if not rows:
+        return 0
+    table = AuditLog.__table__
+    dbapi_connection = connection.connection.dbapi_connection
+    if use_copy and connection.dialect.name == 'postgresql' and hasattr(dbapi_connection, 'cursor'):
+        cursor = dbapi_connection.cursor()
+        if hasattr(cursor, 'copy_expert'):
+            buf = io.StringIO()
+            writer = csv.writer(buf)
+            for row in rows:
+                # '\N' marks NULL so it stays distinct from an empty string.
+                writer.writerow(['\\N' if row[c] is None else row[c] for c in AUDIT_COLUMNS])
+            buf.seek(0)
+            cursor.copy_expert(
+                f"COPY {table.name} ({', '.join(AUDIT_COLUMNS)}) FROM STDIN WITH (FORMAT csv, NULL '\\N')",
+                buf,
+            )
+            return len(rows)
+    connection.execute(insert(table), rows)
+    return len(rows)
+
+
+def _keep_old_value(target, value, oldvalue, initiator):
+    """No-op ``set`` listener; registering it with ``active_history`` is what matters."""
+
+
+class AuditWriter:
+    """
+    Session listeners that diff allowlisted columns and write them in batches.
+
+    Attributes:
+        allowlist (dict): table name -> set of column names, or '*' for every non-key column.
+        background (bool): Hand committed rows to a writer thread instead of writing inline.
+        use_copy (bool): Prefer ``COPY`` over a multi-row insert on Postgres.
+        flush_size (int): Rows the background thread accumulates before writing.
+        flush_interval (float): Seconds the background thread waits before writing a partial batch.
+    """
+
+    def __init__(self, allowlist=None, background=False, use_copy=True, flush_size=5000, flush_interval=1.0):
+        self.allowlist = dict(DEFAULT_AUDIT_ALLOWLIST if allowlist is None else allowlist)
+        self.background = background
+        self.use_copy = use_copy
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self._columns = {}
+        self._queue = None
+        self._thread = None
+
+    def _audited(self, mapper):
+        """(attribute key, column name) pairs audited for ``mapper``; computed once per mapper."""
+        if mapper not in self._columns:
+            allowed = self.allowlist.get(mapper.local_table.name)
+            pairs = ()
+            if allowed:
+                pairs = tuple(
+                    (prop.key, prop.columns[0].name) for prop in mapper.column_attrs
+                    if not prop.columns[0].primary_key and (allowed == '*' or prop.columns[0].name in allowed)
+                )
+            self._columns[mapper] = pairs
+        return self._columns[mapper]
+
+    def _diff(self, session):
+        rows = []
+        for objects, action in ((session.new, 'insert'), (session.dirty, 'update'), (session.deleted, 'delete')):
+            for obj in objects:
+                state = inspect(obj)
+                audited = self._audited(state.mapper)
+                if not audited:
+                    continue
+                identity = state.identity or state.mapper.primary_key_from_instance(obj)
+                record_id = identity[0] if len(identity) == 1 and isinstance(identity[0], int) else None
+                dog_id = getattr(obj, 'dog_id', None)
+                base = {
+                    'table_name': state.mapper.local_table.name,
+                    'record_id': record_id,
+                    'dog_id': dog_id if isinstance(dog_id, int) else None,
+                    'action': action,
+                }
+                if action != 'update':
+                    rows.append(dict(base, column_name=None, old_value=None, new_value=None))
+                    continue
+                for key, column_name in audited:
+                    history = state.attrs[key].history
+                    if not history.has_changes():
+                        continue
+                    old = history.deleted[0] if history.deleted else None
+                    new = history.added[0] if history.added else None
+                    if old == new:
+                        continue
+                    rows.append(dict(base, column_name=column_name, old_value=_text(old), new_value=_text(new)))
+        return rows
+
+    # -- session hooks ------------------------------------------------------
+
+    def after_flush(self, session, flush_context):
+        rows = self._diff(session)
+        if rows:
+            session.info.setdefault(_INFO_BUFFER, []).extend(rows)
+
+    def after_commit(self, session):
+        rows = session.info.pop(_INFO_BUFFER, None)
+        if not rows:
+            return
+        engine = session.get_bind()
+        if self.background:
+            self._ensure_thread()
+            self._queue.put((engine, rows))
+            return
+        try:
+            with engine.begin() as connection:
+                write_audit_rows(connection, rows, self.use_copy)
+        except Exception:
+            logger.exception("failed to write %d audit rows", len(rows))
+
+    def after_rollback(self, session):
+        session.info.pop(_INFO_BUFFER, None)
+
+    def _track_old_values(self):
+        """
+        Load the committed value of audited attributes when they are set.
+
+        Without active history, setting an expired or unloaded attribute (every
+        attribute after a commit, with the default ``expire_on_commit``) records
+        no before-image, and the audit row would get ``old_value=None``.
+        """
+        for mapper in db.Model.registry.mappers:
+            for key, _ in self._audited(mapper):
+                attribute = getattr(mapper.class_, key)
+                if not event.contains(attribute, 'set', _keep_old_value):
+                    event.listen(attribute, 'set', _keep_old_value, active_history=True)
+
+    def install(self, target):
+        self._track_old_values()
+        event.listen(target, 'after_flush', self.after_flush)
+        event.listen(target, 'after_commit', self.after_commit)
+        event.listen(target, 'after_soft_rollback', lambda session, previous: self.after_rollback(session))
+        return self
+
+    # -- background writer --------------------------------------------------
+
+    def _ensure_thread(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._queue = self._queue or queue.Queue()
+        self._thread = threading.Thread(target=self._drain, name='audit-writer', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _drain(self):
+        stopping = False
+        while not stopping:
+            pending = {}
+            count = 0
+            try:
+                item = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+            while item is not None:
+                engine, rows = item
+                pending.setdefault(engine, []).extend(rows)
+                count += len(rows)
+                if count >= self.flush_size:
+                    break
+                try:
+                    item = self._queue.get(timeout=self.flush_interval)
+                except queue.Empty:
+                    break
+            else:
+                stopping = True
+            for engine, rows in pending.items():
+                try:
+                    with engine.begin() as connection:
+                        write_audit_rows(connection, rows, self.use_copy)
+                except Exception:
+                    logger.exception("failed to write %d audit rows", len(rows))
+
+    def close(self, timeout=10):
+        """Flush what the background thread holds and stop it."""
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join(timeout)
+
+
+_writer = None
+
+
+def enable_audit(allowlist=None, target=None, **options):
+    """
+    Start auditing on ``target`` (defaults to ``db.session``). Idempotent.
+
+    Args:
+        allowlist (dict): table name -> column names or '*'; defaults to every ``dog`` column.
+        target: Session, sessionmaker or scoped session to hook.
+        **options: Passed to ``AuditWriter`` (``background``, ``use_copy``, ``flush_size``, ...).
+
+    Returns:
+        AuditWriter: The installed writer.
+    """
+    global _writer
+    if _writer is None:
+        _writer = AuditWriter(allowlist, **options).install(target if target is not None else db.session)
+    return _writer
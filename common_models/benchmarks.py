@@ -0,0 +1,322 @@
+"""
+Load benchmarks for the hot queries and bulk operations.
+
+Each case registered with ``@benchmark_case`` runs one operation per call
+(a screening load for one vet, one timeline page, one clinic's invoice sync,
+...) and returns how many units (dogs, rows, lines) it processed.
+``run_benchmarks`` warms every case up, runs it ``iterations`` times against
+vets and dogs sampled deterministically from the database, and reports latency
+percentiles and throughput per case. Bulk cases run inside a transaction that
+is rolled back, so runs are comparable. The lasting writes are that
+``timeline_read`` materializes the sampled dogs' timelines before reading them,
+and that ``invoice_sync`` stores the content hashes of the sampled vets'
+invoices during warm-up.
+
+Run against a database loaded with ``common_models.synthetic``; store a report
+as JSON and pass it to ``compare_reports`` to flag regressions.
+
+Usage:
+
+    from common_models.benchmarks import compare_reports, run_benchmarks
+    from common_models.synthetic import SyntheticDataset, load_synthetic
+
+    load_synthetic(SyntheticDataset(seed=7, clinics=20))
+    report = run_benchmarks(iterations=50)
+    json.dump(report, open('baseline.json', 'w'), default=str)
+    ...
+    regressions = compare_reports(json.load(open('baseline.json')), run_benchmarks(iterations=50))
+"""
+import time
+from collections import OrderedDict
+from datetime import datetime, time as dt_time, timedelta, timezone
+
+import numpy as np
+from sqlalchemy import func, select
+
+from common_models.compliance_cube import aggregate_facts
+from common_models.db import db
+from common_models.invoice_sync import sync_invoices
+from common_models.models import (
+    Appointments, ErrorLog, InvoiceHeaderFact, InvoiceLineFact, Ticket, TicketLinkedSignal, TicketStatus,
+    dog_vet_association,
+)
+from common_models.schedule import VetSchedule
+from common_models.screening import compute_input_digests, knowledge_graph_version
+from common_models.timeline import rebuild_timeline, timeline_page
+
+OPEN_TICKET_STATUSES = (TicketStatus.open, TicketStatus.in_progress, TicketStatus.waiting_on_customer, TicketStatus.blocked)
+
+_cases = OrderedDict()
+
+
+def benchmark_case(name, bulk=False):
+    """
+    Decorator registering ``fn(context, i)`` as a benchmark case.
+
+    ``fn`` performs the i-th operation and returns the units it processed. Bulk
+    cases are rolled back after every call.
+    """
+    def decorator(fn):
+        _cases[name] = (fn, bulk)
+        return fn
+    return decorator
+
+
+def benchmark_cases():
+    return list(_cases)
+
+
+class BenchmarkContext:
+    """
+    Deterministic sample of the database the cases draw their inputs from.
+
+    Attributes:
+        seed (int): Seed of the sample and of the per-iteration picks.
+        vet_ids (list): Sampled vets.
+        dog_ids (list): Sampled dogs.
+        as_of (date): Last day with invoice lines; windows end there.
+        cache (dict): Per-run values prepared by cases (kg version, payloads, ...).
+    """
+
+    def __init__(self, vet_ids, dog_ids, as_of, seed=0):
+        self.seed = seed
+        self.vet_ids = list(vet_ids)
+        self.dog_ids = list(dog_ids)
+        self.as_of = as_of
+        self.cache = {}
+        self._vet_dogs = {}
+
+    @classmethod
+    def load(cls, seed=0, vets=20, dogs=500):
+        """Sample ``vets`` vets with dogs and ``dogs`` dogs of those vets."""
+        rng = np.random.default_rng(seed)
+        link = dog_vet_association.c
+        vet_ids = db.session.execute(select(link.vet_id).distinct().order_by(link.vet_id)).scalars().all()
+        if len(vet_ids) > vets:
+            vet_ids = sorted(rng.choice(vet_ids, size=vets, replace=False).tolist())
+        dog_ids = db.session.execute(
+            select(link.dog_id).where(link.vet_id.in_(vet_ids)).order_by(link.dog_id)
+        ).scalars().all()
+        if len(dog_ids) > dogs:
+            dog_ids = sorted(rng.choice(dog_ids, size=dogs, replace=False).tolist())
+        last = db.session.execute(select(func.max(InvoiceLineFact.line_date))).scalar()
+        as_of = last.date() if last is not None else datetime.now(timezone.utc).date()
+        return cls(vet_ids, dog_ids, as_of, seed)
+
+    def vet(self, i):
+        return self.vet_ids[i % len(self.vet_ids)]
+
+    def dog(self, i):
+        return self.dog_ids[(i * 7919) % len(self.dog_ids)]
+
+    def vet_dog_ids(self, vet_id):
+        if vet_id not in self._vet_dogs:
+            link = dog_vet_association.c
+            self._vet_dogs[vet_id] = db.session.execute(
+                select(link.dog_id).where(link.vet_id == vet_id).order_by(link.dog_id)
+            ).scalars().all()
+        return self._vet_dogs[vet_id]
+
+
+def summarize_latencies(latencies_ms, elapsed, units=None):
+    """
+    Percentiles and throughput of one case's timings.
+
+    Args:
+        latencies_ms (list): Milliseconds per operation.
+        elapsed (float): Wall seconds of all operations.
+        units (int): Units processed in total; ``len(latencies_ms)`` if None.
+
+    Returns:
+        dict: ``operations``, ``units``, ``mean_ms``, ``p50_ms``, ``p95_ms``,
+        ``p99_ms``, ``max_ms``, ``ops_per_s`` and ``units_per_s``.
+    """
+    values = np.asarray(latencies_ms, dtype=float)
+    units = len(values) if units is None else units
+    if not len(values):
+        return {'operations': 0, 'units': 0}
+    p50, p95, p99 = np.percentile(values, (50, 95, 99))
+    return {
+        'operations': len(values), 'units': units,
+        'mean_ms': round(float(values.mean()), 3), 'p50_ms': round(float(p50), 3),
+        'p95_ms': round(float(p95), 3), 'p99_ms': round(float(p99), 3), 'max_ms': round(float(values.max()), 3),
+        'ops_per_s': round(len(values) / elapsed, 1) if elapsed else 0.0,
+        'units_per_s': round(units / elapsed, 1) if elapsed else 0.0,
+    }
+
+
+def run_case(name, context, iterations=30, warmup=3):
+    """Run one registered case; the summary plus ``case``."""
+    fn, bulk = _cases[name]
+    for i in range(warmup):
+        fn(context, i)
+        if bulk:
+            db.session.rollback()
+    latencies = []
+    units = 0
+    elapsed = 0.0
+    for i in range(warmup, warmup + iterations):
+        start = time.perf_counter()
+        units += fn(context, i) or 0
+        took = time.perf_counter() - start
+        if bulk:
+            db.session.rollback()
+        latencies.append(took * 1000)
+        elapsed += took
+    return dict(case=name, bulk=bulk, **summarize_latencies(latencies, elapsed, units))
+
+
+def run_benchmarks(names=None, iterations=30, warmup=3, seed=0, context=None):
+    """
+    Run the registered cases (all, or ``names``) against the current database.
+
+    Returns:
+        list: One summary dict per case, in registration order.
+    """
+    context = context or BenchmarkContext.load(seed)
+    if not context.vet_ids or not context.dog_ids:
+        raise ValueError("no vets with dogs to benchmark; load a synthetic dataset first")
+    report = []
+    for name in names or list(_cases):
+        report.append(run_case(name, context, iterations, warmup))
+        db.session.rollback()
+    return report
+
+
+def compare_reports(baseline, current, tolerance=0.2, metric='p95_ms'):
+    """
+    Cases whose ``metric`` got worse by more than ``tolerance`` (a fraction) since ``baseline``.
+
+    Returns:
+        list: Dicts with ``case``, ``baseline``, ``current`` and ``change`` (fraction), worst first.
+    """
+    before = {row['case']: row for row in baseline}
+    regressions = []
+    for row in current:
+        old = before.get(row['case'], {}).get(metric)
+        new = row.get(metric)
+        if not old or new is None:
+            continue
+        change = (new - old) / old
+        if change > tolerance:
+            regressions.append({'case': row['case'], 'baseline': old, 'current': new, 'change': round(change, 3)})
+    return sorted(regressions, key=lambda r: -r['change'])
+
+
+@benchmark_case('screening_load')
+def _screening_load(context, i):
+    """Screening input digests for all dogs of one vet."""
+    if 'kg_version' not in context.cache:
+        context.cache['kg_version'] = knowledge_graph_version()
+    dog_ids = context.vet_dog_ids(context.vet(i))
+    compute_input_digests(dog_ids, context.cache['kg_version'])
+    return len(dog_ids)
+
+
+@benchmark_case('timeline_read')
+def _timeline_read(context, i):
+    """First page of one dog's timeline."""
+    if 'timeline' not in context.cache:
+        context.cache['timeline'] = rebuild_timeline(context.dog_ids)
+    rows, _ = timeline_page(context.dog(i), limit=50)
+    return len(rows)
+
+
+@benchmark_case('timeline_rebuild', bulk=True)
+def _timeline_rebuild(context, i):
+    """Timeline of one vet's dogs rebuilt from the source tables."""
+    return rebuild_timeline(context.vet_dog_ids(context.vet(i)), commit=False)['rows']
+
+
+@benchmark_case('free_slots')
+def _free_slots(context, i):
+    """One vet's free 30 minute slots over a working week."""
+    day = context.as_of - timedelta(days=i % 60)
+    start = datetime.combine(day, dt_time(), timezone.utc)
+    end = start + timedelta(days=5)
+    return len(VetSchedule.load(context.vet(i), start, end).free_slots(start, end, minutes=30))
+
+
+@benchmark_case('invoice_reconciliation')
+def _invoice_reconciliation(context, i):
+    """Compliance and revenue facts of one vet over 30 days, straight from the fact tables."""
+    return len(aggregate_facts([context.vet(i)], context.as_of - timedelta(days=30), context.as_of))
+
+
+def _invoice_payloads(context):
+    """Each sampled vet's last 30 days of invoices, as a PiMS pull delivers them."""
+    if 'invoices' not in context.cache:
+        since = context.as_of - timedelta(days=30)
+        payloads = {}
+        for vet_id in context.vet_ids:
+            headers = db.session.execute(
+                select(InvoiceHeaderFact.__table__).where(
+                    InvoiceHeaderFact.vet_id == vet_id, InvoiceHeaderFact.invoice_date >= since
+                )
+            ).mappings().all()
+            ids = [h['invoice_id'] for h in headers]
+            lines = db.session.execute(
+                select(InvoiceLineFact.__table__).where(InvoiceLineFact.invoice_id.in_(ids))
+            ).mappings().all() if ids else []
+            payloads[vet_id] = ([dict(h) for h in headers], [dict(l) for l in lines])
+            # Generated rows carry no content_hash, so a first sync rewrites all of them.
+            # Store the hashes once, here, so the timed runs measure the usual re-sync.
+            sync_invoices(*payloads[vet_id])
+        context.cache['invoices'] = payloads
+    return context.cache['invoices']
+
+
+@benchmark_case('invoice_sync', bulk=True)
+def _invoice_sync(context, i):
+    """Re-sync of one vet's last 30 days of invoices, as a PiMS pull delivers them."""
+    headers, lines = _invoice_payloads(context)[context.vet(i)]
+    sync_invoices(headers, lines, commit=False)
+    return len(lines)
+
+
+@benchmark_case('ticket_triage')
+def _ticket_triage(context, i):
+    """Open ticket queue: most urgent first, with the number of linked error signals."""
+    signals = (
+        select(TicketLinkedSignal.ticket_id, func.count().label('signals'))
+        .group_by(TicketLinkedSignal.ticket_id).subquery()
+    )
+    stmt = (
+        select(Ticket.id, Ticket.priority, Ticket.status, Ticket.title, Ticket.sla_deadline_at,
+               func.coalesce(signals.c.signals, 0))
+        .outerjoin(signals, signals.c.ticket_id == Ticket.id)
+        .where(Ticket.status.in_(OPEN_TICKET_STATUSES))
+        .order_by(Ticket.priority, Ticket.sla_deadline_at.nullslast(), Ticket.created_at)
+        .limit(50)
+    )
+    if i % 2:
+        stmt = stmt.where(Ticket.vet_id == context.vet(i))
+    return len(db.session.execute(stmt).all())
+
+
+@benchmark_case('error_triage')
+def _error_triage(context, i):
+    """Top error fingerprints of the last 24 hours, with counts and last occurrence."""
+    end = db.session.execute(select(func.max(ErrorLog.created_at))).scalar()
+    if end is None:
+        return 0
+    stmt = (
+        select(ErrorLog.fingerprint, func.count(), func.max(ErrorLog.created_at), func.min(ErrorLog.message_template))
+        .where(ErrorLog.created_at >= end - timedelta(days=1), ErrorLog.silenced.is_(False))
+        .group_by(ErrorLog.fingerprint)
+        .order_by(func.count().desc())
+        .limit(20)
+    )
+    return len(db.session.execute(stmt).all())
+
+
+@benchmark_case('vet_day_appointments')
+def _vet_day_appointments(context, i):
+    """One vet's appointments of one day, as the schedule and display views read them."""
+    day = context.as_of - timedelta(days=i % 30)
+    start = datetime.combine(day, dt_time(), timezone.utc)
+    stmt = select(Appointments).where(
+        Appointments.vet_id == context.vet(i), Appointments.startTime >= start,
+        Appointments.startTime < start + timedelta(days=1),
+    ).order_by(Appointments.startTime)
+    return len(db.session.execute(stmt).scalars().all())
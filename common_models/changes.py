@@ -0,0 +1,334 @@
+"""
+Change-data capture from the ORM session into the ``change_events`` outbox.
+
+``enable_change_capture`` hooks the session so that every flush touching a
+captured model writes compact ``ChangeEvent`` rows (table, primary key, changed
+columns, new ``group_hash``) with one multi-row insert on the flush's own
+connection. The events therefore commit or roll back together with the change
+itself. Downstream caches read the outbox through ``ChangeFeedConsumer`` instead
+of rescanning the source tables.
+
+Usage:
+
+    from common_models.changes import enable_change_capture, ChangeFeedConsumer
+
+    enable_change_capture()                      # once, at app start-up
+
+    consumer = ChangeFeedConsumer('risk_scores', tables=['dog', 'patient_diagnoses'])
+    consumer.consume(lambda events: refresh_scores({e.dog_id for e in events}))
+
+Only unit-of-work flushes are captured; ``Query.update()`` / ``Query.delete()``,
+bulk ``update(Model)`` executemany and raw SQL bypass the session hooks and must
+emit their own events with ``emit_change_events``.
+"""
+import json
+import logging
+
+from sqlalchemy import event, func, insert, inspect, text, tuple_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from common_models.db import db
+from common_models.models import (
+    Appointments, ChangeEvent, ChangeFeedOffset, Condition, ConditionAffiliated, ConditionGeorisk,
+    ConditionImaging, ConditionLab, ConditionSign, ConditionSignalment, ConditionSymptom, Dog, InvoiceLineFact,
+    PatientAlerts, PatientDiagnoses, PatientDiagnostics, PatientEmbedding, PatientInterventions,
+    PatientLabResult, PatientPreventions, PatientPrescriptions, PatientRecordLink, PatientSymptoms,
+    PatientVitals, Simulation, Weights,
+)
+
+logger = logging.getLogger(__name__)
+
+NOTIFY_CHANNEL = 'change_events'
+
+CAPTURED_MODELS = (
+    Dog,
+    PatientAlerts, PatientPreventions, PatientPrescriptions, PatientDiagnoses, PatientSymptoms,
+    PatientDiagnostics, PatientLabResult, PatientRecordLink, PatientVitals, PatientEmbedding,
+    PatientInterventions, Weights, Appointments, Simulation,
+    Condition, ConditionSignalment, ConditionSymptom, ConditionSign, ConditionLab, ConditionImaging,
+    ConditionAffiliated, ConditionGeorisk,
+    InvoiceLineFact,
+)
+
+_INFO_PENDING = '_change_events_pending'
+_INFO_NOTIFIED = '_change_events_notified'
+_INFO_TXID = '_change_events_txid'
+
+
+def _record_pk(state):
+    identity = state.identity or inspect(state.mapper).primary_key_from_instance(state.obj())
+    if len(identity) == 1:
+        return str(identity[0])
+    return json.dumps(list(identity), default=str)
+
+
+def _dog_id(obj):
+    value = getattr(obj, 'dog_id', None)
+    try:
+        return int(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def _within(transaction, ancestor):
+    """True when ``transaction`` is ``ancestor`` or nested inside it."""
+    while transaction is not None:
+        if transaction is ancestor:
+            return True
+        transaction = transaction.parent
+    return False
+
+
+class ChangeCapture:
+    """
+    Session listeners that turn flushed changes into ``ChangeEvent`` rows.
+
+    Attributes:
+        models (tuple): Mapped classes whose changes are captured.
+        notify_channel (str): Postgres channel notified once per transaction; None disables it.
+        subscribers (list): In-process callables run after commit with the committed events.
+    """
+
+    def __init__(self, models=CAPTURED_MODELS, notify_channel=NOTIFY_CHANNEL):
+        self.models = tuple(models)
+        self.notify_channel = notify_channel
+        self.subscribers = []
+
+    def _events(self, session):
+        def collect(objects, op):
+            for obj in objects:
+                if not isinstance(obj, self.models):
+                    continue
+                state = inspect(obj)
+                changed = None
+                if op == 'update':
+                    changed = [
+                        prop.columns[0].name for prop in state.mapper.column_attrs
+                        if state.attrs[prop.key].history.has_changes()
+                    ]
+                    if not changed:
+                        continue
+                yield {
+                    'table_name': state.mapper.local_table.name,
+                    'op': op,
+                    'record_pk': _record_pk(state),
+                    'dog_id': _dog_id(obj),
+                    'changed_columns': changed,
+                    'group_hash': getattr(obj, 'group_hash', None),
+                }
+
+        yield from collect(session.new, 'insert')
+        yield from collect(session.dirty, 'update')
+        yield from collect(session.deleted, 'delete')
+
+    def after_flush(self, session, flush_context):
+        # History is still intact here; it is reset in after_flush_postexec.
+        self.record(session, list(self._events(session)))
+
+    def record(self, session, rows):
+        """Write event rows on ``session``'s connection and buffer them for subscribers."""
+        if not rows:
+            return
+        connection = session.connection()
+        postgres = connection.dialect.name == 'postgresql'
+        txid = session.info.get(_INFO_TXID)
+        if txid is None:
+            txid = connection.execute(text("SELECT txid_current()")).scalar() if postgres else 0
+            session.info[_INFO_TXID] = txid
+        for row in rows:
+            row['txid'] = txid
+        connection.execute(insert(ChangeEvent.__table__), rows)
+        # Tagged with the innermost savepoint, so rolling it back drops only its own work.
+        savepoint = session.get_nested_transaction()
+        if postgres and self.notify_channel and _INFO_NOTIFIED not in session.info:
+            connection.execute(text("SELECT pg_notify(:channel, '')"), {'channel': self.notify_channel})
+            session.info[_INFO_NOTIFIED] = savepoint
+        if self.subscribers:
+            session.info.setdefault(_INFO_PENDING, []).extend((savepoint, row) for row in rows)
+
+    def after_commit(self, session):
+        pending = session.info.pop(_INFO_PENDING, None)
+        session.info.pop(_INFO_NOTIFIED, None)
+        session.info.pop(_INFO_TXID, None)
+        if not pending:
+            return
+        rows = [row for _, row in pending]
+        for subscriber in self.subscribers:
+            try:
+                subscriber(rows)
+            except Exception:
+                logger.exception("change subscriber %r failed", subscriber)
+
+    def after_rollback(self, session, previous_transaction=None):
+        """
+        Forget buffered events when the outermost transaction rolls back.
+
+        A savepoint rollback only drops what was flushed inside that savepoint;
+        events of earlier flushes still commit to the outbox with the outer
+        transaction, so subscribers must still receive them.
+        """
+        if previous_transaction is None or not previous_transaction.nested:
+            for key in (_INFO_PENDING, _INFO_NOTIFIED, _INFO_TXID):
+                session.info.pop(key, None)
+            return
+        pending = session.info.get(_INFO_PENDING)
+        if pending:
+            pending[:] = [(savepoint, row) for savepoint, row in pending
+                          if not _within(savepoint, previous_transaction)]
+        if _INFO_NOTIFIED in session.info and _within(session.info[_INFO_NOTIFIED], previous_transaction):
+            del session.info[_INFO_NOTIFIED]
+
+    def install(self, target):
+        event.listen(target, 'after_flush', self.after_flush)
+        event.listen(target, 'after_commit', self.after_commit)
+        event.listen(target, 'after_soft_rollback', self.after_rollback)
+        return self
+
+
+_capture = None
+
+
+def enable_change_capture(target=None, models=CAPTURED_MODELS, notify_channel=NOTIFY_CHANNEL):
+    """
+    Start capturing changes on ``target`` (defaults to ``db.session``). Idempotent.
+
+    Returns:
+        ChangeCapture: Add callables to ``.subscribers`` for in-process notification.
+    """
+    global _capture
+    if _capture is None:
+        _capture = ChangeCapture(models, notify_channel).install(target if target is not None else db.session)
+    return _capture
+
+
+def change_capture():
+    """The installed ``ChangeCapture``, or None when ``enable_change_capture`` has not run."""
+    return _capture
+
+
+def emit_change_events(table_name, op, records, changed_columns=None, session=None):
+    """
+    Write outbox events for rows changed outside the unit of work (Core or bulk writes).
+
+    Args:
+        table_name (str): Table of the changed rows.
+        op (str): insert|update|delete.
+        records (iterable): (record_pk, dog_id) pairs.
+        changed_columns (list): Columns an update wrote.
+        session: Session whose transaction the events join; ``db.session`` if None.
+
+    Returns:
+        int: Events written; 0 when change capture is off.
+    """
+    if _capture is None:
+        return 0
+    rows = [
+        {'table_name': table_name, 'op': op, 'record_pk': str(record_pk), 'dog_id': dog_id,
+         'changed_columns': changed_columns, 'group_hash': None}
+        for record_pk, dog_id in records
+    ]
+    _capture.record(session if session is not None else db.session(), rows)
+    return len(rows)
+
+
+class ChangeFeedConsumer:
+    """
+    Batched, at-least-once reader of the ``change_events`` outbox.
+
+    Events are read in ``(txid, id)`` order and, on Postgres, only from
+    transactions older than the current snapshot's xmin. An id-ordered read could
+    skip an event whose transaction commits after a higher id was already
+    consumed; bounding by xmin means every event below the offset is final.
+    The offset row is locked while a batch is handled, so running the same
+    consumer in several processes is safe (they take turns).
+
+    Attributes:
+        name (str): Consumer name; its offset lives in ``change_feed_offsets``.
+        tables (list): Table names to receive; None for all.
+        batch_size (int): Maximum events per handler call.
+    """
+
+    def __init__(self, name, tables=None, batch_size=500):
+        self.name = name
+        self.tables = list(tables) if tables else None
+        self.batch_size = batch_size
+
+    def _lock_offset(self, session):
+        if session.get_bind().dialect.name == 'postgresql':
+            session.execute(
+                pg_insert(ChangeFeedOffset.__table__)
+                .values(consumer=self.name, last_txid=0, last_event_id=0)
+                .on_conflict_do_nothing(index_elements=['consumer'])
+            )
+        elif session.get(ChangeFeedOffset, self.name) is None:
+            session.add(ChangeFeedOffset(consumer=self.name, last_txid=0, last_event_id=0))
+            session.flush()
+        return (session.query(ChangeFeedOffset)
+                .filter(ChangeFeedOffset.consumer == self.name)
+                .with_for_update()
+                .populate_existing()
+                .one())
+
+    def _batch(self, session, offset):
+        query = session.query(ChangeEvent).filter(
+            tuple_(ChangeEvent.txid, ChangeEvent.id) > tuple_(offset.last_txid, offset.last_event_id)
+        )
+        if session.get_bind().dialect.name == 'postgresql':
+            query = query.filter(ChangeEvent.txid < func.txid_snapshot_xmin(func.txid_current_snapshot()))
+        if self.tables:
+            query = query.filter(ChangeEvent.table_name.in_(self.tables))
+        return query.order_by(ChangeEvent.txid, ChangeEvent.id).limit(self.batch_size).all()
+
+    def consume_batch(self, handler):
+        """
+        Hand the next batch to ``handler(events)`` and advance the offset if it returns.
+
+        Returns:
+            int: Number of events handled; 0 when caught up.
+        """
+        session = db.session
+        try:
+            offset = self._lock_offset(session)
+            events = self._batch(session, offset)
+            if events:
+                handler(events)
+                offset.last_txid = events[-1].txid
+                offset.last_event_id = events[-1].id
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        return len(events)
+
+    def consume(self, handler, max_batches=None):
+        """Consume batches until caught up (or ``max_batches``). Returns the number of events handled."""
+        total = batches = 0
+        while max_batches is None or batches < max_batches:
+            handled = self.consume_batch(handler)
+            if not handled:
+                break
+            total += handled
+            batches += 1
+        return total
+
+    def lag(self):
+        """Number of events not yet consumed."""
+        offset = db.session.get(ChangeFeedOffset, self.name)
+        last = (offset.last_txid, offset.last_event_id) if offset else (0, 0)
+        query = db.session.query(func.count(ChangeEvent.id)).filter(
+            tuple_(ChangeEvent.txid, ChangeEvent.id) > tuple_(*last)
+        )
+        if self.tables:
+            query = query.filter(ChangeEvent.table_name.in_(self.tables))
+        return query.scalar()
+
+
+def prune_change_events(older_than):
+    """Delete events created before ``older_than`` that every consumer has passed."""
+    slowest = db.session.query(func.min(ChangeFeedOffset.last_txid)).scalar()
+    query = db.session.query(ChangeEvent).filter(ChangeEvent.created_at < older_than)
+    if slowest is not None:
+        query = query.filter(ChangeEvent.txid < slowest)
+    deleted = query.delete(synchronize_session=False)
+    db.session.commit()
+    return deleted
@@ -0,0 +1,284 @@
+"""
+Compiled ``Codebook`` for decoding coded survey answers.
+
+``CompiledCodebook`` parses every ``Codebook.value_label_map`` once into a
+``VariableCodes`` per variable: a dense code -> label array (offset by the
+smallest code) and a normalized label -> code map. Whole ``Dog`` columns are
+then decoded or encoded with array indexing instead of a codebook lookup and a
+JSON parse per value.
+
+The process-wide instance is loaded on first use and dropped on writes to
+``Codebook``; ``version`` is a hash of the codebook content, for tagging
+exports and caches built from it.
+
+Usage:
+
+    from common_models.codebook import compiled_codebook, validate_dog_codes
+
+    codebook = compiled_codebook()
+    labels = codebook.decode('de_drinking_water_source', frame['de_drinking_water_source'])
+    codes = codebook.encode('de_drinking_water_source', ['Well', 'City'])
+    problems = validate_dog_codes()
+"""
+import hashlib
+import json
+import threading
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session, object_session
+
+from common_models.db import db
+from common_models.models import Codebook, Dog
+
+# Codes spanning more than this many values are looked up by dict instead of a dense array.
+MAX_DENSE_SPAN = 4096
+
+_INFO_PENDING = '_codebook_changes'
+
+
+def normalize_label(label):
+    return ' '.join(str(label).lower().split())
+
+
+def parse_value_label_map(value_label_map):
+    """
+    ``value_label_map`` as {int code: label}.
+
+    Accepts a dict (keys may be strings such as "1" or "1.0"), a JSON string of
+    one, or a list of {"value", "label"} objects / (value, label) pairs. Entries
+    whose code is not an integer are skipped.
+    """
+    if isinstance(value_label_map, str):
+        try:
+            value_label_map = json.loads(value_label_map)
+        except ValueError:
+            return {}
+    if isinstance(value_label_map, dict):
+        pairs = value_label_map.items()
+    elif isinstance(value_label_map, list):
+        pairs = [(p.get('value'), p.get('label')) if isinstance(p, dict) else tuple(p)[:2] for p in value_label_map]
+    else:
+        return {}
+    codes = {}
+    for code, label in pairs:
+        try:
+            number = float(code)
+        except (TypeError, ValueError):
+            continue
+        if number.is_integer() and label is not None:
+            codes[int(number)] = str(label)
+    return codes
+
+
+class VariableCodes:
+    """
+    Code <-> label lookups for one variable.
+
+    Attributes:
+        variable (str): Codebook variable.
+        labels (dict): code -> label.
+        offset (int): Smallest code; ``table[code - offset]`` is its label.
+        table (np.ndarray): Dense object array of labels (None for gaps), or None when sparse.
+    """
+
+    def __init__(self, variable, labels):
+        self.variable = variable
+        self.labels = dict(sorted(labels.items()))
+        self._codes = {normalize_label(label): code for code, label in self.labels.items()}
+        self.offset = min(self.labels) if self.labels else 0
+        span = max(self.labels) - self.offset + 1 if self.labels else 0
+        self.table = None
+        if 0 < span <= MAX_DENSE_SPAN:
+            self.table = np.full(span, None, dtype=object)
+            self.table[np.array(list(self.labels)) - self.offset] = list(self.labels.values())
+
+    def __contains__(self, code):
+        return code in self.labels
+
+    def _integers(self, values):
+        numeric = pd.to_numeric(pd.Series(values, copy=False), errors='coerce').to_numpy(dtype=float)
+        valid = ~np.isnan(numeric)
+        valid[valid] = numeric[valid] == np.floor(numeric[valid])
+        return numeric, valid
+
+    def decode(self, values):
+        """Labels for an array of codes; None for missing or unknown codes."""
+        numeric, valid = self._integers(values)
+        out = np.full(len(numeric), None, dtype=object)
+        if not valid.any():
+            return out
+        codes = numeric[valid].astype(np.int64)
+        if self.table is not None:
+            index = codes - self.offset
+            inside = (index >= 0) & (index < len(self.table))
+            decoded = np.full(len(codes), None, dtype=object)
+            decoded[inside] = self.table[index[inside]]
+        else:
+            decoded = np.array([self.labels.get(code) for code in codes.tolist()], dtype=object)
+        out[valid] = decoded
+        return out
+
+    def encode(self, labels):
+        """Codes for an array of labels (matched case- and whitespace-insensitively); None when unknown."""
+        series = pd.Series(labels, copy=False, dtype=object)
+        present = series.notna()
+        out = np.full(len(series), None, dtype=object)
+        codes = series[present].map(normalize_label).map(self._codes).astype('Int64')
+        out[present.to_numpy()] = codes.astype(object).where(codes.notna(), None).to_numpy()
+        return out
+
+    def unknown(self, values):
+        """Boolean mask of non-missing values that are not codes of this variable."""
+        numeric, valid = self._integers(values)
+        present = ~np.isnan(numeric)
+        known = np.zeros(len(numeric), dtype=bool)
+        known[valid] = np.isin(numeric[valid].astype(np.int64), list(self.labels))
+        return present & ~known
+
+
+class CompiledCodebook:
+    """
+    Every codebook variable with a usable ``value_label_map``.
+
+    Attributes:
+        variables (dict): variable (and variable_handle) -> ``VariableCodes``.
+        version (str): Hash of the codebook content it was compiled from.
+    """
+
+    def __init__(self, rows=()):
+        self.variables = {}
+        digest = hashlib.sha256()
+        for variable, handle, value_label_map in rows:
+            digest.update(json.dumps([variable, handle, value_label_map], sort_keys=True, default=str).encode('utf-8'))
+            labels = parse_value_label_map(value_label_map)
+            if not labels:
+                continue
+            codes = VariableCodes(variable or handle, labels)
+            for key in (variable, handle):
+                if key:
+                    self.variables.setdefault(key, codes)
+        self.version = digest.hexdigest()[:32]
+
+    @classmethod
+    def load(cls):
+        """Compile from the codebook table in one query."""
+        return cls(db.session.execute(
+            select(Codebook.variable, Codebook.variable_handle, Codebook.value_label_map).order_by(Codebook.id)
+        ).all())
+
+    def __contains__(self, variable):
+        return variable in self.variables
+
+    def codes(self, variable):
+        """``VariableCodes`` for a variable; KeyError when it has no value map."""
+        return self.variables[variable]
+
+    def label(self, variable, code):
+        codes = self.variables.get(variable)
+        return codes.labels.get(code) if codes is not None else None
+
+    def decode(self, variable, values):
+        return self.codes(variable).decode(values)
+
+    def encode(self, variable, labels):
+        return self.codes(variable).encode(labels)
+
+    def decode_frame(self, frame, columns=None):
+        """Copy of ``frame`` with every coded column (or just ``columns``) replaced by its labels."""
+        decoded = frame.copy()
+        for column in columns or [c for c in frame.columns if c in self.variables]:
+            decoded[column] = self.decode(column, frame[column].to_numpy())
+        return decoded
+
+    def dog_columns(self):
+        """``Dog`` columns that have a value map."""
+        return [c.name for c in Dog.__table__.columns if c.name in self.variables]
+
+
+_lock = threading.Lock()
+_codebook = None
+
+
+def compiled_codebook():
+    """Process-wide ``CompiledCodebook``, compiled on first use and dropped when codebook writes commit."""
+    global _codebook
+    with _lock:
+        if _codebook is None:
+            _codebook = CompiledCodebook.load()
+        return _codebook
+
+
+def invalidate_compiled_codebook(*args):
+    global _codebook
+    with _lock:
+        _codebook = None
+
+
+def _mark_changed(mapper, connection, target):
+    # Recompiling at flush could cache value maps that roll back; drop it on commit.
+    session = object_session(target)
+    if session is not None:
+        session.info[_INFO_PENDING] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_pending(session):
+    if session.info.pop(_INFO_PENDING, False):
+        invalidate_compiled_codebook()
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _drop_pending(session, previous_transaction):
+    session.info.pop(_INFO_PENDING, None)
+
+
+for _event in ('after_insert', 'after_update', 'after_delete'):
+    event.listen(Codebook, _event, _mark_changed)
+
+
+def validate_dog_codes(dog_ids=None, columns=None, batch_size=20000, sample_size=10):
+    """
+    ``Dog`` values that are not codes in their variable's value map.
+
+    Args:
+        dog_ids (iterable): Dogs to check; all dogs if None.
+        columns (list): Columns to check; every coded ``Dog`` column if None.
+        batch_size (int): Dogs read per query.
+        sample_size (int): Dog ids kept per problem.
+
+    Returns:
+        list: Dicts with ``variable``, ``value``, ``count`` and ``dog_ids`` (a
+        sample), most frequent first.
+    """
+    codebook = compiled_codebook()
+    columns = list(columns or codebook.dog_columns())
+    if not columns:
+        return []
+    table = Dog.__table__
+    counts = Counter()
+    samples = {}
+    stmt = select(table.c.dog_id, *[table.c[c] for c in columns]).order_by(table.c.dog_id)
+    if dog_ids is not None:
+        stmt = stmt.where(table.c.dog_id.in_(list(dog_ids)))
+    result = db.session.execute(stmt.execution_options(yield_per=batch_size))
+    for batch in result.partitions(batch_size):
+        frame = pd.DataFrame(batch, columns=['dog_id', *columns])
+        for column in columns:
+            mask = codebook.codes(column).unknown(frame[column].to_numpy())
+            if not mask.any():
+                continue
+            for dog_id, value in zip(frame['dog_id'].to_numpy()[mask].tolist(), frame[column].to_numpy()[mask].tolist()):
+                if isinstance(value, float) and value.is_integer():
+                    value = int(value)
+                key = (column, value)
+                counts[key] += 1
+                sample = samples.setdefault(key, [])
+                if len(sample) < sample_size:
+                    sample.append(dog_id)
+    return [
+        {'variable': column, 'value': value, 'count': count, 'dog_ids': samples[(column, value)]}
+        for (column, value), count in counts.most_common()
+    ]
@@ -0,0 +1,383 @@
+"""
+"Patients like this one": k-NN over standardized ``Dog`` feature vectors.
+
+``CohortIndex`` encodes signalment (``dd_*``, ``breed``), environment (``cv_*``,
+``pv_*``, ``tp_*``), lifestyle survey answers (``de_*``, ``df_*``, ``pa_*``,
+``mp_*``, ``ss_*``) and ``hs_health_conditions_*`` flags into one float32 matrix:
+
+    continuous   z-score, missing -> 0 (the mean), clipped to +/- ``CLIP``
+    categorical  one-hot over the ``MAX_LEVELS`` most frequent answers, missing -> all 0
+
+A column is categorical when its ``Codebook.variable_type`` says so (or, with no
+codebook entry, when it is a string column). Each feature group is scaled to the
+same total weight so that the ~80 lifestyle answers do not drown out signalment,
+and rows are L2-normalized, so similarity is a dot product and a batch of
+queries is one matrix product.
+
+The process-wide index picks up ``Dog`` writes made through the ORM once they
+commit: changed dogs are re-encoded with the fitted statistics on the next
+query, and the index is refitted once ``REFIT_FRACTION`` of it has changed or
+the codebook changes.
+Writes from other processes arrive through ``apply_cohort_events`` when it is
+wired to a ``ChangeFeedConsumer`` on the ``dog`` table.
+
+Usage:
+
+    from common_models.cohorts import cohort_index
+
+    cohort_index().neighbors(dog_id, k=10)                        # [(dog_id, similarity), ...]
+    cohort_index().neighbors_many(dog_ids, k=10, candidates=vet_dog_ids)
+"""
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import Float, Integer, Numeric, String, event, inspect, select
+from sqlalchemy.orm import Session, object_session
+
+from common_models.db import db
+from common_models.models import Codebook, Dog
+
+FEATURE_GROUPS = OrderedDict([
+    ('signalment', ('dd_', 'breed')),
+    ('environment', ('cv_', 'pv_', 'tp_')),
+    ('lifestyle', ('de_', 'df_', 'pa_', 'mp_', 'ss_')),
+    ('health', ('hs_health_conditions_',)),
+])
+
+EXCLUDED_COLUMNS = ('dd_microchip', 'dd_dog_name', 'dd_dob')
+
+CATEGORICAL_TYPES = ('categorical', 'nominal', 'multiple choice', 'single choice', 'string', 'text')
+
+MAX_LEVELS = 20
+
+CLIP = 4.0
+
+REFIT_FRACTION = 0.1
+
+_INFO_PENDING = '_cohort_changes'
+
+
+def feature_columns():
+    """(column name, group) for every ``Dog`` column that feeds the index."""
+    columns = []
+    for column in Dog.__table__.columns:
+        if column.name in EXCLUDED_COLUMNS or not isinstance(column.type, (Integer, Float, Numeric, String)):
+            continue
+        for group, prefixes in FEATURE_GROUPS.items():
+            if any(column.name == p or (p.endswith('_') and column.name.startswith(p)) for p in prefixes):
+                columns.append((column.name, group))
+                break
+    return columns
+
+
+def column_kinds(names):
+    """column name -> 'categorical' | 'continuous', from ``Codebook.variable_type`` where known."""
+    types = {}
+    for variable, handle, variable_type in db.session.execute(
+        select(Codebook.variable, Codebook.variable_handle, Codebook.variable_type)
+    ):
+        for key in (handle, variable):
+            if key and variable_type:
+                types.setdefault(key, variable_type.strip().lower())
+    table = Dog.__table__
+    kinds = {}
+    for name in names:
+        variable_type = types.get(name)
+        if variable_type is None:
+            categorical = isinstance(table.c[name].type, String)
+        else:
+            categorical = variable_type in CATEGORICAL_TYPES
+        kinds[name] = 'categorical' if categorical else 'continuous'
+    return kinds
+
+
+def category_keys(values):
+    """
+    Canonical text of categorical values, NaN where missing.
+
+    Numbers are keyed by value, so 1, 1.0 and Decimal('1') all become '1': a
+    column read with NULLs comes back float64 while a NULL-free slice of it is
+    int64, and fitted levels must match either.
+    """
+    numeric = pd.to_numeric(values, errors='coerce')
+    number = numeric.notna() & np.isfinite(numeric.astype(float))
+    integral = number & (numeric == numeric.round())
+    keys = values.astype(str).astype(object)
+    keys[number] = numeric[number].astype(float).astype(str)
+    keys[integral] = numeric[integral].astype(np.int64).astype(str)
+    return keys.where(values.notna())
+
+
+def load_dog_features(dog_ids=None, columns=None):
+    """DataFrame of feature columns indexed by dog_id, in one query."""
+    columns = columns or [name for name, _ in feature_columns()]
+    table = Dog.__table__
+    stmt = select(table.c.dog_id, *[table.c[name] for name in columns])
+    if dog_ids is not None:
+        stmt = stmt.where(table.c.dog_id.in_(list(dog_ids)))
+    frame = pd.DataFrame(db.session.execute(stmt).all(), columns=['dog_id', *columns])
+    return frame.set_index('dog_id')
+
+
+class CohortIndex:
+    """
+    Normalized feature matrix over dogs with k-NN queries.
+
+    Attributes:
+        dog_ids (np.ndarray): Dog of each matrix row.
+        matrix (np.ndarray): float32 rows, L2-normalized (all-zero for removed dogs).
+        columns (list): (column, group, kind) encoded, in order.
+        changed (int): Rows re-encoded or added since the fit.
+    """
+
+    def __init__(self, frame, kinds, groups, max_levels=MAX_LEVELS):
+        self.columns = [(name, groups[name], kinds[name]) for name in frame.columns]
+        self._stats = {}
+        widths = dict.fromkeys(FEATURE_GROUPS, 0)
+        for name, group, kind in self.columns:
+            values = frame[name]
+            if kind == 'categorical':
+                counts = category_keys(values).dropna().value_counts()
+                levels = counts.index[:max_levels].tolist()
+                self._stats[name] = levels
+                widths[group] += len(levels)
+            else:
+                numeric = pd.to_numeric(values, errors='coerce').astype(float)
+                mean, std = numeric.mean(), numeric.std()
+                self._stats[name] = (0.0 if pd.isna(mean) else mean, std if std and not pd.isna(std) else 1.0)
+                widths[group] += 1
+        self._weights = {group: 1.0 / np.sqrt(width) if width else 0.0 for group, width in widths.items()}
+        self.dog_ids = frame.index.to_numpy(dtype=np.int64)
+        self._rows = {dog_id: i for i, dog_id in enumerate(self.dog_ids.tolist())}
+        self.matrix = self.encode(frame)
+        self._active = np.ones(len(self.dog_ids), dtype=bool)
+        self.changed = 0
+
+    @classmethod
+    def load(cls, max_levels=MAX_LEVELS):
+        columns = feature_columns()
+        frame = load_dog_features(columns=[name for name, _ in columns])
+        return cls(frame, column_kinds(frame.columns), dict(columns), max_levels)
+
+    def encode(self, frame):
+        """Rows of ``frame`` encoded with the fitted statistics."""
+        blocks = []
+        for name, group, kind in self.columns:
+            weight = self._weights[group]
+            values = frame[name]
+            if kind == 'categorical':
+                levels = self._stats[name]
+                if levels:
+                    text = category_keys(values)
+                    blocks.append(np.stack([(text == level).to_numpy() for level in levels], axis=1) * weight)
+            else:
+                mean, std = self._stats[name]
+                z = (pd.to_numeric(values, errors='coerce').astype(float) - mean) / std
+                blocks.append((z.fillna(0.0).clip(-CLIP, CLIP).to_numpy() * weight)[:, None])
+        if not blocks:
+            return np.zeros((len(frame), 0), dtype=np.float32)
+        matrix = np.hstack(blocks).astype(np.float32)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        return matrix / np.where(norms > 0, norms, 1.0)
+
+    def update(self, frame):
+        """Re-encode existing dogs and append new ones from ``frame`` (indexed by dog_id)."""
+        if frame.empty:
+            return
+        encoded = self.encode(frame[[name for name, _, _ in self.columns]])
+        new = []
+        for i, dog_id in enumerate(frame.index.tolist()):
+            row = self._rows.get(dog_id)
+            if row is None:
+                new.append(i)
+            else:
+                self.matrix[row] = encoded[i]
+                self._active[row] = True
+        if new:
+            start = len(self.dog_ids)
+            self.dog_ids = np.concatenate([self.dog_ids, frame.index.to_numpy(dtype=np.int64)[new]])
+            self.matrix = np.vstack([self.matrix, encoded[new]])
+            self._active = np.concatenate([self._active, np.ones(len(new), dtype=bool)])
+            for offset, dog_id in enumerate(self.dog_ids[start:].tolist()):
+                self._rows[dog_id] = start + offset
+        self.changed += len(frame)
+
+    def remove(self, dog_ids):
+        for dog_id in dog_ids:
+            row = self._rows.get(dog_id)
+            if row is not None:
+                self.matrix[row] = 0.0
+                self._active[row] = False
+                self.changed += 1
+
+    @property
+    def stale(self):
+        return self.changed > REFIT_FRACTION * max(len(self.dog_ids), 1)
+
+    def _candidate_rows(self, candidates):
+        if candidates is None:
+            return np.flatnonzero(self._active)
+        rows = [self._rows[d] for d in candidates if d in self._rows]
+        return np.array([r for r in rows if self._active[r]], dtype=np.int64)
+
+    def neighbors_many(self, dog_ids, k=10, candidates=None, chunk_size=1024):
+        """
+        k most similar dogs for each of ``dog_ids``.
+
+        Args:
+            candidates (iterable): Restrict neighbours to these dogs (e.g. one vet's patients).
+            chunk_size (int): Query rows per matrix product.
+
+        Returns:
+            dict: dog_id -> [(dog_id, similarity), ...], most similar first. Dogs not in
+            the index map to [].
+        """
+        result = {dog_id: [] for dog_id in dog_ids}
+        queries = [d for d in result if d in self._rows and self._active[self._rows[d]]]
+        pool = self._candidate_rows(candidates)
+        if not queries or not len(pool):
+            return result
+        pool_matrix = self.matrix[pool].T
+        pool_ids = self.dog_ids[pool]
+        for i in range(0, len(queries), chunk_size):
+            chunk = queries[i:i + chunk_size]
+            scores = self.matrix[[self._rows[d] for d in chunk]] @ pool_matrix
+            scores[np.array(chunk)[:, None] == pool_ids[None, :]] = -np.inf
+            take = min(k, scores.shape[1])
+            top = np.argpartition(-scores, take - 1, axis=1)[:, :take]
+            for dog_id, row_scores, row_top in zip(chunk, scores, top):
+                ordered = row_top[np.argsort(-row_scores[row_top], kind='stable')]
+                result[dog_id] = [
+                    (int(pool_ids[j]), round(float(row_scores[j]), 4)) for j in ordered if np.isfinite(row_scores[j])
+                ]
+        return result
+
+    def neighbors(self, dog_id, k=10, candidates=None):
+        return self.neighbors_many([dog_id], k, candidates)[dog_id]
+
+
+class CohortIndexCache:
+    """
+    Process-wide ``CohortIndex`` kept current from ORM writes to ``Dog``.
+
+    Attributes:
+        max_levels (int): Passed to ``CohortIndex``.
+    """
+
+    def __init__(self, max_levels=MAX_LEVELS):
+        self.max_levels = max_levels
+        self._lock = threading.Lock()
+        self._index = None
+        self._dirty = set()
+        self._removed = set()
+        self._feature_names = None
+
+    def get(self):
+        with self._lock:
+            index = self._index
+            if index is None or index.stale:
+                index = self._index = CohortIndex.load(self.max_levels)
+                self._dirty.clear()
+                self._removed.clear()
+                return index
+            dirty, removed = self._dirty - self._removed, set(self._removed)
+            self._dirty.clear()
+            self._removed.clear()
+            if removed:
+                index.remove(removed)
+            if dirty:
+                frame = load_dog_features(dirty, [name for name, _, _ in index.columns])
+                index.update(frame)
+                index.remove(dirty - set(frame.index))
+            return index
+
+    def mark(self, dog_ids, removed=False):
+        with self._lock:
+            (self._removed if removed else self._dirty).update(dog_ids)
+
+    def invalidate(self, *args):
+        with self._lock:
+            self._index = None
+
+    def _features(self):
+        if self._feature_names is None:
+            self._feature_names = {name for name, _ in feature_columns()}
+        return self._feature_names
+
+    @staticmethod
+    def _pending(target):
+        # Marks wait on the session until commit: a refresh in between would
+        # encode rows that may still roll back.
+        session = object_session(target)
+        if session is None:
+            return None
+        return session.info.setdefault(_INFO_PENDING, {'dirty': set(), 'removed': set(), 'codebook': False})
+
+    def _on_dog_write(self, mapper, connection, target):
+        state = inspect(target)
+        if state.persistent and not state.deleted and not any(
+            state.attrs[name].history.has_changes() for name in self._features() if name in state.attrs
+        ):
+            return
+        pending = self._pending(target)
+        if pending is not None:
+            pending['dirty'].add(target.dog_id)
+
+    def _on_dog_delete(self, mapper, connection, target):
+        pending = self._pending(target)
+        if pending is not None:
+            pending['removed'].add(target.dog_id)
+
+    def _on_codebook_write(self, mapper, connection, target):
+        pending = self._pending(target)
+        if pending is not None:
+            pending['codebook'] = True
+
+
+cohort_index_cache = CohortIndexCache()
+
+
+def cohort_index():
+    """Current process-wide ``CohortIndex``."""
+    return cohort_index_cache.get()
+
+
+def apply_cohort_events(events):
+    """``ChangeFeedConsumer`` handler for the ``dog`` table: mark changed dogs for re-encoding."""
+    changed, removed = set(), set()
+    for change in events:
+        if change.table_name != Dog.__tablename__:
+            continue
+        dog_id = int(change.record_pk)
+        if change.op == 'delete':
+            removed.add(dog_id)
+        elif change.changed_columns is None or set(change.changed_columns) & cohort_index_cache._features():
+            changed.add(dog_id)
+    cohort_index_cache.mark(changed)
+    cohort_index_cache.mark(removed, removed=True)
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_pending(session):
+    pending = session.info.pop(_INFO_PENDING, None)
+    if not pending:
+        return
+    if pending['codebook']:
+        cohort_index_cache.invalidate()
+        return
+    cohort_index_cache.mark(pending['dirty'])
+    cohort_index_cache.mark(pending['removed'], removed=True)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _drop_pending(session, previous_transaction):
+    session.info.pop(_INFO_PENDING, None)
+
+
+event.listen(Dog, 'after_insert', cohort_index_cache._on_dog_write)
+event.listen(Dog, 'after_update', cohort_index_cache._on_dog_write)
+event.listen(Dog, 'after_delete', cohort_index_cache._on_dog_delete)
+for _event in ('after_insert', 'after_update', 'after_delete'):
+    event.listen(Codebook, _event, cohort_index_cache._on_codebook_write)
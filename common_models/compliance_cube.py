@@ -0,0 +1,326 @@
+"""
+Incrementally maintained compliance and revenue cube.
+
+``ComplianceCube`` holds additive measures per (vet, day, category,
+compliance_state) from three sources:
+
+    intervention_fact   interventions, selected, matched, matched_amount
+    invoice_line_fact   invoice_lines, invoice_amount (PTR-attributed, not voided)
+    appt_invoice_link   links, pr_amount, rr_amount (category / state '')
+
+``refresh_compliance_cube`` finds the (vet, day) partitions whose source rows
+were written since the last watermark and recomputes only those partitions, so
+a refresh costs in proportion to what changed. Each source has an indexed
+``written_ts`` (server default on insert, ``onupdate`` on every SQLAlchemy
+update, stamped explicitly by the invoice upsert), so finding them is an index
+range scan. Partitions are recomputed whole from the sources, which makes a
+refresh idempotent; the watermark is re-read with a ``WATERMARK_LAG`` overlap to
+catch transactions that committed after a later timestamp was already seen.
+
+Still missed, and left to ``rebuild_compliance_cube`` over the affected dates:
+deletes, the old partition of a row moved to another vet or day, and raw SQL
+updates that do not set ``written_ts``.
+
+``compliance_summary`` answers dashboard queries from the cube and aggregates
+the raw facts only for the current, still-changing day.
+
+Days are the UTC calendar day of ``appt_date``, ``line_date`` and the linked
+appointment's ``startTime``.
+
+Usage:
+
+    from common_models.compliance_cube import compliance_summary, refresh_compliance_cube
+
+    refresh_compliance_cube()                     # e.g. every few minutes
+    compliance_summary([vet_id], date(2026, 1, 1), date.today(), group_by=('category',))
+"""
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+
+from sqlalchemy import Date, case, delete, func, insert, literal, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from common_models.db import db
+from common_models.models import (
+    AggregateWatermark, ApptInvoiceLink, Appointments, ComplianceCube, InterventionFact, InvoiceLineFact,
+)
+
+CUBE_NAME = 'compliance_cube'
+
+ALL = ''
+
+DIMENSIONS = ('vet_id', 'day', 'category', 'compliance_state')
+
+COUNT_MEASURES = ('interventions', 'selected', 'matched', 'invoice_lines', 'links')
+AMOUNT_MEASURES = ('matched_amount', 'invoice_amount', 'pr_amount', 'rr_amount')
+MEASURES = COUNT_MEASURES + AMOUNT_MEASURES
+
+WATERMARK_LAG = timedelta(minutes=5)
+
+
+def _sources():
+    """Per source: vet, time and write-timestamp columns, dimensions, measures and filters."""
+    return [
+        {
+            'vet': InterventionFact.vet_id,
+            'time': InterventionFact.appt_date,
+            'written': InterventionFact.written_ts,
+            'category': func.coalesce(InterventionFact.category, ALL),
+            'state': InterventionFact.compliance_state,
+            'measures': {
+                'interventions': func.count(),
+                'selected': func.sum(case((InterventionFact.selected.is_(True), 1), else_=0)),
+                'matched': func.count(InterventionFact.matched_line_id),
+                'matched_amount': func.sum(InterventionFact.matched_amount),
+            },
+            'where': [InterventionFact.vet_id.isnot(None)],
+            'join': None,
+        },
+        {
+            'vet': InvoiceLineFact.vet_id,
+            'time': InvoiceLineFact.line_date,
+            'written': InvoiceLineFact.written_ts,
+            'category': func.coalesce(InvoiceLineFact.reco_category, InvoiceLineFact.category_name, ALL),
+            'state': case(
+                (InvoiceLineFact.is_declined.is_(True), 'declined'),
+                (InvoiceLineFact.is_discussed.is_(True), 'discussed'),
+                else_='selected',
+            ),
+            'measures': {
+                'invoice_lines': func.count(),
+                'invoice_amount': func.sum(InvoiceLineFact.line_amount),
+            },
+            'where': [InvoiceLineFact.attributed_to_ptr.is_(True), InvoiceLineFact.is_voided.isnot(True)],
+            'join': None,
+        },
+        {
+            'vet': ApptInvoiceLink.vet_id,
+            'time': Appointments.startTime,
+            'written': ApptInvoiceLink.written_ts,
+            'category': literal(ALL),
+            'state': literal(ALL),
+            'measures': {
+                'links': func.count(),
+                'pr_amount': func.sum(ApptInvoiceLink.pr_amount),
+                'rr_amount': func.sum(ApptInvoiceLink.rr_amount),
+            },
+            'where': [],
+            'join': (ApptInvoiceLink, Appointments, Appointments.appointment_id == ApptInvoiceLink.appointment_id),
+        },
+    ]
+
+
+def _select(source, *columns):
+    stmt = select(*columns)
+    if source['join'] is not None:
+        left, right, onclause = source['join']
+        stmt = stmt.select_from(left).join(right, onclause)
+    return stmt.where(*source['where'])
+
+
+def _day(column):
+    if db.session.get_bind().dialect.name == 'postgresql':
+        column = func.timezone('UTC', column)
+    return func.date(column, type_=Date)
+
+
+def _bounds(start_day, end_day):
+    """UTC datetimes of [start_day, end_day] (inclusive days)."""
+    start = datetime(start_day.year, start_day.month, start_day.day, tzinfo=timezone.utc)
+    end = datetime(end_day.year, end_day.month, end_day.day, tzinfo=timezone.utc) + timedelta(days=1)
+    return start, end
+
+
+def _empty():
+    return dict.fromkeys(COUNT_MEASURES, 0) | dict.fromkeys(AMOUNT_MEASURES, Decimal('0'))
+
+
+def aggregate_facts(vet_ids, start_day, end_day):
+    """
+    Cube cells computed from the raw sources for [start_day, end_day].
+
+    Returns:
+        dict: (vet_id, day, category, compliance_state) -> measures dict.
+    """
+    start, end = _bounds(start_day, end_day)
+    cells = defaultdict(_empty)
+    for source in _sources():
+        day = _day(source['time'])
+        names = list(source['measures'])
+        stmt = _select(
+            source, source['vet'], day, source['category'], source['state'],
+            *[source['measures'][n] for n in names],
+        ).where(
+            source['vet'].in_(list(vet_ids)), source['time'] >= start, source['time'] < end,
+        ).group_by(source['vet'], day, source['category'], source['state'])
+        for vet_id, row_day, category, state, *values in db.session.execute(stmt):
+            cell = cells[(vet_id, row_day, category or ALL, state or ALL)]
+            for name, value in zip(names, values):
+                cell[name] += value or 0
+    return dict(cells)
+
+
+def touched_partitions(since=None):
+    """
+    (vet_id, day) partitions with source rows written after ``since``.
+
+    Returns:
+        tuple: (set of (vet_id, day), latest write timestamp seen or None).
+    """
+    partitions = set()
+    latest = None
+    for source in _sources():
+        day = _day(source['time'])
+        stmt = _select(source, source['vet'], day, func.max(source['written']))
+        if since is not None:
+            stmt = stmt.where(source['written'] > since)
+        for vet_id, row_day, written in db.session.execute(stmt.group_by(source['vet'], day)):
+            if row_day is None:
+                continue
+            partitions.add((vet_id, row_day))
+            if written is not None and (latest is None or written > latest):
+                latest = written
+    return partitions, latest
+
+
+def refresh_partitions(partitions):
+    """Recompute the cube rows of the given (vet_id, day) partitions. Returns the rows written."""
+    days_by_vet = defaultdict(set)
+    for vet_id, day in partitions:
+        days_by_vet[vet_id].add(day)
+    written = 0
+    for vet_id, days in days_by_vet.items():
+        cells = aggregate_facts([vet_id], min(days), max(days))
+        rows = [
+            {'vet_id': v, 'day': d, 'category': c, 'compliance_state': s, **measures}
+            for (v, d, c, s), measures in cells.items() if d in days
+        ]
+        db.session.execute(
+            delete(ComplianceCube).where(ComplianceCube.vet_id == vet_id, ComplianceCube.day.in_(sorted(days)))
+        )
+        if rows:
+            db.session.execute(insert(ComplianceCube), rows)
+        written += len(rows)
+    return written
+
+
+def _lock_watermark(session):
+    if session.get_bind().dialect.name == 'postgresql':
+        session.execute(
+            pg_insert(AggregateWatermark.__table__).values(name=CUBE_NAME)
+            .on_conflict_do_nothing(index_elements=['name'])
+        )
+    elif session.get(AggregateWatermark, CUBE_NAME) is None:
+        session.add(AggregateWatermark(name=CUBE_NAME))
+        session.flush()
+    return (session.query(AggregateWatermark)
+            .filter(AggregateWatermark.name == CUBE_NAME)
+            .with_for_update()
+            .populate_existing()
+            .one())
+
+
+def refresh_compliance_cube(lag=WATERMARK_LAG, commit=True):
+    """
+    Fold source rows written since the watermark into the cube.
+
+    The first run (no watermark) builds the whole cube. The watermark row is
+    locked for the duration, so concurrent refreshes take turns.
+
+    Returns:
+        dict: ``partitions``, ``rows``, ``watermark`` and ``ms``.
+    """
+    session = db.session
+    start = time.perf_counter()
+    try:
+        mark = _lock_watermark(session)
+        since = mark.watermark - lag if mark.watermark is not None else None
+        partitions, latest = touched_partitions(since)
+        rows = refresh_partitions(partitions)
+        if latest is not None and (mark.watermark is None or latest > mark.watermark):
+            mark.watermark = latest
+        if commit:
+            session.commit()
+        else:
+            session.flush()
+    except Exception:
+        session.rollback()
+        raise
+    return {
+        'partitions': len(partitions), 'rows': rows, 'watermark': mark.watermark,
+        'ms': int((time.perf_counter() - start) * 1000),
+    }
+
+
+def rebuild_compliance_cube(start_day, end_day, vet_ids=None, commit=True):
+    """
+    Recompute every partition in [start_day, end_day], e.g. after deletes or backfills.
+
+    Returns:
+        dict: ``partitions``, ``rows`` and ``ms``.
+    """
+    start = time.perf_counter()
+    if vet_ids is None:
+        first, last = _bounds(start_day, end_day)
+        vet_ids = set(db.session.execute(
+            select(ComplianceCube.vet_id).where(ComplianceCube.day >= start_day, ComplianceCube.day <= end_day)
+        ).scalars())
+        for source in _sources():
+            vet_ids.update(db.session.execute(
+                _select(source, source['vet']).where(source['time'] >= first, source['time'] < last).distinct()
+            ).scalars())
+        vet_ids.discard(None)
+    days = [start_day + timedelta(days=i) for i in range((end_day - start_day).days + 1)]
+    partitions = {(vet_id, day) for vet_id in vet_ids for day in days}
+    rows = refresh_partitions(partitions)
+    if commit:
+        db.session.commit()
+    return {'partitions': len(partitions), 'rows': rows, 'ms': int((time.perf_counter() - start) * 1000)}
+
+
+def compliance_summary(vet_ids, start_day, end_day, group_by=('category', 'compliance_state'), today=None):
+    """
+    Measures for [start_day, end_day] rolled up to ``group_by``.
+
+    Completed days are read from the cube; days from ``today`` (UTC) on are
+    aggregated from the raw facts, since the cube lags them until the next refresh.
+
+    Args:
+        vet_ids (iterable): Vets to include.
+        group_by (tuple): Subset of ``DIMENSIONS``; () for grand totals.
+        today (date): Override of the current UTC day.
+
+    Returns:
+        list: Dicts of the ``group_by`` dimensions and every measure, ordered by the dimensions.
+    """
+    group_by = tuple(group_by)
+    unknown = set(group_by) - set(DIMENSIONS)
+    if unknown:
+        raise ValueError(f"Unknown cube dimensions: {sorted(unknown)}")
+    vet_ids = list(vet_ids)
+    today = today or datetime.now(timezone.utc).date()
+    totals = defaultdict(_empty)
+
+    if start_day < today:
+        dims = [getattr(ComplianceCube, d) for d in group_by]
+        stmt = select(*dims, *[func.sum(getattr(ComplianceCube, m)) for m in MEASURES]).where(
+            ComplianceCube.vet_id.in_(vet_ids),
+            ComplianceCube.day >= start_day,
+            ComplianceCube.day <= min(end_day, today - timedelta(days=1)),
+        )
+        if dims:
+            stmt = stmt.group_by(*dims)
+        for row in db.session.execute(stmt):
+            cell = totals[tuple(row[:len(group_by)])]
+            for name, value in zip(MEASURES, row[len(group_by):]):
+                cell[name] += value or 0
+
+    if end_day >= today:
+        for key, measures in aggregate_facts(vet_ids, max(start_day, today), end_day).items():
+            cell = totals[tuple(key[DIMENSIONS.index(d)] for d in group_by)]
+            for name, value in measures.items():
+                cell[name] += value
+
+    return [dict(zip(group_by, key)) | measures for key, measures in sorted(totals.items(), key=lambda kv: kv[0])]
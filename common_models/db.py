@@ -1,3 +1,244 @@
+"""
+Shared ``db`` object, with read-replica routing and connection pool presets.
+
+Binds whose key starts with ``replica`` in ``SQLALCHEMY_BINDS`` are read
+replicas of the default bind. A ``SELECT`` goes to a replica (round robin) when
+the session is inside ``read_replica()`` or the statement carries
+``execution_options(replica=True)``. Everything else goes to the primary. So do
+``SELECT ... FOR UPDATE`` and every statement of a session that has already
+flushed or run DML: the session stays pinned to the primary until it is closed,
+so it always reads its own writes. Without replica binds everything goes to
+the primary, as before.
+
+``configure_pool`` applies a pool sizing preset (``POOL_PRESETS``) to the
+default bind and every replica bind, using ``TimedQueuePool`` so the time spent
+waiting for a pooled connection is recorded in ``pool_metrics``. Presets need a
+pooled database (Postgres, or SQLite on a file); in-memory SQLite keeps its
+``StaticPool``.
+
+Usage:
+
+    from common_models.db import configure_pool, db, pool_metrics, read_replica
+
+    app.config['SQLALCHEMY_BINDS'] = {'replica_1': REPLICA_URL}
+    configure_pool(app, 'web')                   # before db.init_app(app)
+    db.init_app(app)
+
+    with read_replica():
+        rows = timeline_page(dog_id)
+
+    pool_metrics.stats()      # {'primary': {'checkouts': ..., 'p95_wait_ms': ..., ...}, ...}
+"""
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.dml import UpdateBase
+
+logger = logging.getLogger(__name__)
+
+REPLICA_BIND_PREFIX = 'replica'
+
+PRIMARY_POOL_NAME = 'primary'
+
+POOL_PRESETS = {
+    # Request handlers: many short checkouts; fail fast rather than queue a request for long.
+    'web': {'pool_size': 5, 'max_overflow': 10, 'pool_timeout': 10, 'pool_recycle': 1800, 'pool_pre_ping': True},
+    # Background workers and batch runs: few, long-held connections; wait rather than fail.
+    'worker': {'pool_size': 2, 'max_overflow': 2, 'pool_timeout': 120, 'pool_recycle': 3600, 'pool_pre_ping': True},
+}
+
+# Checkouts waiting longer than this are logged.
+SLOW_CHECKOUT_SECONDS = 0.25
+
+_INFO_PINNED = 'db_pinned_to_primary'
+_INFO_READ_ONLY = 'db_read_only'
+
+
+class PoolMetrics:
+    """
+    Connection checkout wait times per pool.
+
+    Attributes:
+        window (int): Recent waits kept per pool for percentiles.
+    """
+
+    def __init__(self, window=2000):
+        self.window = window
+        self._lock = threading.Lock()
+        self._pools = {}
+
+    def record(self, pool, seconds):
+        name = getattr(pool, 'logging_name', None) or PRIMARY_POOL_NAME
+        with self._lock:
+            entry = self._pools.get(name)
+            if entry is None:
+                entry = self._pools[name] = {
+                    'pool': pool, 'checkouts': 0, 'total': 0.0, 'max': 0.0, 'slow': 0,
+                    'recent': deque(maxlen=self.window),
+                }
+            entry['pool'] = pool
+            entry['checkouts'] += 1
+            entry['total'] += seconds
+            entry['max'] = max(entry['max'], seconds)
+            entry['recent'].append(seconds)
+            if seconds > SLOW_CHECKOUT_SECONDS:
+                entry['slow'] += 1
+        if seconds > SLOW_CHECKOUT_SECONDS:
+            logger.warning("waited %.0f ms for a %s connection (%s)", seconds * 1000, name, pool.status())
+
+    def stats(self):
+        """
+        Per pool: checkouts, mean / p95 / max wait in ms, slow checkouts and current pool usage.
+
+        Returns:
+            dict: pool name -> stats dict.
+        """
+        with self._lock:
+            entries = {name: dict(entry, recent=sorted(entry['recent'])) for name, entry in self._pools.items()}
+        stats = {}
+        for name, entry in entries.items():
+            recent, pool = entry['recent'], entry['pool']
+            stats[name] = {
+                'checkouts': entry['checkouts'],
+                'mean_wait_ms': round(entry['total'] / entry['checkouts'] * 1000, 3),
+                'p95_wait_ms': round(recent[int(0.95 * (len(recent) - 1))] * 1000, 3) if recent else 0.0,
+                'max_wait_ms': round(entry['max'] * 1000, 3),
+                'slow_checkouts': entry['slow'],
+                'size': pool.size(), 'checked_out': pool.checkedout(), 'overflow': pool.overflow(),
+            }
+        return stats
+
+    def reset(self):
+        with self._lock:
+            self._pools.clear()
+
+
+pool_metrics = PoolMetrics()
+
+
+class TimedCheckoutMixin:
+    """Pool mixin reporting how long each checkout waited (including connecting) to ``pool_metrics``."""
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            pool_metrics.record(self, time.perf_counter() - start)
+
+
+class TimedQueuePool(TimedCheckoutMixin, QueuePool):
+    pass
+
+
+class RoutingSession(Session):
+    """Flask-SQLAlchemy session that sends eligible reads to a replica bind."""
+
+    def _use_replica(self, clause):
+        if clause is None or not getattr(clause, 'is_select', False):
+            return False
+        if self.info.get(_INFO_PINNED) or self._flushing or getattr(clause, '_for_update_arg', None) is not None:
+            return False
+        return bool(self.info.get(_INFO_READ_ONLY) or clause.get_execution_options().get('replica'))
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None:
+            if isinstance(clause, UpdateBase):
+                self.info[_INFO_PINNED] = True
+            elif self._use_replica(clause):
+                replica = self._db.replica_engine()
+                if replica is not None:
+                    return replica
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+    def close(self):
+        self.info.pop(_INFO_PINNED, None)
+        super().close()
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _pin_to_primary(session, flush_context):
+    session.info[_INFO_PINNED] = True
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """``SQLAlchemy`` extension aware of replica binds."""
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('session_options', {}).setdefault('class_', RoutingSession)
+        super().__init__(*args, **kwargs)
+        self._replica_turn = itertools.count()
+
+    def replica_engines(self):
+        """Replica engines of the current app, ordered by bind key."""
+        engines = self.engines
+        return [engines[key] for key in sorted(k for k in engines if k and k.startswith(REPLICA_BIND_PREFIX))]
+
+    def replica_engine(self):
+        """Next replica engine (round robin), or None when the app has no replicas."""
+        replicas = self.replica_engines()
+        if not replicas:
+            return None
+        return replicas[next(self._replica_turn) % len(replicas)]
+
+
+db = RoutingSQLAlchemy()
+
+
+@contextmanager
+def read_replica(session=None):
+    """Send the reads of ``session`` (default ``db.session``) to a replica for the block."""
+    session = session if session is not None else db.session
+    previous = session.info.get(_INFO_READ_ONLY)
+    session.info[_INFO_READ_ONLY] = True
+    try:
+        yield session
+    finally:
+        if previous:
+            session.info[_INFO_READ_ONLY] = previous
+        else:
+            session.info.pop(_INFO_READ_ONLY, None)
+
+
+def pinned_to_primary(session=None):
+    """True once ``session`` (default ``db.session``) has written and reads from the primary only."""
+    return bool((session if session is not None else db.session).info.get(_INFO_PINNED))
+
+
+def configure_pool(app, preset='web', **overrides):
+    """
+    Apply a pool preset to the app's default bind and every ``SQLALCHEMY_BINDS`` entry.
+
+    Must run before ``db.init_app(app)``.
+
+    Args:
+        preset (str): Key of ``POOL_PRESETS``.
+        **overrides: Engine options replacing the preset's (e.g. ``pool_size=20``).
 
-db = SQLAlchemy()
+    Returns:
+        dict: The engine options applied to the default bind.
+    """
+    options = dict(POOL_PRESETS[preset], **overrides)
+    options.setdefault('poolclass', TimedQueuePool)
+    engine_options = dict(app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+    engine_options.update(options)
+    engine_options.setdefault('pool_logging_name', PRIMARY_POOL_NAME)
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options
+    # Flask-SQLAlchemy does not apply SQLALCHEMY_ENGINE_OPTIONS to binds.
+    binds = {}
+    for key, value in (app.config.get('SQLALCHEMY_BINDS') or {}).items():
+        bind = {'url': value} if not isinstance(value, dict) else dict(value)
+        for name, option in options.items():
+            bind.setdefault(name, option)
+        bind.setdefault('pool_logging_name', key)
+        binds[key] = bind
+    app.config['SQLALCHEMY_BINDS'] = binds
+    return engine_options
@@ -0,0 +1,249 @@
+"""
+Appointment-day bundles for clinic ``Display`` screens.
+
+``load_display_bundle`` assembles everything a screen shows for one day in a
+fixed number of queries regardless of how many appointments there are: the
+display and its vet, the vet's appointments for the local day, a slim profile
+of each dog, each dog's latest ``PatientInterventions`` for the vet, its recent
+``PatientAlerts`` and its latest ``Simulation`` on the display.
+
+``display_version`` computes an ETag for the same day with a single query, from
+row counts and max ids of the bundle's sources (inserts and deletes) and the
+latest ``change_events`` id for the day's dogs (in-place edits). None of the
+source tables has an update timestamp, so in-place edits are only visible
+through change capture: ``display_version`` raises ``ChangeCaptureRequired``
+unless ``enable_change_capture`` has run and captures every
+``VERSIONED_TABLES`` table. Writes that bypass the session (``Query.update()``,
+raw SQL) must emit their own events. ``DisplayBundleCache`` serves an unchanged
+screen from memory, or tells the caller to answer 304, after only that version
+check.
+
+Usage:
+
+    from common_models.displays import display_bundle_cache
+
+    etag, bundle = display_bundle_cache.get(display_id, day, if_none_match=request_etag)
+    if bundle is None:
+        return '', 304
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+from datetime import datetime, time, timedelta, timezone
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+from sqlalchemy import and_, func, select
+
+from common_models.changes import change_capture
+from common_models.db import db
+from common_models.models import (
+    Appointments, ChangeEvent, Display, Dog, PatientAlerts, PatientInterventions, Simulation, Vet,
+)
+
+DISPLAY_DOG_COLUMNS = (
+    'dog_id', 'dd_dog_name', 'breed', 'dd_sex', 'dd_age_years', 'dd_weight_lbs', 'dd_lifestage',
+    'screen_status', 'imminent_conditions', 'next_due', 'status',
+)
+
+ALERTS_PER_DOG = 20
+
+VERSIONED_TABLES = ('appointments', 'dog', 'patient_alerts', 'patient_interventions', 'simulations')
+
+
+class DisplayNotFound(LookupError):
+    """Raised when no ``Display`` has the requested display_id."""
+
+
+class ChangeCaptureRequired(RuntimeError):
+    """Raised when display ETags are requested without change capture of every ``VERSIONED_TABLES`` table."""
+
+
+def _require_change_capture():
+    capture = change_capture()
+    if capture is None:
+        raise ChangeCaptureRequired("display ETags miss in-place edits without change capture; "
+                                    "call enable_change_capture() at start-up")
+    captured = {model.__table__.name for model in capture.models}
+    missing = [table for table in VERSIONED_TABLES if table not in captured]
+    if missing:
+        raise ChangeCaptureRequired(f"change capture does not cover {', '.join(missing)}; display ETags would miss their edits")
+
+
+def _display(display_id):
+    row = db.session.execute(
+        select(Display.display_id, Display.name, Display.location, Display.vet_id, Vet.timezone)
+        .join(Vet, Vet.vet_id == Display.vet_id)
+        .where(Display.display_id == display_id)
+    ).mappings().first()
+    if row is None:
+        raise DisplayNotFound(display_id)
+    return dict(row)
+
+
+def _zone(tz_name):
+    try:
+        return ZoneInfo(tz_name) if tz_name else timezone.utc
+    except (ZoneInfoNotFoundError, ValueError):
+        return timezone.utc
+
+
+def day_window(day, tz_name=None):
+    """UTC [start, end) of the local calendar ``day`` in the vet's timezone (UTC if unknown)."""
+    start = datetime.combine(day, time.min, tzinfo=_zone(tz_name))
+    return start.astimezone(timezone.utc), (start + timedelta(days=1)).astimezone(timezone.utc)
+
+
+def _day_appointments(vet_id, start, end):
+    return and_(Appointments.vet_id == vet_id, Appointments.startTime >= start, Appointments.startTime < end)
+
+
+def _latest_per_dog(model, order_columns, where, limit=1):
+    """Rows of ``model`` matching ``where``, at most ``limit`` per dog, newest first, in one query."""
+    rank = func.row_number().over(partition_by=model.dog_id, order_by=[c.desc() for c in order_columns])
+    inner = select(model, rank.label('rank')).where(where).subquery()
+    columns = [c for c in inner.c if c.name != 'rank']
+    return db.session.execute(
+        select(*columns).where(inner.c.rank <= limit).order_by(inner.c.dog_id, inner.c.rank)
+    ).mappings().all()
+
+
+def display_version(display_id, day, display=None):
+    """
+    ETag for a display's day, computed with one query (plus one to resolve the display).
+
+    Returns:
+        str: Hex digest; changes when any bundle source for the day changes.
+
+    Raises:
+        ChangeCaptureRequired: Change capture is off or misses a ``VERSIONED_TABLES`` table.
+    """
+    _require_change_capture()
+    display = display or _display(display_id)
+    start, end = day_window(day, display['timezone'])
+    in_day = _day_appointments(display['vet_id'], start, end)
+    dogs = select(Appointments.dog_id).where(in_day)
+    interventions = and_(PatientInterventions.vet_id == display['vet_id'], PatientInterventions.dog_id.in_(dogs))
+    alerts = PatientAlerts.dog_id.in_(dogs)
+    columns = [
+        select(func.count()).select_from(Appointments).where(in_day),
+        select(func.max(Appointments.appointment_id)).where(in_day),
+        select(func.count()).select_from(PatientInterventions).where(interventions),
+        select(func.max(PatientInterventions.id)).where(interventions),
+        select(func.count()).select_from(PatientAlerts).where(alerts),
+        select(func.max(PatientAlerts.alert_id)).where(alerts),
+        select(func.max(Simulation.id)).where(Simulation.display_id == display_id, Simulation.dog_id.in_(dogs)),
+        select(func.max(ChangeEvent.id)).where(
+            ChangeEvent.dog_id.in_(dogs), ChangeEvent.table_name.in_(VERSIONED_TABLES)
+        ),
+    ]
+    row = db.session.execute(select(*[c.scalar_subquery() for c in columns])).one()
+    payload = repr((display_id, day.isoformat(), display['vet_id'], tuple(row)))
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:32]
+
+
+def load_display_bundle(display_id, day=None, display=None):
+    """
+    Everything a display shows for ``day`` (default: today in the vet's timezone), in six queries.
+
+    Returns:
+        dict: ``display``, ``date``, ``appointments`` (list, by start time), ``dogs``,
+        ``interventions`` and ``simulations`` (dog_id -> row) and ``alerts``
+        (dog_id -> newest-first rows).
+    """
+    display = display or _display(display_id)
+    if day is None:
+        day = datetime.now(_zone(display['timezone'])).date()
+    start, end = day_window(day, display['timezone'])
+    in_day = _day_appointments(display['vet_id'], start, end)
+
+    appointments = [dict(r) for r in db.session.execute(
+        select(Appointments.__table__).where(in_day).order_by(Appointments.startTime, Appointments.appointment_id)
+    ).mappings()]
+    dog_ids = sorted({a['dog_id'] for a in appointments})
+
+    bundle = {
+        'display': display, 'date': day, 'appointments': appointments,
+        'dogs': {}, 'interventions': {}, 'alerts': {}, 'simulations': {},
+    }
+    if not dog_ids:
+        return bundle
+
+    dog_table = Dog.__table__
+    for row in db.session.execute(
+        select(*[dog_table.c[c] for c in DISPLAY_DOG_COLUMNS]).where(dog_table.c.dog_id.in_(dog_ids))
+    ).mappings():
+        bundle['dogs'][row['dog_id']] = dict(row)
+
+    for row in _latest_per_dog(
+        PatientInterventions, (PatientInterventions.date, PatientInterventions.id),
+        and_(PatientInterventions.vet_id == display['vet_id'], PatientInterventions.dog_id.in_(dog_ids)),
+    ):
+        bundle['interventions'][row['dog_id']] = dict(row)
+
+    for row in _latest_per_dog(
+        PatientAlerts, (PatientAlerts.alert_date, PatientAlerts.alert_id),
+        PatientAlerts.dog_id.in_(dog_ids), limit=ALERTS_PER_DOG,
+    ):
+        bundle['alerts'].setdefault(row['dog_id'], []).append(dict(row))
+
+    for row in _latest_per_dog(
+        Simulation, (Simulation.created_at, Simulation.id),
+        and_(Simulation.display_id == display_id, Simulation.dog_id.in_(dog_ids)),
+    ):
+        bundle['simulations'][row['dog_id']] = dict(row)
+    return bundle
+
+
+class DisplayBundleCache:
+    """
+    Bundles keyed by (display_id, day), revalidated with ``display_version``.
+
+    Attributes:
+        max_entries (int): Bundles kept in memory, least recently used evicted first.
+    """
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, display_id, day, if_none_match=None):
+        """
+        Current bundle for a display's day.
+
+        Args:
+            if_none_match (str): ETag the client already has.
+
+        Returns:
+            tuple: (etag, bundle). ``bundle`` is None when ``if_none_match`` is
+            still current, so the caller can answer 304.
+        """
+        display = _display(display_id)
+        etag = display_version(display_id, day, display)
+        if if_none_match is not None and if_none_match == etag:
+            return etag, None
+        key = (display_id, day)
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached is not None and cached[0] == etag:
+                self._entries.move_to_end(key)
+                return cached
+        bundle = load_display_bundle(display_id, day, display)
+        bundle['etag'] = etag
+        with self._lock:
+            self._entries[key] = (etag, bundle)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return etag, bundle
+
+    def invalidate(self, display_id=None):
+        with self._lock:
+            if display_id is None:
+                self._entries.clear()
+            else:
+                for key in [k for k in self._entries if k[0] == display_id]:
+                    del self._entries[key]
+
+
+display_bundle_cache = DisplayBundleCache()
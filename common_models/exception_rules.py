@@ -0,0 +1,319 @@
+"""
+Indexed, pre-parsed ``Exception`` rules for the condition association tables.
+
+Every ``Exception`` row hangs off exactly one association row
+(``condition_signalment``, ``condition_symptom``, ``condition_sign``,
+``condition_lab``, ``condition_imaging`` or ``condition_affiliated``). Instead of
+lazy-loading ``association.exceptions`` during scoring, all exceptions are loaded
+once into an ``ExceptionRuleTable`` keyed by ``(kind, association_id)`` with
+their values parsed into typed predicates, and ``mask`` evaluates them for a
+whole batch of dogs with numpy.
+
+Rule semantics:
+    * ``exception_category`` names the signalment field: age, sex, breed, weight,
+      neuter, lifestage (see ``SIGNALMENT_FIELDS``).
+    * Numeric values accept "7", "<7", ">=10", "5-10" with an optional unit
+      ("8 months", "20 kg"); they are converted to years / lbs like ``Dog``. An
+      unknown unit raises ``ExceptionRuleError`` and the rule is ignored.
+    * Categorical values are one or more labels separated by ``|``, ``,`` or ``;``.
+    * By default a matching rule removes the association for that dog.
+      ``exception_type`` 'only' / 'include' / 'require' inverts this: the
+      association applies only to dogs matching the rule.
+    * A dog missing the field never matches.
+
+Usage:
+
+    from common_models.exception_rules import exception_rules, load_signalment
+
+    dogs = load_signalment(dog_ids)
+    applies = exception_rules().mask(dogs, 'symptom', condition_symptom_ids)
+    # applies[i, j] is False when an exception removes association j for dog i
+"""
+import logging
+import re
+import threading
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+
+from common_models.db import db
+from common_models.models import Dog
+from common_models.models import Exception as ConditionException
+
+logger = logging.getLogger(__name__)
+
+_INFO_PENDING = '_exception_rule_changes'
+
+# Association kind -> Exception foreign key column.
+ASSOCIATION_COLUMNS = {
+    'signalment': 'condition_signalment_id',
+    'symptom': 'condition_symptom_id',
+    'sign': 'condition_sign_id',
+    'lab': 'condition_lab_id',
+    'imaging': 'condition_imaging_id',
+    'affiliated': 'condition_affiliated_id',
+}
+
+# exception_category -> (Dog column, 'numeric' | 'categorical')
+SIGNALMENT_FIELDS = {
+    'age': ('dd_age_years', 'numeric'),
+    'weight': ('dd_weight_lbs', 'numeric'),
+    'sex': ('dd_sex', 'categorical'),
+    'breed': ('breed', 'categorical'),
+    'neuter': ('dd_spayed_or_neutered', 'categorical'),
+    'lifestage': ('dd_lifestage', 'categorical'),
+}
+
+REQUIRING_TYPES = frozenset({'only', 'include', 'require'})
+
+# exception_category -> unit -> factor to the Dog column's unit (years, lbs).
+NUMERIC_UNITS = {
+    'age': {
+        '': 1.0, 'y': 1.0, 'yr': 1.0, 'yrs': 1.0, 'year': 1.0, 'years': 1.0,
+        'mo': 1 / 12, 'mos': 1 / 12, 'month': 1 / 12, 'months': 1 / 12,
+        'wk': 7 / 365.25, 'wks': 7 / 365.25, 'week': 7 / 365.25, 'weeks': 7 / 365.25,
+        'd': 1 / 365.25, 'day': 1 / 365.25, 'days': 1 / 365.25,
+    },
+    'weight': {
+        '': 1.0, 'lb': 1.0, 'lbs': 1.0, 'pound': 1.0, 'pounds': 1.0,
+        'kg': 2.20462, 'kgs': 2.20462, 'g': 0.00220462, 'oz': 1 / 16,
+    },
+}
+
+_NUMBER = r'(-?\d+(?:\.\d+)?)\s*([a-z]*)'
+_RANGE = re.compile(rf'^\s*{_NUMBER}\s*(?:-|to)\s*{_NUMBER}\s*$')
+_BOUND = re.compile(rf'^\s*(<=|>=|<|>|=)?\s*{_NUMBER}\s*$')
+
+
+class ExceptionRuleError(ValueError):
+    """Raised for an exception value that parses but cannot be applied, e.g. an unknown unit."""
+
+
+def _scaled(number, unit, category):
+    units = NUMERIC_UNITS[category]
+    if unit not in units:
+        raise ExceptionRuleError(f"unknown {category} unit {unit!r}; expected one of {sorted(u for u in units if u)}")
+    return float(number) * units[unit]
+
+
+def parse_numeric(value, category='age'):
+    """
+    Parse a numeric exception value into an inclusive ``(low, high)`` interval, or None.
+
+    Raises:
+        ExceptionRuleError: The value has a unit that is not one of ``NUMERIC_UNITS[category]``.
+    """
+    text = (value or '').strip().lower()
+    match = _RANGE.match(text)
+    if match:
+        low_n, low_u, high_n, high_u = match.groups()
+        low_u = low_u or high_u
+        return _scaled(low_n, low_u, category), _scaled(high_n, high_u, category)
+    match = _BOUND.match(text)
+    if not match:
+        return None
+    op, number, unit = match.groups()
+    x = _scaled(number, unit, category)
+    if op == '<':
+        return -np.inf, np.nextafter(x, -np.inf)
+    if op == '<=':
+        return -np.inf, x
+    if op == '>':
+        return np.nextafter(x, np.inf), np.inf
+    if op == '>=':
+        return x, np.inf
+    return x, x
+
+
+def parse_categorical(value):
+    """Parse a categorical exception value into a frozenset of lower-cased labels."""
+    return frozenset(v.strip().lower() for v in re.split(r'[|,;]', value or '') if v.strip())
+
+
+class ExceptionRuleTable:
+    """
+    All exceptions, parsed and indexed by ``(kind, association_id)``.
+
+    Attributes:
+        rules (list): Parsed rules as dicts: kind, association_id, field, op ('range'|'in'),
+            low, high, values, require, exception_id.
+        index (dict): (kind, association_id) -> list of rule positions.
+        unsupported (list): exception_ids whose category or value could not be parsed.
+        invalid (dict): exception_id -> reason, for values rejected by validation (unknown
+            units); these are also in ``unsupported``.
+    """
+
+    def __init__(self, rows):
+        self.rules = []
+        self.index = defaultdict(list)
+        self.unsupported = []
+        self.invalid = {}
+        for row in rows:
+            try:
+                rule = self._parse(row)
+            except ExceptionRuleError as exc:
+                self.invalid[row['exception_id']] = str(exc)
+                rule = None
+            if rule is None:
+                self.unsupported.append(row['exception_id'])
+                continue
+            self.index[(rule['kind'], rule['association_id'])].append(len(self.rules))
+            self.rules.append(rule)
+        if self.unsupported:
+            logger.info("%d exceptions could not be parsed and are ignored", len(self.unsupported))
+        for exception_id, reason in self.invalid.items():
+            logger.warning("exception %s ignored: %s", exception_id, reason)
+
+    @staticmethod
+    def _parse(row):
+        kind = next((k for k, column in ASSOCIATION_COLUMNS.items() if row.get(column) is not None), None)
+        category = (row.get('exception_category') or '').strip().lower()
+        field = SIGNALMENT_FIELDS.get(category)
+        if kind is None or field is None:
+            return None
+        column, field_type = field
+        rule = {
+            'exception_id': row['exception_id'],
+            'kind': kind,
+            'association_id': row[ASSOCIATION_COLUMNS[kind]],
+            'field': column,
+            'require': (row.get('exception_type') or '').strip().lower() in REQUIRING_TYPES,
+            'low': None, 'high': None, 'values': None,
+        }
+        if field_type == 'numeric':
+            interval = parse_numeric(row.get('exception_value'), category)
+            if interval is None:
+                return None
+            rule['op'] = 'range'
+            rule['low'], rule['high'] = interval
+        else:
+            values = parse_categorical(row.get('exception_value'))
+            if not values:
+                return None
+            rule['op'] = 'in'
+            rule['values'] = values
+        return rule
+
+    @classmethod
+    def load(cls):
+        """Build the table from every ``Exception`` row in one query."""
+        columns = ['exception_id', 'exception_category', 'exception_value', 'exception_type',
+                   *ASSOCIATION_COLUMNS.values()]
+        table = ConditionException.__table__
+        rows = db.session.execute(db.select(*[table.c[c] for c in columns])).mappings()
+        return cls(rows)
+
+    def rules_for(self, kind, association_id):
+        return [self.rules[i] for i in self.index.get((kind, association_id), ())]
+
+    def mask(self, dogs, kind, association_ids):
+        """
+        Which associations apply to which dogs.
+
+        Args:
+            dogs (pd.DataFrame): One row per dog with the Dog signalment columns
+                (see ``signalment_frame`` / ``load_signalment``).
+            kind (str): Association kind, a key of ``ASSOCIATION_COLUMNS``.
+            association_ids (sequence): Association ids, defining the output columns.
+
+        Returns:
+            np.ndarray: bool array (len(dogs), len(association_ids)); False where an
+            exception removes the association for that dog.
+        """
+        association_ids = list(association_ids)
+        n = len(dogs)
+        positions, columns = [], []
+        for j, association_id in enumerate(association_ids):
+            for i in self.index.get((kind, association_id), ()):
+                positions.append(i)
+                columns.append(j)
+        applies = np.ones((n, len(association_ids)), dtype=bool)
+        if not positions or not n:
+            return applies
+
+        hits = np.zeros((n, len(positions)), dtype=bool)
+        numeric = defaultdict(list)
+        for k, i in enumerate(positions):
+            rule = self.rules[i]
+            if rule['op'] == 'range':
+                numeric[rule['field']].append(k)
+            else:
+                labels = dogs[rule['field']].astype('string').str.strip().str.lower()
+                hits[:, k] = labels.isin(rule['values']).fillna(False).to_numpy(dtype=bool)
+        for field, ks in numeric.items():
+            values = pd.to_numeric(dogs[field], errors='coerce').to_numpy(dtype=float)[:, None]
+            low = np.array([self.rules[positions[k]]['low'] for k in ks])[None, :]
+            high = np.array([self.rules[positions[k]]['high'] for k in ks])[None, :]
+            # NaN compares False, so dogs missing the field never match.
+            hits[:, ks] = (values >= low) & (values <= high)
+
+        require = np.array([self.rules[i]['require'] for i in positions])
+        removes = np.where(require[None, :], ~hits, hits)
+        owner = np.zeros((len(positions), len(association_ids)), dtype=np.uint8)
+        owner[np.arange(len(positions)), columns] = 1
+        return applies & ~((removes.astype(np.uint8) @ owner) > 0)
+
+
+SIGNALMENT_COLUMNS = ['dog_id'] + sorted({column for column, _ in SIGNALMENT_FIELDS.values()})
+
+
+def signalment_frame(dogs):
+    """DataFrame of signalment columns for an iterable of ``Dog`` objects."""
+    return pd.DataFrame(
+        [[getattr(dog, c) for c in SIGNALMENT_COLUMNS] for dog in dogs],
+        columns=SIGNALMENT_COLUMNS,
+    )
+
+
+def load_signalment(dog_ids):
+    """Signalment columns for ``dog_ids`` in one query, without loading full ``Dog`` rows."""
+    table = Dog.__table__
+    rows = db.session.execute(
+        db.select(*[table.c[c] for c in SIGNALMENT_COLUMNS]).where(table.c.dog_id.in_(list(dog_ids)))
+    ).all()
+    return pd.DataFrame(rows, columns=SIGNALMENT_COLUMNS)
+
+
+_lock = threading.Lock()
+_table = None
+
+
+def exception_rules():
+    """Process-wide ``ExceptionRuleTable``, loaded on first use and dropped when Exception writes commit."""
+    global _table
+    with _lock:
+        if _table is None:
+            _table = ExceptionRuleTable.load()
+        return _table
+
+
+def invalidate_exception_rules(*args):
+    global _table
+    with _lock:
+        _table = None
+
+
+def _mark_changed(mapper, connection, target):
+    # Flushed but not committed: a reload now would re-cache rows that may still
+    # roll back, or miss them in other sessions. Drop the table once committed.
+    session = object_session(target)
+    if session is not None:
+        session.info[_INFO_PENDING] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_pending(session):
+    if session.info.pop(_INFO_PENDING, False):
+        invalidate_exception_rules()
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _drop_pending(session, previous_transaction):
+    session.info.pop(_INFO_PENDING, None)
+
+
+for _event in ('after_insert', 'after_update', 'after_delete'):
+    event.listen(ConditionException, _event, _mark_changed)
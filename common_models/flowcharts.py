@@ -0,0 +1,424 @@
+"""
+Compiled condition decision flowcharts.
+
+Each condition's ``Step`` / ``Entry`` / ``Link`` rows are compiled once into an
+in-memory DAG: steps in topological order, predecessor index lists, and entry
+predicates parsed into a shared predicate table. Evaluating a patient computes
+every distinct predicate once and then sweeps each graph in topological order,
+so all flowcharts are evaluated in a single call without touching the database.
+
+Entry semantics:
+    * ``category`` (falling back to the step's ``attribute_type``) selects the
+      patient fact group, e.g. 'symptom', 'sign', 'lab', 'signalment'.
+    * ``value`` is either a bare name ("vomiting": the fact is present) or a
+      comparison "name op threshold" with op in ``= != > >= < <=`` ("alt>120").
+    * ``type`` 'exclude' / 'absent' / 'not' negates the predicate.
+
+A step matches when any of its entries match (a step without entries always
+matches). A step is reached when it is a root or any predecessor was reached
+and matched.
+
+Usage:
+
+    from common_models.flowcharts import flowchart_cache
+
+    facts = {'symptom': {'vomiting', 'lethargy'}, 'lab': {'alt': 130.0}}
+    results = flowchart_cache.evaluate(facts)          # {condition_id: FlowResult}
+"""
+import logging
+import re
+import threading
+import time
+from collections import defaultdict, namedtuple
+
+import numpy as np
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+
+from common_models.db import db
+from common_models.models import Entry, Link, Step
+
+logger = logging.getLogger(__name__)
+
+NEGATING_TYPES = frozenset({'exclude', 'absent', 'not'})
+
+_INFO_PENDING = '_flowchart_changes'
+
+# Stands for "every condition" in a session's pending evictions.
+_ALL = object()
+
+_COMPARISON = re.compile(r'^\s*(.+?)\s*(>=|<=|!=|=|>|<)\s*(.+?)\s*$')
+
+FlowResult = namedtuple('FlowResult', ['condition_id', 'reached', 'matched', 'leaves', 'completed'])
+FlowResult.__doc__ = """
+Outcome of one flowchart for one patient.
+
+Attributes:
+    condition_id (int): Condition of the flowchart.
+    reached (list): step_ids reached.
+    matched (list): step_ids reached whose entries matched.
+    leaves (list): Matched step_ids without outgoing links.
+    completed (bool): True if any leaf step matched.
+"""
+
+
+class FlowchartCycleError(ValueError):
+    """Raised when a condition's links do not form a DAG."""
+
+
+def _number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_entry(category, entry_type, value):
+    """Parse an entry into a hashable predicate key ``(category, name, op, threshold, negate)``."""
+    negate = (entry_type or '').strip().lower() in NEGATING_TYPES
+    category = (category or '').strip().lower()
+    match = _COMPARISON.match(value or '')
+    if match:
+        name, op, threshold = match.groups()
+        number = _number(threshold)
+        return category, name.strip().lower(), op, number if number is not None else threshold.strip().lower(), negate
+    return category, (value or '').strip().lower(), 'present', None, negate
+
+
+def _test(predicate, facts):
+    category, name, op, threshold, negate = predicate
+    group = facts.get(category) or ()
+    if op == 'present':
+        result = name in group
+    else:
+        actual = group.get(name) if isinstance(group, dict) else None
+        if actual is None:
+            result = False
+        elif isinstance(threshold, float):
+            actual = _number(actual)
+            result = actual is not None and {
+                '=': actual == threshold, '!=': actual != threshold,
+                '>': actual > threshold, '>=': actual >= threshold,
+                '<': actual < threshold, '<=': actual <= threshold,
+            }[op]
+        else:
+            equal = str(actual).strip().lower() == threshold
+            result = equal if op == '=' else (not equal if op == '!=' else False)
+    return result != negate
+
+
+def normalize_facts(facts):
+    """Lower-case fact names so they line up with parsed predicates."""
+    normalized = {}
+    for category, group in (facts or {}).items():
+        if isinstance(group, dict):
+            normalized[category.lower()] = {str(k).strip().lower(): v for k, v in group.items()}
+        else:
+            normalized[category.lower()] = {str(v).strip().lower() for v in group}
+    return normalized
+
+
+class CompiledFlowchart:
+    """
+    One condition's flowchart as a DAG.
+
+    Attributes:
+        condition_id (int): Condition of the flowchart.
+        step_ids (list): step_id of each node, in topological order.
+        predecessors (list): Per node, indices of predecessor nodes.
+        entry_predicates (list): Per node, indices into the shared predicate table.
+        leaves (np.ndarray): Boolean mask of nodes without successors.
+    """
+
+    def __init__(self, condition_id, step_ids, predecessors, entry_predicates, leaves):
+        self.condition_id = condition_id
+        self.step_ids = step_ids
+        self.predecessors = predecessors
+        self.entry_predicates = entry_predicates
+        self.leaves = leaves
+
+    def sweep(self, predicate_values):
+        """
+        Reached / matched / matched-leaf masks for a batch of patients.
+
+        Args:
+            predicate_values (np.ndarray): bool (patients, predicates).
+
+        Returns:
+            tuple: Three bool arrays of shape (steps, patients).
+        """
+        n, patients = len(self.step_ids), predicate_values.shape[0]
+        reached = np.zeros((n, patients), dtype=bool)
+        matched = np.zeros((n, patients), dtype=bool)
+        for i in range(n):
+            preds = self.predecessors[i]
+            reached[i] = True if preds.size == 0 else matched[preds].any(axis=0)
+            entries = self.entry_predicates[i]
+            matched[i] = reached[i] if entries.size == 0 else reached[i] & predicate_values[:, entries].any(axis=1)
+        return reached, matched, matched & self.leaves[:, None]
+
+    def results(self, predicate_values):
+        """One ``FlowResult`` per row of ``predicate_values`` (patients, predicates)."""
+        reached, matched, leaves = self.sweep(predicate_values)
+        step_ids = self.step_ids
+        return [
+            FlowResult(
+                self.condition_id,
+                [step_ids[i] for i in np.flatnonzero(reached[:, p])],
+                [step_ids[i] for i in np.flatnonzero(matched[:, p])],
+                [step_ids[i] for i in np.flatnonzero(leaves[:, p])],
+                bool(leaves[:, p].any()),
+            )
+            for p in range(predicate_values.shape[0])
+        ]
+
+    def evaluate(self, predicate_values):
+        return self.results(predicate_values[None, :])[0]
+
+
+class FlowchartCache:
+    """
+    Compiled flowcharts keyed by condition_id, invalidated by committed Step/Entry/Link writes.
+
+    Evicting one condition reloads only that condition on the next ``get``. The
+    shared predicate table only grows on partial reloads and is compacted on a
+    full reload.
+
+    Attributes:
+        max_age (float): Seconds before a compiled graph is reloaded even without a
+            local write, to pick up edits made by other processes. None disables it.
+        errors (dict): condition_id -> reason, for flowcharts that failed to compile
+            (cycles). They are cached as empty graphs: left out of ``get(None)`` and
+            never completed.
+    """
+
+    def __init__(self, max_age=3600):
+        self.max_age = max_age
+        self._lock = threading.RLock()
+        self._graphs = {}
+        self._loaded_at = {}
+        self._step_condition = {}
+        self._predicates = []
+        self._predicate_index = {}
+        self._complete = False
+        self._evicted = set()
+        self.errors = {}
+
+    def _predicate(self, key):
+        index = self._predicate_index.get(key)
+        if index is None:
+            index = self._predicate_index[key] = len(self._predicates)
+            self._predicates.append(key)
+        return index
+
+    def _compile(self, condition_id, steps, entries, links):
+        order_in = {s.step_id: i for i, s in enumerate(steps)}
+        successors = defaultdict(list)
+        indegree = [0] * len(steps)
+        predecessors = [[] for _ in steps]
+        for link in links:
+            start, end = order_in.get(link.start_step_id), order_in.get(link.end_step_id)
+            if start is None or end is None:
+                continue
+            successors[start].append(end)
+            predecessors[end].append(start)
+            indegree[end] += 1
+
+        order = [i for i, d in enumerate(indegree) if d == 0]
+        for i in order:
+            for j in successors[i]:
+                indegree[j] -= 1
+                if indegree[j] == 0:
+                    order.append(j)
+        if len(order) != len(steps):
+            cyclic = sorted(steps[i].step_id for i, d in enumerate(indegree) if d > 0)
+            raise FlowchartCycleError(f"condition {condition_id}: steps on or after a cycle: {cyclic}")
+
+        position = {node: p for p, node in enumerate(order)}
+        by_step = defaultdict(list)
+        for entry in entries:
+            by_step[entry.step_id].append(entry)
+        entry_predicates = []
+        for node in order:
+            step = steps[node]
+            keys = [parse_entry(e.category or step.attribute_type, e.type, e.value) for e in by_step[step.id]]
+            entry_predicates.append(np.array([self._predicate(k) for k in keys], dtype=np.intp))
+        return CompiledFlowchart(
+            condition_id,
+            [steps[node].step_id for node in order],
+            [np.array(sorted(position[p] for p in predecessors[node]), dtype=np.intp) for node in order],
+            entry_predicates,
+            np.array([not successors[node] for node in order], dtype=bool),
+        )
+
+    def _load(self, condition_ids=None):
+        """Compile ``condition_ids`` (all conditions if None) with three queries."""
+        if condition_ids is None:
+            # Every graph is recompiled, so predicates of dropped entries can go.
+            self._graphs.clear()
+            self._loaded_at.clear()
+            self._step_condition.clear()
+            self._predicates = []
+            self._predicate_index = {}
+        steps_q = db.session.query(Step)
+        links_q = db.session.query(Link)
+        if condition_ids is not None:
+            steps_q = steps_q.filter(Step.condition_id.in_(condition_ids))
+            links_q = links_q.filter(Link.condition_id.in_(condition_ids))
+        steps = defaultdict(list)
+        for step in steps_q.order_by(Step.condition_id, Step.id):
+            steps[step.condition_id].append(step)
+        links = defaultdict(list)
+        for link in links_q:
+            links[link.condition_id].append(link)
+        step_pks = [s.id for group in steps.values() for s in group]
+        entries = defaultdict(list)
+        for i in range(0, len(step_pks), 5000):
+            for entry in db.session.query(Entry).filter(Entry.step_id.in_(step_pks[i:i + 5000])):
+                entries[entry.step_id].append(entry)
+
+        now = time.monotonic()
+        for condition_id in (condition_ids if condition_ids is not None else list(steps)):
+            group = steps.get(condition_id, [])
+            condition_entries = [e for s in group for e in entries[s.id]]
+            try:
+                graph = self._compile(condition_id, group, condition_entries, links[condition_id])
+                self.errors.pop(condition_id, None)
+            except FlowchartCycleError as exc:
+                # One broken flowchart must not stop the others from loading.
+                logger.warning("skipping flowchart: %s", exc)
+                self.errors[condition_id] = str(exc)
+                graph = CompiledFlowchart(condition_id, [], [], [], np.zeros(0, dtype=bool))
+            self._graphs[condition_id] = graph
+            self._loaded_at[condition_id] = now
+            self._evicted.discard(condition_id)
+            for s in group:
+                self._step_condition[s.id] = condition_id
+        if condition_ids is None:
+            self._evicted.clear()
+
+    def get(self, condition_ids=None):
+        """Compiled flowcharts for ``condition_ids`` (every condition with steps if None)."""
+        with self._lock:
+            now = time.monotonic()
+            stale = set()
+            if self.max_age is not None:
+                stale = {c for c, t in self._loaded_at.items() if now - t > self.max_age}
+            if condition_ids is None:
+                outdated = stale | self._evicted
+                if not self._complete or (self._graphs and len(outdated) >= len(self._graphs)):
+                    self._load(None)
+                    self._complete = True
+                elif outdated:
+                    self._load(sorted(outdated))
+                return {c: g for c, g in self._graphs.items() if g.step_ids}
+            wanted = list(dict.fromkeys(condition_ids))
+            missing = [c for c in wanted if c not in self._graphs or c in stale or c in self._evicted]
+            if missing:
+                self._load(missing)
+            return {c: self._graphs[c] for c in wanted}
+
+    def _snapshot(self, condition_ids):
+        with self._lock:
+            # Taken together: a full reload renumbers the predicate table.
+            return self.get(condition_ids), list(self._predicates)
+
+    @staticmethod
+    def _predicate_values(predicates, facts):
+        facts = normalize_facts(facts)
+        return np.fromiter((_test(p, facts) for p in predicates), dtype=bool, count=len(predicates))
+
+    def evaluate(self, facts, condition_ids=None):
+        """
+        Evaluate one patient against every requested flowchart.
+
+        Args:
+            facts (dict): category -> set of present names, or dict of name -> value.
+            condition_ids (iterable): Restrict to these conditions; all if None.
+
+        Returns:
+            dict: condition_id -> FlowResult.
+        """
+        graphs, predicates = self._snapshot(condition_ids)
+        values = self._predicate_values(predicates, facts)
+        return {c: g.evaluate(values) for c, g in graphs.items()}
+
+    def evaluate_many(self, facts_by_patient, condition_ids=None):
+        """
+        ``evaluate`` for several patients at once.
+
+        The predicate table is evaluated into one (patients, predicates) matrix and
+        each flowchart is swept once for all patients.
+
+        Returns:
+            dict: patient -> {condition_id: FlowResult}.
+        """
+        patients = list(facts_by_patient)
+        graphs, predicates = self._snapshot(condition_ids)
+        values = np.zeros((len(patients), len(predicates)), dtype=bool)
+        for row, patient in enumerate(patients):
+            values[row] = self._predicate_values(predicates, facts_by_patient[patient])
+        results = {patient: {} for patient in patients}
+        for condition_id, graph in graphs.items():
+            for patient, result in zip(patients, graph.results(values)):
+                results[patient][condition_id] = result
+        return results
+
+    def invalidate(self, condition_id=None):
+        """Drop one condition's graph, or everything when ``condition_id`` is None."""
+        with self._lock:
+            if condition_id is None:
+                self.errors.clear()
+                self._graphs.clear()
+                self._loaded_at.clear()
+                self._step_condition.clear()
+                self._predicates = []
+                self._predicate_index = {}
+                self._complete = False
+            else:
+                self._graphs.pop(condition_id, None)
+                self._loaded_at.pop(condition_id, None)
+                # Reloaded by the next get(), including get(None).
+                self._evicted.add(condition_id)
+
+    def _affected(self, target):
+        """Conditions whose graphs a write to ``target`` changes; ``_ALL`` when unknown."""
+        if isinstance(target, Entry):
+            # Unknown step: the entry may belong to any condition, so drop everything.
+            condition_id = self._step_condition.get(target.step_id)
+            return {condition_id} if condition_id is not None else {_ALL}
+        affected = {target.condition_id}
+        if isinstance(target, Step) and target.id in self._step_condition:
+            # A step moved to another condition leaves its old graph too.
+            affected.add(self._step_condition[target.id])
+        return affected
+
+    def _on_change(self, mapper, connection, target):
+        session = object_session(target)
+        if session is not None:
+            session.info.setdefault(_INFO_PENDING, set()).update(self._affected(target))
+
+
+flowchart_cache = FlowchartCache()
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_pending(session):
+    pending = session.info.pop(_INFO_PENDING, None)
+    if not pending:
+        return
+    if _ALL in pending:
+        flowchart_cache.invalidate()
+        return
+    for condition_id in pending:
+        flowchart_cache.invalidate(condition_id)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _drop_pending(session, previous_transaction):
+    session.info.pop(_INFO_PENDING, None)
+
+
+for _model in (Step, Entry, Link):
+    for _event in ('after_insert', 'after_update', 'after_delete'):
+        event.listen(_model, _event, flowchart_cache._on_change)
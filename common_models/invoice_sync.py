@@ -0,0 +1,230 @@
+"""
+Bulk PiMS invoice ingestion.
+
+``sync_invoices`` loads a clinic's raw invoice headers and lines into temporary
+staging tables with ``COPY`` (psycopg2 Postgres), then merges each staging
+table into ``InvoiceHeaderFact`` / ``InvoiceLineFact`` with one
+``INSERT ... SELECT ... ON CONFLICT DO UPDATE`` whose ``WHERE`` skips rows whose
+``content_hash`` is unchanged. Unchanged lines are therefore neither rewritten
+nor given a new ``updated_ts``.
+
+Tombstones: ``is_deleted`` headers and ``is_voided`` lines are merged like any
+other row, and every line of a header that arrives deleted is voided. Voiding
+clears the hash of lines the sync did not resend, so if PiMS later restores the
+header and resends them unchanged they are rewritten rather than skipped.
+
+On other databases the same merge runs as a keyed hash lookup plus bulk insert
+and bulk update, one statement each per chunk.
+
+The merge writes with Core statements, so the session hooks never see it;
+``sync_invoices`` emits the ``change_events`` of the lines it inserts, updates or
+voids itself (headers are not captured).
+
+Usage:
+
+    from common_models.invoice_sync import sync_invoices
+
+    stats = sync_invoices(pims_headers, pims_lines)
+    stats['lines']      # {'staged': ..., 'inserted': ..., 'updated': ..., 'unchanged': ...}
+"""
+import csv
+import hashlib
+import io
+import json
+import time
+from datetime import date, datetime, timezone
+
+from sqlalchemy import Column, MetaData, Table, bindparam, func, insert, literal_column, select, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from common_models.changes import emit_change_events
+from common_models.db import db
+from common_models.models import InvoiceHeaderFact, InvoiceLineFact
+
+# Columns maintained by the database rather than the PiMS payload.
+_MANAGED_COLUMNS = ('created_ts', 'updated_ts', 'written_ts', 'content_hash')
+
+_NULL = '\\N'
+
+
+def _payload_columns(table):
+    return [c for c in table.columns if c.name not in _MANAGED_COLUMNS]
+
+
+def _default(column):
+    default = column.default
+    if default is not None and default.is_scalar:
+        return default.arg
+    return None
+
+
+def _text(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return str(value)
+
+
+def content_hash(row, columns):
+    """sha256 over a row's payload columns, in column order."""
+    payload = json.dumps([None if row.get(c.name) is None else _text(row.get(c.name)) for c in columns])
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def prepare_rows(rows, model):
+    """
+    Payload dicts for ``model`` with column defaults filled in and ``content_hash`` set.
+
+    Rows repeating a primary key are collapsed, the last one wins, so the merge
+    never touches a row twice.
+    """
+    table = model.__table__
+    columns = _payload_columns(table)
+    pk = table.primary_key.columns.values()[0].name
+    prepared = {}
+    for row in rows:
+        if not isinstance(row, dict):
+            row = {c.name: getattr(row, c.key, None) for c in columns}
+        values = {c.name: _default(c) if row.get(c.name) is None else row.get(c.name) for c in columns}
+        values['content_hash'] = content_hash(values, columns)
+        prepared[values[pk]] = values
+    return list(prepared.values())
+
+
+def _copy(connection, table, columns, rows):
+    """``COPY`` rows into ``table``; False when the driver has no ``copy_expert``."""
+    cursor = connection.connection.dbapi_connection.cursor()
+    if not hasattr(cursor, 'copy_expert'):
+        return False
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    for row in rows:
+        writer.writerow([_NULL if row[c] is None else _text(row[c]) for c in columns])
+    buf.seek(0)
+    quoted = ', '.join(f'"{c}"' for c in columns)
+    cursor.copy_expert(f"COPY {table.name} ({quoted}) FROM STDIN WITH (FORMAT csv, NULL '{_NULL}')", buf)
+    return True
+
+
+def _merge_postgres(connection, model, rows):
+    """Stage with COPY and merge with one upsert. Returns the (inserted, updated) primary keys."""
+    table = model.__table__
+    columns = [c.name for c in _payload_columns(table)] + ['content_hash']
+    pk = table.primary_key.columns.values()[0].name
+    stage = Table(
+        f'stage_{table.name}', MetaData(),
+        *[Column(name, table.c[name].type) for name in columns],
+        prefixes=['TEMPORARY'],
+    )
+    stage.create(connection)
+    try:
+        if not _copy(connection, stage, columns, rows):
+            connection.execute(insert(stage), rows)
+        stmt = pg_insert(table).from_select(columns, select(*[stage.c[name] for name in columns]))
+        # Column onupdate defaults do not reach ON CONFLICT DO UPDATE; stamp them here.
+        stamps = {name: func.now() for name in ('updated_ts', 'written_ts') if name in table.c}
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[pk],
+            set_={**{name: stmt.excluded[name] for name in columns if name != pk}, **stamps},
+            where=table.c.content_hash.is_distinct_from(stmt.excluded.content_hash),
+        ).returning(table.c[pk], literal_column('(xmax = 0)'))
+        written = connection.execute(stmt).all()
+    finally:
+        stage.drop(connection)
+    return [key for key, fresh in written if fresh], [key for key, fresh in written if not fresh]
+
+
+def _merge_generic(connection, model, rows, chunk_size=1000):
+    """Hash lookup, bulk insert and bulk update per chunk. Returns the (inserted, updated) primary keys."""
+    table = model.__table__
+    pk = table.primary_key.columns.values()[0]
+    inserted, updated = [], []
+    for i in range(0, len(rows), chunk_size):
+        chunk = rows[i:i + chunk_size]
+        existing = dict(connection.execute(
+            select(pk, table.c.content_hash).where(pk.in_([r[pk.name] for r in chunk]))
+        ).all())
+        new = [r for r in chunk if r[pk.name] not in existing]
+        now = datetime.now(timezone.utc)
+        changed = [
+            dict(r, updated_ts=now, _pk=r[pk.name]) for r in chunk
+            if r[pk.name] in existing and existing[r[pk.name]] != r['content_hash']
+        ]
+        if new:
+            connection.execute(insert(table), new)
+        if changed:
+            connection.execute(update(table).where(pk == bindparam('_pk')), changed)
+        inserted.extend(r[pk.name] for r in new)
+        updated.extend(r['_pk'] for r in changed)
+    return inserted, updated
+
+
+def _void_deleted_invoice_lines(connection, invoice_ids):
+    """Void the remaining lines of deleted headers. Returns their (line_id, dog_id) rows."""
+    if not invoice_ids:
+        return []
+    table = InvoiceLineFact.__table__
+    return connection.execute(
+        update(table)
+        .where(table.c.invoice_id.in_(invoice_ids), table.c.is_voided.isnot(True))
+        # Clearing the hash makes the next sync rewrite (and un-void) these lines
+        # if PiMS restores the header and resends them unchanged.
+        .values(is_voided=True, content_hash=None, updated_ts=func.now())
+        .returning(table.c.line_id, table.c.dog_id)
+    ).all()
+
+
+def sync_invoices(headers, lines, commit=True):
+    """
+    Merge one PiMS sync's invoice headers and lines into the fact tables.
+
+    Args:
+        headers (iterable): Dicts (or objects) with ``InvoiceHeaderFact`` columns.
+        lines (iterable): Dicts (or objects) with ``InvoiceLineFact`` columns.
+        commit (bool): Commit the session when done.
+
+    Returns:
+        dict: ``headers`` and ``lines`` counts (staged / inserted / updated /
+        unchanged), ``voided_lines``, ``prepare_ms``, ``merge_ms`` and ``ms``.
+    """
+    start = time.perf_counter()
+    header_rows = prepare_rows(headers, InvoiceHeaderFact)
+    line_rows = prepare_rows(lines, InvoiceLineFact)
+    deleted = {r['invoice_id'] for r in header_rows if r.get('is_deleted')}
+    if deleted:
+        # Resent lines of a deleted header are stored voided, with the hash of
+        # that payload, so they are not rewritten and re-voided on every sync.
+        columns = _payload_columns(InvoiceLineFact.__table__)
+        for row in line_rows:
+            if row['invoice_id'] in deleted and not row.get('is_voided'):
+                row['is_voided'] = True
+                row['content_hash'] = content_hash(row, columns)
+    prepared = time.perf_counter()
+
+    connection = db.session.connection()
+    merge = _merge_postgres if connection.dialect.name == 'postgresql' else _merge_generic
+    stats = {}
+    try:
+        # Headers first: lines reference them.
+        for key, model, rows in (('headers', InvoiceHeaderFact, header_rows), ('lines', InvoiceLineFact, line_rows)):
+            inserted, updated = merge(connection, model, rows) if rows else ([], [])
+            stats[key] = {
+                'staged': len(rows), 'inserted': len(inserted), 'updated': len(updated),
+                'unchanged': len(rows) - len(inserted) - len(updated),
+            }
+            if model is InvoiceLineFact:
+                dog_of = {r['line_id']: r['dog_id'] for r in rows}
+                emit_change_events(InvoiceLineFact.__tablename__, 'insert', ((k, dog_of[k]) for k in inserted))
+                emit_change_events(InvoiceLineFact.__tablename__, 'update', ((k, dog_of[k]) for k in updated))
+        voided = _void_deleted_invoice_lines(connection, sorted(deleted))
+        emit_change_events(InvoiceLineFact.__tablename__, 'update', voided, ['is_voided', 'content_hash', 'updated_ts'])
+        stats['voided_lines'] = len(voided)
+        if commit:
+            db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    done = time.perf_counter()
+    stats['prepare_ms'] = int((prepared - start) * 1000)
+    stats['merge_ms'] = int((done - prepared) * 1000)
+    stats['ms'] = int((done - start) * 1000)
+    return stats
@@ -0,0 +1,370 @@
+"""
+Bulk loader for knowledge-base releases.
+
+A release bundle is a JSON file, a directory of CSV files, or an equivalent dict,
+with one section per table:
+
+    conditions              condition_name, <Condition columns>
+    symptoms                symptom_name
+    signs                   sign_name
+    lab_tests               lab_test_name, lab_test_units
+    signalments             signalment_name, condition_name
+    condition_signalments   condition_name, signalment_name, <ConditionSignalment columns>
+    condition_symptoms      condition_name, symptom_name, <ConditionSymptom columns>
+    condition_signs         condition_name, sign_name, <ConditionSign columns>
+    condition_labs          condition_name, lab_test_name, <ConditionLab columns>
+    condition_affiliated    condition_name, affiliated_condition_name, impact_on_primary_condition
+    exceptions              association (signalment|symptom|sign|lab|affiliated), the association's
+                            two names, exception_category, exception_value, exception_type
+
+Natural keys are resolved with one ``IN`` query per table and chunk, and the
+bundle is diffed against the current KB: new rows are inserted with multi-row
+``INSERT ... RETURNING``, changed rows are updated with one executemany per
+table, and unchanged rows are not written. Only the columns present in the
+bundle are compared, so a partial bundle never blanks other columns.
+
+Usage:
+
+    from common_models.kb_loader import KBLoader, load_bundle
+
+    report = KBLoader(load_bundle('kb-2025.10/')).apply(prune=True)
+    # report['phases']['condition_symptoms'] == {'inserted': 120, 'updated': 4, ..., 'ms': 35}
+
+The loader writes with Core statements, which fire no ORM events, so after a
+successful commit ``apply`` drops the in-process KB caches itself (exception
+rules, affiliation closure, flowcharts) and reports the new
+``knowledge_graph_version``. Other processes pick up the release through their
+cache ``max_age`` or the version change.
+"""
+import csv
+import json
+import os
+import time
+
+from sqlalchemy import Boolean, Float, Integer, Numeric, delete, insert, select, update
+
+from common_models.affiliations import invalidate_affiliation_closure
+from common_models.db import db
+from common_models.exception_rules import invalidate_exception_rules
+from common_models.flowcharts import flowchart_cache
+from common_models.models import (
+    Condition, ConditionAffiliated, ConditionLab, ConditionSign, ConditionSignalment, ConditionSymptom,
+    LabTests, Sign, Signalment, Symptom,
+)
+from common_models.models import Exception as ConditionException
+from common_models.screening import knowledge_graph_version
+
+CHUNK_SIZE = 1000
+
+# section -> (model, natural key column, references {bundle field: (column, section)})
+ENTITY_SPECS = (
+    ('conditions', Condition, 'condition_name', {}),
+    ('symptoms', Symptom, 'symptom_name', {}),
+    ('signs', Sign, 'sign_name', {}),
+    ('lab_tests', LabTests, 'lab_test_name', {}),
+    ('signalments', Signalment, 'signalment_name', {'condition_name': ('condition_id', 'conditions')}),
+)
+
+# section -> (model, exception kind, other end: (bundle field, entity section, column))
+ASSOCIATION_SPECS = (
+    ('condition_signalments', ConditionSignalment, 'signalment', ('signalment_name', 'signalments', 'signalment_id')),
+    ('condition_symptoms', ConditionSymptom, 'symptom', ('symptom_name', 'symptoms', 'symptom_id')),
+    ('condition_signs', ConditionSign, 'sign', ('sign_name', 'signs', 'sign_id')),
+    ('condition_labs', ConditionLab, 'lab', ('lab_test_name', 'lab_tests', 'lab_test_id')),
+    ('condition_affiliated', ConditionAffiliated, 'affiliated',
+     ('affiliated_condition_name', 'conditions', 'affiliated_condition_id')),
+)
+
+EXCEPTION_FIELDS = ('exception_category', 'exception_value', 'exception_type')
+
+EXCEPTION_COLUMNS = {
+    'signalment': 'condition_signalment_id',
+    'symptom': 'condition_symptom_id',
+    'sign': 'condition_sign_id',
+    'lab': 'condition_lab_id',
+    'affiliated': 'condition_affiliated_id',
+}
+
+
+class KBLoadError(ValueError):
+    """Raised when a bundle references names that exist neither in the bundle nor in the KB; nothing is applied."""
+
+
+def load_bundle(source):
+    """Read a bundle from a dict, a ``.json`` file or a directory of ``<section>.csv`` files."""
+    if isinstance(source, dict):
+        return source
+    if os.path.isdir(source):
+        bundle = {}
+        for name in sorted(os.listdir(source)):
+            section, ext = os.path.splitext(name)
+            if ext.lower() == '.csv':
+                with open(os.path.join(source, name), newline='', encoding='utf-8') as f:
+                    bundle[section] = list(csv.DictReader(f))
+        return bundle
+    with open(source, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _coerce(column, value):
+    if value is None or (isinstance(value, str) and value.strip() == ''):
+        return None
+    if isinstance(column.type, Boolean):
+        return value if isinstance(value, bool) else str(value).strip().lower() in ('1', 'true', 't', 'yes', 'y')
+    if isinstance(column.type, Integer):
+        return int(float(value))
+    if isinstance(column.type, (Float, Numeric)):
+        return float(value)
+    return value if not isinstance(value, str) else value.strip()
+
+
+def invalidate_kb_caches():
+    """Drop every in-process cache derived from the KB tables."""
+    invalidate_exception_rules()
+    invalidate_affiliation_closure()
+    flowchart_cache.invalidate()
+
+
+def _chunks(items, size=CHUNK_SIZE):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _insert_many(table, rows, returning=()):
+    """Multi-row insert of ``rows``, grouped by column set so each group is one statement per chunk."""
+    groups = {}
+    for row in rows:
+        groups.setdefault(tuple(sorted(row)), []).append(row)
+    statement = insert(table).returning(*returning) if returning else insert(table)
+    results = []
+    for group in groups.values():
+        for chunk in _chunks(group):
+            result = db.session.execute(statement, chunk)
+            if returning:
+                results.extend(result.all())
+    return results
+
+
+class KBLoader:
+    """
+    Applies a release bundle to the knowledge base as a diff.
+
+    Attributes:
+        bundle (dict): section -> list of row dicts.
+        ids (dict): entity section -> {natural key: primary key}, filled while loading.
+        report (dict): Per-phase counts and timings, returned by ``apply``.
+    """
+
+    def __init__(self, bundle):
+        self.bundle = {k: list(v) for k, v in bundle.items()}
+        self.ids = {section: {} for section, *_ in ENTITY_SPECS}
+        self.association_ids = {}
+        self.bundled_associations = {}
+        self.report = {'phases': {}}
+
+    def _phase(self, name, **counts):
+        entry = self.report['phases'].setdefault(name, {'inserted': 0, 'updated': 0, 'unchanged': 0, 'deleted': 0})
+        for key, value in counts.items():
+            entry[key] = entry.get(key, 0) + value
+        return entry
+
+    def _referenced_names(self):
+        """Entity names referenced by rows, per entity section, so they resolve in the same queries."""
+        names = {section: set() for section, *_ in ENTITY_SPECS}
+        for section, model, key, refs in ENTITY_SPECS:
+            for row in self.bundle.get(section, ()):
+                names[section].add(row[key])
+                for field, (_, ref_section) in refs.items():
+                    if row.get(field):
+                        names[ref_section].add(row[field])
+        for section, model, kind, (field, ref_section, _) in ASSOCIATION_SPECS:
+            for row in self.bundle.get(section, ()):
+                names['conditions'].add(row['condition_name'])
+                names[ref_section].add(row[field])
+        kinds = {kind: (field, ref_section) for _, _, kind, (field, ref_section, _) in ASSOCIATION_SPECS}
+        for row in self.bundle.get('exceptions', ()):
+            field, ref_section = kinds[row['association']]
+            names['conditions'].add(row['condition_name'])
+            names[ref_section].add(row[field])
+        return names
+
+    # -- phases -------------------------------------------------------------
+
+    def _load_entities(self, section, model, key, refs, names):
+        table = model.__table__
+        pk = table.primary_key.columns[0]
+        rows = {}
+        unresolved = {}
+        for row in self.bundle.get(section, ()):
+            values = {key: row[key]}
+            for field, value in row.items():
+                if field in refs:
+                    column, ref_section = refs[field]
+                    values[column] = self.ids[ref_section].get(value) if value else None
+                    if value and values[column] is None:
+                        unresolved.setdefault(ref_section, set()).add(value)
+                elif field in table.c and field != pk.name:
+                    values[field] = _coerce(table.c[field], value)
+            rows[row[key]] = values
+        if unresolved:
+            missing = '; '.join(f"{ref}: {', '.join(map(repr, sorted(names)))}" for ref, names in sorted(unresolved.items()))
+            raise KBLoadError(f"{section} reference names that are not in the bundle or the knowledge base: {missing}")
+
+        compared = sorted({c for values in rows.values() for c in values} - {key})
+        existing = {}
+        for chunk in _chunks(names):
+            for record in db.session.execute(
+                select(pk, table.c[key], *[table.c[c] for c in compared]).where(table.c[key].in_(chunk))
+            ).mappings():
+                existing[record[key]] = record
+                self.ids[section][record[key]] = record[pk.name]
+
+        new = [values for name, values in rows.items() if name not in existing]
+        changed = []
+        for name, values in rows.items():
+            record = existing.get(name)
+            if record is not None and any(record[c] != v for c, v in values.items() if c != key):
+                changed.append(dict(values, **{pk.name: record[pk.name]}))
+
+        for new_id, name in _insert_many(table, new, (pk, table.c[key])):
+            self.ids[section][name] = new_id
+        if changed:
+            db.session.execute(update(model), changed)
+        self._phase(section, inserted=len(new), updated=len(changed), unchanged=len(rows) - len(new) - len(changed))
+
+    def _resolve(self, section, name):
+        resolved = self.ids[section].get(name)
+        if resolved is None:
+            raise KBLoadError(f"{section[:-1]} {name!r} is not in the bundle or the knowledge base")
+        return resolved
+
+    def _load_associations(self, section, model, kind, other, prune):
+        field, ref_section, other_column = other
+        table = model.__table__
+        pk = table.primary_key.columns[0]
+        skip = {'condition_name', field, pk.name, 'condition_id', other_column}
+        rows = {}
+        for row in self.bundle.get(section, ()):
+            pair = (self._resolve('conditions', row['condition_name']), self._resolve(ref_section, row[field]))
+            values = {'condition_id': pair[0], other_column: pair[1]}
+            values.update({c: _coerce(table.c[c], v) for c, v in row.items() if c in table.c and c not in skip})
+            rows[pair] = values
+
+        condition_ids = sorted({pair[0] for pair in rows} | {
+            self._resolve('conditions', row['condition_name'])
+            for row in self.bundle.get('exceptions', ()) if row['association'] == kind
+        })
+        existing = {}
+        for chunk in _chunks(condition_ids):
+            for record in db.session.execute(select(table).where(table.c.condition_id.in_(chunk))).mappings():
+                existing[(record['condition_id'], record[other_column])] = record
+
+        new = [values for pair, values in rows.items() if pair not in existing]
+        changed = []
+        for pair, values in rows.items():
+            record = existing.get(pair)
+            if record is not None and any(record[c] != v for c, v in values.items()):
+                changed.append(dict(values, **{pk.name: record[pk.name]}))
+
+        ids = self.association_ids.setdefault(kind, {})
+        ids.update({pair: record[pk.name] for pair, record in existing.items()})
+        for new_id, condition_id, other_id in _insert_many(table, new, (pk, table.c.condition_id, table.c[other_column])):
+            ids[(condition_id, other_id)] = new_id
+        if changed:
+            db.session.execute(update(model), changed)
+        self.bundled_associations[kind] = {ids[pair] for pair in rows}
+
+        deleted = 0
+        if prune:
+            # Only conditions carried by this section are pruned; others are left untouched.
+            bundled = {pair[0] for pair in rows}
+            stale = [record[pk.name] for pair, record in existing.items() if pair[0] in bundled and pair not in rows]
+            for chunk in _chunks(stale):
+                db.session.execute(delete(ConditionException.__table__)
+                                   .where(ConditionException.__table__.c[EXCEPTION_COLUMNS[kind]].in_(chunk)))
+                deleted += db.session.execute(delete(table).where(pk.in_(chunk))).rowcount
+            stale_ids = set(stale)
+            for pair in [p for p, r in existing.items() if r[pk.name] in stale_ids]:
+                ids.pop(pair, None)
+        self._phase(section, inserted=len(new), updated=len(changed), deleted=deleted,
+                    unchanged=len(rows) - len(new) - len(changed))
+
+    def _load_exceptions(self, prune):
+        table = ConditionException.__table__
+        kinds = {kind: (field, ref_section) for _, _, kind, (field, ref_section, _) in ASSOCIATION_SPECS}
+        wanted = {}
+        for row in self.bundle.get('exceptions', ()):
+            kind = row['association']
+            field, ref_section = kinds[kind]
+            pair = (self._resolve('conditions', row['condition_name']), self._resolve(ref_section, row[field]))
+            association_id = self.association_ids.get(kind, {}).get(pair)
+            if association_id is None:
+                raise KBLoadError(f"exception on missing {kind} association {row['condition_name']!r} / {row[field]!r}")
+            values = {c: _coerce(table.c[c], row.get(c)) for c in EXCEPTION_FIELDS}
+            wanted[(kind, association_id) + tuple(values[c] for c in EXCEPTION_FIELDS)] = dict(
+                values, **{EXCEPTION_COLUMNS[kind]: association_id})
+
+        existing = {}
+        for kind, column in EXCEPTION_COLUMNS.items():
+            association_ids = {key[1] for key in wanted if key[0] == kind}
+            if prune:
+                association_ids |= self.bundled_associations.get(kind, set())
+            for chunk in _chunks(sorted(association_ids)):
+                for record in db.session.execute(
+                    select(table.c.exception_id, table.c[column], *[table.c[c] for c in EXCEPTION_FIELDS])
+                    .where(table.c[column].in_(chunk))
+                ).mappings():
+                    existing[(kind, record[column]) + tuple(record[c] for c in EXCEPTION_FIELDS)] = record['exception_id']
+
+        new = [values for key, values in wanted.items() if key not in existing]
+        _insert_many(table, new)
+        deleted = 0
+        if prune:
+            stale = [exception_id for key, exception_id in existing.items() if key not in wanted]
+            for chunk in _chunks(stale):
+                deleted += db.session.execute(delete(table).where(table.c.exception_id.in_(chunk))).rowcount
+        self._phase('exceptions', inserted=len(new), deleted=deleted, unchanged=len(wanted) - len(new))
+
+    # -- entry point --------------------------------------------------------
+
+    def apply(self, prune=False, dry_run=False):
+        """
+        Apply the bundle in dependency order inside one transaction.
+
+        Args:
+            prune (bool): Delete associations (and their exceptions) of bundled
+                conditions that the bundle no longer lists, and exceptions of
+                bundled associations that it no longer lists. Entities are never deleted.
+            dry_run (bool): Compute the diff and roll back instead of committing.
+
+        Returns:
+            dict: ``{'phases': {section: {inserted, updated, unchanged, deleted, ms}}, 'total_ms'}``,
+            plus ``kg_version`` when committed.
+        """
+        started = time.perf_counter()
+        try:
+            names = self._referenced_names()
+            for section, model, key, refs in ENTITY_SPECS:
+                t = time.perf_counter()
+                self._load_entities(section, model, key, refs, names[section])
+                self._phase(section)['ms'] = int((time.perf_counter() - t) * 1000)
+            for section, model, kind, other in ASSOCIATION_SPECS:
+                t = time.perf_counter()
+                self._load_associations(section, model, kind, other, prune)
+                self._phase(section)['ms'] = int((time.perf_counter() - t) * 1000)
+            t = time.perf_counter()
+            self._load_exceptions(prune)
+            self._phase('exceptions')['ms'] = int((time.perf_counter() - t) * 1000)
+        except Exception:
+            db.session.rollback()
+            raise
+        if dry_run:
+            db.session.rollback()
+        else:
+            db.session.commit()
+            invalidate_kb_caches()
+            self.report['kg_version'] = knowledge_graph_version()
+        self.report['total_ms'] = int((time.perf_counter() - started) * 1000)
+        self.report['dry_run'] = dry_run
+        return self.report
@@ -0,0 +1,255 @@
+"""
+Panel -> component -> lab test map.
+
+``PanelMap`` loads ``Panel``, ``Component``, ``panel_components`` and
+``LabTests`` once and keeps forward and reverse lookups, so lab ingestion and
+interpretation never walk ``Panel.components`` or ``LabTests.component_id``
+lazily. It is rebuilt on the next use after any write to those tables.
+
+``attach_components`` takes a whole ingestion batch of ``PatientLabResult`` rows
+(dicts or objects), fills ``component_id`` from ``result_name`` (preferring the
+components of the diagnostic's panel, then component names, then lab test
+names) and groups the rows under their diagnostics.
+
+Usage:
+
+    from common_models.lab_panels import attach_components, panel_map
+
+    groups = attach_components(incoming_results)
+    groups[diagnostic_id]['missing']     # panel components without a result
+    panel_map().lab_tests_for_panel(panel_id)
+"""
+import re
+import threading
+import time
+from collections import defaultdict
+
+from sqlalchemy import event, select, update
+from sqlalchemy.orm import Session, object_session
+
+from common_models.changes import emit_change_events
+from common_models.db import db
+from common_models.models import Component, LabTests, Panel, PatientDiagnostics, PatientLabResult, panel_components
+
+_NON_WORD = re.compile(r'[^a-z0-9]+')
+
+_INFO_PENDING = '_panel_map_changes'
+
+
+def normalize_result_name(name):
+    """'ALT (SGPT)' -> 'alt sgpt'."""
+    return ' '.join(_NON_WORD.sub(' ', (name or '').lower()).split())
+
+
+class PanelMap:
+    """
+    Forward and reverse lookups between panels, components and lab tests.
+
+    Attributes:
+        panel_components (dict): panel_id -> tuple of component_ids.
+        component_panels (dict): component_id -> tuple of panel_ids.
+        component_lab_tests (dict): component_id -> tuple of lab_test_ids.
+        lab_test_component (dict): lab_test_id -> component_id.
+        component_names (dict): component_id -> name.
+    """
+
+    def __init__(self, components=(), memberships=(), lab_tests=()):
+        self.component_names = {}
+        self._by_name = {}
+        for component_id, name in components:
+            self.component_names[component_id] = name
+            self._by_name.setdefault(normalize_result_name(name), component_id)
+
+        by_panel, by_component = defaultdict(list), defaultdict(list)
+        for panel_id, component_id in memberships:
+            by_panel[panel_id].append(component_id)
+            by_component[component_id].append(panel_id)
+        self.panel_components = {p: tuple(sorted(c)) for p, c in by_panel.items()}
+        self.component_panels = {c: tuple(sorted(p)) for c, p in by_component.items()}
+
+        tests = defaultdict(list)
+        test_names = []
+        self.lab_test_component = {}
+        self._by_test_name = {}
+        for lab_test_id, name, component_id in lab_tests:
+            if component_id is None:
+                continue
+            tests[component_id].append(lab_test_id)
+            self.lab_test_component[lab_test_id] = component_id
+            self._by_test_name.setdefault(normalize_result_name(name), component_id)
+            test_names.append((normalize_result_name(name), component_id))
+        self.component_lab_tests = {c: tuple(sorted(t)) for c, t in tests.items()}
+
+        # (panel_id, normalized component or lab test name) -> component_id.
+        self._panel_names = {}
+        for panel_id, component_ids in self.panel_components.items():
+            for component_id in component_ids:
+                name = normalize_result_name(self.component_names.get(component_id))
+                self._panel_names[(panel_id, name)] = component_id
+        for name, component_id in test_names:
+            for panel_id in self.component_panels.get(component_id, ()):
+                self._panel_names.setdefault((panel_id, name), component_id)
+
+    @classmethod
+    def load(cls):
+        """Build from the panel tables in three queries."""
+        components = db.session.execute(select(Component.id, Component.name)).all()
+        memberships = db.session.execute(
+            select(panel_components.c.panel_id, panel_components.c.component_id)
+        ).all()
+        lab_tests = db.session.execute(
+            select(LabTests.lab_test_id, LabTests.lab_test_name, LabTests.component_id)
+        ).all()
+        return cls(components, memberships, lab_tests)
+
+    def component_for(self, result_name, panel_id=None):
+        """Component for a result name, looked up in the panel first when ``panel_id`` is given."""
+        name = normalize_result_name(result_name)
+        if not name:
+            return None
+        if panel_id is not None:
+            component_id = self._panel_names.get((panel_id, name))
+            if component_id is not None:
+                return component_id
+        component_id = self._by_name.get(name)
+        if component_id is None:
+            component_id = self._by_test_name.get(name)
+        return component_id
+
+    def lab_tests_for_panel(self, panel_id):
+        """Lab test ids measured by a panel's components."""
+        return tuple(t for c in self.panel_components.get(panel_id, ()) for t in self.component_lab_tests.get(c, ()))
+
+    def panels_for_lab_test(self, lab_test_id):
+        """Panels whose components include a lab test."""
+        return self.component_panels.get(self.lab_test_component.get(lab_test_id), ())
+
+
+_lock = threading.Lock()
+_map = None
+
+
+def panel_map():
+    """Process-wide ``PanelMap``, loaded on first use and dropped when writes to the panel tables commit."""
+    global _map
+    with _lock:
+        if _map is None:
+            _map = PanelMap.load()
+        return _map
+
+
+def invalidate_panel_map(*args):
+    global _map
+    with _lock:
+        _map = None
+
+
+def _mark_changed(mapper, connection, target):
+    # Reloading at flush could cache rows that roll back; drop the map on commit.
+    session = object_session(target)
+    if session is not None:
+        session.info[_INFO_PENDING] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_pending(session):
+    if session.info.pop(_INFO_PENDING, False):
+        invalidate_panel_map()
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _drop_pending(session, previous_transaction):
+    session.info.pop(_INFO_PENDING, None)
+
+
+for _model in (Panel, Component, LabTests):
+    for _event in ('after_insert', 'after_update', 'after_delete'):
+        event.listen(_model, _event, _mark_changed)
+
+
+def _get(row, key):
+    return row.get(key) if isinstance(row, dict) else getattr(row, key, None)
+
+
+def _set(row, key, value):
+    if isinstance(row, dict):
+        row[key] = value
+    else:
+        setattr(row, key, value)
+
+
+def attach_components(results, diagnostic_panels=None, overwrite=False):
+    """
+    Fill ``component_id`` on a batch of lab results and group them by diagnostic.
+
+    Args:
+        results (iterable): ``PatientLabResult`` objects or dicts with
+            diagnostic_id, result_name and optionally component_id.
+        diagnostic_panels (dict): diagnostic_id -> panel_id for diagnostics not yet
+            in the database; the rest are read with one query.
+        overwrite (bool): Re-resolve results that already have a component_id.
+
+    Returns:
+        dict: diagnostic_id -> {'panel_id', 'results', 'unmatched', 'missing'} where
+        ``unmatched`` are results without a component and ``missing`` the panel's
+        component_ids that no result in the batch covers.
+    """
+    results = list(results)
+    mapping = panel_map()
+    panels = dict(diagnostic_panels or {})
+    unknown = {_get(r, 'diagnostic_id') for r in results} - set(panels) - {None}
+    if unknown:
+        panels.update(db.session.execute(
+            select(PatientDiagnostics.diagnostic_id, PatientDiagnostics.panel_id)
+            .where(PatientDiagnostics.diagnostic_id.in_(list(unknown)))
+        ).all())
+
+    groups = {}
+    for row in results:
+        diagnostic_id = _get(row, 'diagnostic_id')
+        panel_id = panels.get(diagnostic_id)
+        group = groups.setdefault(diagnostic_id, {'panel_id': panel_id, 'results': [], 'unmatched': [], 'missing': ()})
+        if overwrite or _get(row, 'component_id') is None:
+            component_id = mapping.component_for(_get(row, 'result_name'), panel_id)
+            if component_id is not None:
+                _set(row, 'component_id', component_id)
+        group['results'].append(row)
+        if _get(row, 'component_id') is None:
+            group['unmatched'].append(row)
+    for group in groups.values():
+        covered = {_get(r, 'component_id') for r in group['results']}
+        group['missing'] = tuple(c for c in mapping.panel_components.get(group['panel_id'], ()) if c not in covered)
+    return groups
+
+
+def backfill_lab_components(dog_ids=None, batch_size=5000, commit=True):
+    """
+    Set ``component_id`` on stored lab results that lack one, in bulk.
+
+    Returns:
+        dict: ``results``, ``updated`` and ``ms``.
+    """
+    table = PatientLabResult.__table__
+    stmt = select(table.c.lab_result_id, table.c.dog_id, table.c.diagnostic_id, table.c.result_name).where(
+        table.c.component_id.is_(None)
+    )
+    if dog_ids is not None:
+        stmt = stmt.where(table.c.dog_id.in_(list(dog_ids)))
+    start = time.perf_counter()
+    rows = [dict(r) for r in db.session.execute(stmt.order_by(table.c.lab_result_id)).mappings()]
+    updated = 0
+    for i in range(0, len(rows), batch_size):
+        batch = rows[i:i + batch_size]
+        attach_components(batch)
+        changes = [{'lab_result_id': r['lab_result_id'], 'component_id': r['component_id']}
+                   for r in batch if r.get('component_id') is not None]
+        if changes:
+            db.session.execute(update(PatientLabResult), changes)
+            # Bulk updates skip the session hooks; emit the outbox events ourselves.
+            emit_change_events(PatientLabResult.__tablename__, 'update',
+                               ((r['lab_result_id'], r['dog_id']) for r in batch if r.get('component_id') is not None),
+                               ['component_id'])
+        if commit:
+            db.session.commit()
+        updated += len(changes)
+    return {'results': len(rows), 'updated': updated, 'ms': int((time.perf_counter() - start) * 1000)}
@@ -20,6 +20,7 @@ from sqlalchemy import UniqueConstraint
 dog_vet_association = db.Table('dog_vet',
     db.Column('dog_id', db.Integer, db.ForeignKey('dog.dog_id'), primary_key=True),
     db.Column('vet_id', db.Integer, db.ForeignKey('vet.vet_id'), primary_key=True),
+    db.Index('ix_dog_vet_vet_id', 'vet_id', 'dog_id'),
     extend_existing=True
 )
 
@@ -458,8 +459,11 @@ class Vet(db.Model, UserMixin):
             return f"Vet('{self.vet_email}')"
 
 class Appointments(db.Model):
-    __table_args__ = {'extend_existing': True}
     __tablename__ = 'appointments'
+    __table_args__ = (
+        Index("ix_appointments_vet_start", "vet_id", "startTime"),
+        {'extend_existing': True},
+    )
     
     appointment_id = db.Column(db.Integer, primary_key=True)
     appointment_pims_id = db.Column(Text, nullable=True)
@@ -490,14 +494,14 @@ class Display(db.Model):
     display_id = db.Column(db.String, unique=True)
     name = db.Column(db.String)
     location = db.Column(db.String)
-    vet_id = db.Column(db.Integer, db.ForeignKey('vet.vet_id'), nullable=False)
+    vet_id = db.Column(db.Integer, db.ForeignKey('vet.vet_id'), nullable=False, index=True)
     
 class EHRJson(db.Model):
     __table_args__ = {'extend_existing': True}
     __tablename__ = 'ehr_jsons'
 
     id = db.Column(db.Integer, primary_key=True)
-    dog_id = db.Column(db.Integer, db.ForeignKey('dog.dog_id'), nullable=False)
+    dog_id = db.Column(db.Integer, db.ForeignKey('dog.dog_id'), nullable=False, index=True)
     dog = db.relationship('Dog', backref=db.backref('ehr_jsons', lazy=True))  # Optional relationship to access EHRs from Dog
 
     json_data = db.Column(db.JSON, nullable=True)  # Stores the JSON content, optional
@@ -838,7 +842,7 @@ class PatientAlerts(db.Model):
     __table_args__ = {'extend_existing': True}
     __tablename__ = 'patient_alerts'
     alert_id = db.Column(db.Integer, primary_key=True, unique=True)
-    dog_id = db.Column(db.Integer, db.ForeignKey('dog.dog_id', ondelete="CASCADE"), nullable=False)
+    dog_id = db.Column(db.Integer, db.ForeignKey('dog.dog_id', ondelete="CASCADE"), nullable=False, index=True)
     alert_type =  db.Column(db.String(50))
     
     alert_date = db.Column(Date, nullable=True)
@@ -871,7 +875,7 @@ class PatientPreventions(db.Model):
         {"extend_existing": True},
     )
     record_id = db.Column(db.Integer, primary_key=True, unique=True)
-    dog_id = db.Column(db.Integer, db.ForeignKey('dog.dog_id', ondelete="CASCADE"), nullable=False)
+    dog_id = db.Column(db.Integer, db.ForeignKey('dog.dog_id', ondelete="CASCADE"), nullable=False, index=True)
     prevention_type =  db.Column(db.String(50))
 
     name = db.Column(db.Text, nullable=False)
@@ -922,7 +926,7 @@ class PatientPrescriptions(db.Model):
     )
 
     id = db.Column(db.Integer, unique=True, primary_key=True)
-    dog_id = db.Column(db.Integer, db.ForeignKey('dog.dog_id', ondelete="CASCADE"), nullable=False)
+    dog_id = db.Column(db.Integer, db.ForeignKey('dog.dog_id', ondelete="CASCADE"), nullable=False, index=True)
     
     name = db.Column(db.String(180))
     strength = db.Column(db.String(180))
@@ -964,7 +968,7 @@ class PatientDiagnoses(db.Model):
     """
     __tablename__ = 'patient_diagnoses'
     diagnosis_id = db.Column(db.Integer, unique=True, primary_key=True, autoincrement=True)
-    dog_id = db.Column(db.Integer, db.ForeignKey('dog.dog_id', ondelete="CASCADE"), nullable=False)
+    dog_id = db.Column(db.Integer, db.ForeignKey('dog.dog_id', ondelete="CASCADE"), nullable=False, index=True)
     
     condition_name = db.Column(db.String(180))
     
@@ -1006,7 +1010,7 @@ class PatientSymptoms(db.Model):
     __tablename__ = 'patient_symptoms'
 
     symptom_entry_id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    dog_id = db.Column(db.Integer, db.ForeignKey('dog.dog_id', ondelete="CASCADE"), nullable=False)
+    dog_id = db.Column(db.Integer, db.ForeignKey('dog.dog_id', ondelete="CASCADE"), nullable=False, index=True)
 
     symptom_name = db.Column(db.String(180))
     symptom_id = db.Column(db.Integer, db.ForeignKey('symptoms.symptom_id'), nullable=True)
@@ -1022,6 +1026,10 @@ class PatientSymptoms(db.Model):
     symptom_end = db.Column(Date)
     duration_days = db.Column(db.Integer)
 
+    symptom_episode = db.Column(db.Integer)
+    episode_start = db.Column(Date, nullable=True)
+    episode_end = db.Column(Date, nullable=True)
+
     group_hash = db.Column(db.String(180), index=True)
     clinical_status = db.Column(db.String(64))
     
@@ -1035,7 +1043,7 @@ class PatientDiagnostics(db.Model):
     __table_args__ = {'extend_existing': True}
     __tablename__ = 'patient_diagnostics'
     diagnostic_id = db.Column(db.Integer, primary_key=True, unique=True)
-    dog_id = db.Column(db.Integer, db.ForeignKey('dog.dog_id', ondelete="CASCADE"), nullable=False)
+    dog_id = db.Column(db.Integer, db.ForeignKey('dog.dog_id', ondelete="CASCADE"), nullable=False, index=True)
 
 
     diagnostic_type = db.Column(db.String(50), nullable=False)  # 'lab', 'imaging', 'pathology', etc.
@@ -1070,7 +1078,7 @@ class PatientLabResult(db.Model):
 
     lab_result_id = db.Column(db.Integer, primary_key=True)
     diagnostic_id = db.Column(db.Integer, db.ForeignKey('patient_diagnostics.diagnostic_id', ondelete="CASCADE"), nullable=False)
-    dog_id = db.Column(db.Integer, db.ForeignKey('dog.dog_id', ondelete="CASCADE"), nullable=False)
+    dog_id = db.Column(db.Integer, db.ForeignKey('dog.dog_id', ondelete="CASCADE"), nullable=False, index=True)
     
     result_name = db.Column(db.String(100), nullable=False)
     result_value = db.Column(db.String(50), nullable=True)
@@ -1096,8 +1104,13 @@ class PatientLabResult(db.Model):
         return f"<LabResult {self.result_name}: {self.result_value} ({self.indicator})>"
     
 class PatientRecordLink(db.Model):
-    __table_args__ = {'extend_existing': True}
     __tablename__ = 'patient_record_links'
+    __table_args__ = (
+        Index("ix_record_links_forward", "record_type", "record_id", "target_type", "target_id"),
+        Index("ix_record_links_reverse", "target_type", "target_id", "record_type", "record_id"),
+        Index("ix_record_links_dog", "dog_id"),
+        {'extend_existing': True},
+    )
     
     id = db.Column(db.Integer, primary_key=True, unique=True)
     dog_id = db.Column(db.Integer, db.ForeignKey('dog.dog_id', ondelete="CASCADE"), nullable=False)
@@ -1125,7 +1138,7 @@ class Weights(db.Model):
     """
     __tablename__ = 'weights'
     id = db.Column(db.Integer, primary_key=True)
-    dog_id = db.Column(db.Integer, db.ForeignKey('dog.dog_id', ondelete="CASCADE"), nullable=False)
+    dog_id = db.Column(db.Integer, db.ForeignKey('dog.dog_id', ondelete="CASCADE"), nullable=False, index=True)
     weight = db.Column(db.Float, nullable=False)  # Assuming weight is stored as a float
     record_date = db.Column(Date, server_default=func.now())
 
@@ -1136,7 +1149,7 @@ class PatientVitals(db.Model):
     __table_args__ = {'extend_existing': True}
     __tablename__ = 'patient_vitals'
     id = db.Column(db.Integer, primary_key=True)
-    dog_id = db.Column(db.Integer, db.ForeignKey('dog.dog_id', ondelete="CASCADE"), nullable=False)
+    dog_id = db.Column(db.Integer, db.ForeignKey('dog.dog_id', ondelete="CASCADE"), nullable=False, index=True)
     type = db.Column(db.String(100), nullable=True)
     value = db.Column(db.String(100), nullable=False)  # Assuming weight is stored as a float
     uom = db.Column(db.String(100), nullable=True)
@@ -1152,7 +1165,7 @@ class PatientEmbedding(db.Model):
 
     id = db.Column(db.Integer, primary_key=True)
     
-    dog_id = db.Column(db.Integer, db.ForeignKey('dog.dog_id', ondelete="CASCADE"), nullable=False)
+    dog_id = db.Column(db.Integer, db.ForeignKey('dog.dog_id', ondelete="CASCADE"), nullable=False, index=True)
     category = db.Column(db.String(100), nullable=False)
     entry_id = db.Column(db.String(100), nullable=False)
     
@@ -1177,7 +1190,7 @@ class PatientInterventions(db.Model):
     
     id = db.Column(db.Integer, primary_key=True)
     
-    vet_id = db.Column(db.Integer, db.ForeignKey('vet.vet_id'), nullable=False)
+    vet_id = db.Column(db.Integer, db.ForeignKey('vet.vet_id'), nullable=False, index=True)
     dog_id = db.Column(db.Integer, db.ForeignKey('dog.dog_id'), nullable=False)
     appointment_id = db.Column(db.Integer, db.ForeignKey('appointments.appointment_id'), nullable=True)
 
@@ -1225,6 +1238,9 @@ class InterventionFact(db.Model):
     # audit
     created_ts        = db.Column(db.DateTime(timezone=True), server_default=func.now())
     updated_ts        = db.Column(db.DateTime(timezone=True), onupdate=func.now())
+    # last insert or update; indexed for compliance_cube refreshes
+    written_ts        = db.Column(db.DateTime(timezone=True), nullable=False, index=True,
+                                  server_default=func.now(), onupdate=func.now())
     
     condition_id = db.Column(db.Integer, db.ForeignKey('conditions.condition_id'), nullable=True)
     extected_effect = db.Column(db.Float, nullable=True)
@@ -1285,7 +1301,7 @@ class PromptRecommendations(db.Model):
     __tablename__ = 'prompt_recommendations'
     
     id = db.Column(db.Integer, primary_key=True)
-    dog_id = db.Column(db.Integer, db.ForeignKey('dog.dog_id', ondelete="CASCADE"), nullable=False)
+    dog_id = db.Column(db.Integer, db.ForeignKey('dog.dog_id', ondelete="CASCADE"), nullable=False, index=True)
     
     generated_at = db.Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
     generated_by_model = db.Column(db.String(50), nullable=False)
@@ -1549,13 +1565,46 @@ class ActiveIngredients(db.Model):
 
     drugs = relationship("Drugs", secondary=drug_ingredients, back_populates="ingredients")
 
+class PrescriptionNormalization(db.Model):
+    """
+    Memo of free-text prescriptions resolved against the formulary.
+
+    Attributes:
+        raw_key (str): sha256 of the normalized (name, strength, form); primary key.
+        raw_name (str): Name as first seen.
+        raw_strength (str): Strength as first seen.
+        raw_form (str): Form as first seen.
+        drug_id (int): Matched drug, if any.
+        ingredient_id (int): Matched (or the matched drug's) active ingredient, if any.
+        confidence (float): Match score in [0, 1]; 0 when nothing matched.
+        method (str): 'exact', 'token', 'trigram' or 'none'.
+        formulary_version (str): Formulary version the match was made against.
+        updated_at (DateTime): When the entry was last resolved.
+    """
+    __tablename__ = 'prescription_normalizations'
+    __table_args__ = {'extend_existing': True}
+
+    raw_key = db.Column(db.String(64), primary_key=True)
+    raw_name = db.Column(db.Text, nullable=True)
+    raw_strength = db.Column(db.String(180), nullable=True)
+    raw_form = db.Column(db.String(180), nullable=True)
+    drug_id = db.Column(db.Integer, db.ForeignKey('drugs.drug_id', ondelete="SET NULL"), nullable=True)
+    ingredient_id = db.Column(db.Integer, db.ForeignKey('active_ingredients.ingredient_id', ondelete="SET NULL"), nullable=True)
+    confidence = db.Column(db.Float, nullable=False, default=0.0)
+    method = db.Column(db.String(16), nullable=False)
+    formulary_version = db.Column(db.String(64), nullable=True)
+    updated_at = db.Column(db.DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+    def __repr__(self):
+        return f"PrescriptionNormalization('{self.raw_name}', {self.drug_id}, {self.ingredient_id}, {self.confidence})"
+
 
 class Simulation(db.Model):
     __tablename__ = 'simulations'
     __table_args__ = {'extend_existing': True}
 
     id = db.Column(db.Integer, primary_key=True)
-    vet_id = db.Column(db.Integer, db.ForeignKey('vet.vet_id'), nullable=False)
+    vet_id = db.Column(db.Integer, db.ForeignKey('vet.vet_id'), nullable=False, index=True)
     dog_id = db.Column(db.Integer, db.ForeignKey('dog.dog_id'), nullable=False)
     display_id = db.Column(db.String, db.ForeignKey('displays.display_id'), nullable=False)
     data = db.Column(db.JSON, nullable=False)
@@ -1629,7 +1678,62 @@ class TaskRun(db.Model):
     error_class = db.Column(db.String(128))
     error_msg = db.Column(db.Text)
     meta = db.Column(JSONB)
-    
+
+class ScreeningInput(db.Model):
+    """
+    Digest of everything a dog's last screening read, used to skip unchanged dogs.
+
+    Attributes:
+        dog_id (int): Primary key, the screened dog.
+        input_digest (str): sha256 over survey columns, record group_hashes and KG version.
+        kg_version (str): Knowledge-graph / CausalEdge version the screening ran against.
+        screened_at (DateTime): When the digest was last refreshed.
+        batch_id (UUID): Batch that last screened the dog, if any.
+    """
+    __tablename__ = 'screening_inputs'
+    __table_args__ = {'extend_existing': True}
+
+    dog_id = db.Column(db.Integer, db.ForeignKey('dog.dog_id', ondelete="CASCADE"), primary_key=True)
+    input_digest = db.Column(db.String(64), nullable=False)
+    kg_version = db.Column(db.String(64), nullable=True)
+    screened_at = db.Column(db.DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+    batch_id = db.Column(UUID(as_uuid=True), nullable=True)
+
+    def __repr__(self):
+        return f"ScreeningInput('{self.dog_id}', '{self.input_digest[:12]}')"
+
+class PatientTimeline(db.Model):
+    """
+    Materialized clinical timeline: one row per dated patient record.
+
+    Attributes:
+        id (int): Primary key; breaks ties between rows on the same date.
+        dog_id (int): Owning dog.
+        date (Date): Date the record is shown under.
+        kind (str): Record kind, e.g. 'diagnosis', 'lab_result' (see ``common_models.timeline``).
+        ref_id (int): Primary key of the source record.
+        summary (str): One-line description of the record.
+        updated_at (DateTime): When the row was last refreshed.
+    """
+    __tablename__ = 'patient_timeline'
+    __table_args__ = (
+        UniqueConstraint("kind", "ref_id", name="uq_patient_timeline_ref"),
+        Index("ix_patient_timeline_dog_date", "dog_id", "date", "id",
+              postgresql_include=["kind", "ref_id", "summary"]),
+        {"extend_existing": True},
+    )
+
+    id = db.Column(db.BigInteger, primary_key=True)
+    dog_id = db.Column(db.Integer, db.ForeignKey('dog.dog_id', ondelete="CASCADE"), nullable=False)
+    date = db.Column(Date, nullable=False)
+    kind = db.Column(db.String(32), nullable=False)
+    ref_id = db.Column(db.Integer, nullable=False)
+    summary = db.Column(db.String(500), nullable=True)
+    updated_at = db.Column(db.DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+    def __repr__(self):
+        return f"PatientTimeline('{self.dog_id}', '{self.date}', '{self.kind}:{self.ref_id}')"
+
 class WaitlistEntry(db.Model):
     __tablename__ = 'waitlist'
 
@@ -1924,6 +2028,15 @@ class Action(db.Model):
         Index("ix_actions_status_created", "status", "created_at"),
         Index("ix_actions_ticket", "ticket_id"),
         Index("ix_actions_target", "target_type", "target_id"),
+        Index("ix_actions_lease", "status", "lease_expires_at"),
+        Index("ix_actions_coalesced_into", "coalesced_into_id"),
+        Index(
+            "uq_actions_pending_dedupe",
+            "dedupe_key",
+            unique=True,
+            postgresql_where=text("status = 'queued' AND coalesced_into_id IS NULL"),
+            sqlite_where=text("status = 'queued' AND coalesced_into_id IS NULL"),
+        ),
     )
 
     id = db.Column(db.Integer, primary_key=True)
@@ -1946,6 +2059,20 @@ class Action(db.Model):
 
     ticket_id = db.Column(db.Integer, db.ForeignKey("tickets.id", ondelete="SET NULL"), nullable=True)
 
+    # worker lease (see common_models.actions.ActionRunner)
+    lease_owner = db.Column(db.String(128), nullable=True)
+    lease_expires_at = db.Column(db.DateTime(timezone=True), nullable=True)
+    attempts = db.Column(db.Integer, nullable=False, default=0, server_default=text("0"))
+
+    # coalescing (see common_models.actions.enqueue_action)
+    dedupe_key = db.Column(db.String(64), nullable=True)  # sha256 of type + target + normalized context
+    coalesced_into_id = db.Column(db.Integer, db.ForeignKey("actions.id", ondelete="SET NULL"), nullable=True)
+
+    @property
+    def execution_id(self):
+        """Id of the action that actually runs for this request."""
+        return self.coalesced_into_id or self.id
+
     def __repr__(self):
         return f"<Action id={self.id} type={self.action_type.value} status={self.status.value} ticket={self.ticket_id}>"
 
@@ -1954,7 +2081,7 @@ class Feedback(db.Model):
     __tablename__ = 'feedback'
     id = db.Column(db.Integer, primary_key=True)
     patient_id = db.Column(db.Integer, db.ForeignKey('dog.dog_id'), nullable=True)
-    vet_id = db.Column(db.Integer, db.ForeignKey('vet.vet_id'), nullable=False)
+    vet_id = db.Column(db.Integer, db.ForeignKey('vet.vet_id'), nullable=False, index=True)
     timestamp = db.Column(DateTime, server_default=func.now(), nullable=True)
     reported = db.Column(DateTime, server_default=func.now(), nullable=True)
     step = db.Column(db.Text, nullable=True)
@@ -1990,7 +2117,7 @@ class UserInteraction(db.Model):
     status = db.Column(db.String(20), nullable=False)
     status_code = db.Column(db.Integer, nullable=True)
 
-    vet_id = db.Column(db.Integer, db.ForeignKey('vet.vet_id'))
+    vet_id = db.Column(db.Integer, db.ForeignKey('vet.vet_id'), index=True)
     dog_id = db.Column(db.Integer, db.ForeignKey('dog.dog_id'), nullable=True)
     appointment_id = db.Column(db.Integer, db.ForeignKey('appointments.appointment_id'), nullable=True)
     
@@ -2001,7 +2128,7 @@ class InvoiceHeaderFact(db.Model):
     __table_args__ = {'extend_existing': True}
     __tablename__ = 'invoice_header_fact'
     invoice_id = db.Column(db.String, primary_key=True)
-    vet_id = db.Column(db.Integer, db.ForeignKey('vet.vet_id'), nullable=False)
+    vet_id = db.Column(db.Integer, db.ForeignKey('vet.vet_id'), nullable=False, index=True)
     dog_id = db.Column(db.Integer, db.ForeignKey('dog.dog_id'), nullable=False)
     integration_practice_id = db.Column(db.String(800), nullable=True)
     client_id = db.Column(db.String(800), nullable=True)
@@ -2016,12 +2143,16 @@ class InvoiceHeaderFact(db.Model):
     tax_amount = db.Column(db.Numeric(12,2), nullable=True)
     currency = db.Column(db.String(800), nullable=True, default='USD')
     is_deleted = db.Column(db.Boolean, default=False)
+    content_hash = db.Column(db.String(64), nullable=True)
 
 class InvoiceLineFact(db.Model):
-    __table_args__ = {'extend_existing': True}
     __tablename__ = 'invoice_line_fact'
+    __table_args__ = (
+        Index("ix_invoice_line_fact_invoice_id", "invoice_id"),
+        {'extend_existing': True},
+    )
     line_id = db.Column(db.String(800), primary_key=True)
-    vet_id = db.Column(db.Integer, db.ForeignKey('vet.vet_id'), nullable=False)
+    vet_id = db.Column(db.Integer, db.ForeignKey('vet.vet_id'), nullable=False, index=True)
     dog_id = db.Column(db.Integer, db.ForeignKey('dog.dog_id'), nullable=False)
     client_id = db.Column(db.String(800), nullable=True)
     
@@ -2059,9 +2190,13 @@ class InvoiceLineFact(db.Model):
     is_rebook_req = db.Column(db.Boolean, default=False)
     normalized_item_id = db.Column(db.String(800), nullable=True)
     created_ts = db.Column(db.DateTime(timezone=True), server_default=func.now())
-    updated_ts = db.Column(db.DateTime(timezone=True), server_default=func.now())
+    updated_ts = db.Column(db.DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+    # Last insert or update; indexed for compliance_cube refreshes.
+    written_ts = db.Column(db.DateTime(timezone=True), nullable=False, index=True,
+                           server_default=func.now(), onupdate=func.now())
     
     reco_appt_id = db.Column(db.Integer, nullable=True)
+    content_hash = db.Column(db.String(64), nullable=True)
     
     
 class ApptInvoiceLink(db.Model):
@@ -2075,11 +2210,57 @@ class ApptInvoiceLink(db.Model):
     link_type = db.Column(db.String(20), nullable=False)
     attribution_win = db.Column(db.String(10), nullable=False)
     linked_ts = db.Column(db.DateTime(timezone=True), nullable=False, server_default=func.now())
+    # Last insert or update; indexed for compliance_cube refreshes.
+    written_ts = db.Column(db.DateTime(timezone=True), nullable=False, index=True,
+                           server_default=func.now(), onupdate=func.now())
     is_pointer_appt = db.Column(db.Boolean, default=False)
     pr_amount = db.Column(db.Numeric(12,2))
     rr_amount = db.Column(db.Numeric(12,2))
     line_count = db.Column(db.Integer)
     matched_count = db.Column(db.Integer)
+
+
+class ComplianceCube(db.Model):
+    """
+    Additive compliance and revenue measures per (vet, day, category, compliance_state).
+
+    Intervention and invoice-line measures are split by category and compliance
+    state; appointment-level ``ApptInvoiceLink`` amounts are not, and live in the
+    row with category and compliance_state ''. Maintained by
+    ``common_models.compliance_cube``.
+
+    Attributes:
+        interventions (int): InterventionFact rows.
+        selected (int): Of those, selected.
+        matched (int): Of those, reconciled to an invoice line.
+        matched_amount (Numeric): Sum of InterventionFact.matched_amount.
+        invoice_lines (int): PTR-attributed InvoiceLineFact rows.
+        invoice_amount (Numeric): Sum of their line_amount.
+        links (int): ApptInvoiceLink rows.
+        pr_amount (Numeric): Sum of ApptInvoiceLink.pr_amount.
+        rr_amount (Numeric): Sum of ApptInvoiceLink.rr_amount.
+    """
+    __tablename__ = "compliance_cube"
+    __table_args__ = {"extend_existing": True}
+
+    vet_id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    category = db.Column(db.Text, primary_key=True, default='')
+    compliance_state = db.Column(db.String(32), primary_key=True, default='')
+
+    interventions = db.Column(db.Integer, nullable=False, default=0)
+    selected = db.Column(db.Integer, nullable=False, default=0)
+    matched = db.Column(db.Integer, nullable=False, default=0)
+    matched_amount = db.Column(db.Numeric(14,2), nullable=False, default=0)
+    invoice_lines = db.Column(db.Integer, nullable=False, default=0)
+    invoice_amount = db.Column(db.Numeric(14,2), nullable=False, default=0)
+    links = db.Column(db.Integer, nullable=False, default=0)
+    pr_amount = db.Column(db.Numeric(14,2), nullable=False, default=0)
+    rr_amount = db.Column(db.Numeric(14,2), nullable=False, default=0)
+    refreshed_at = db.Column(db.DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+    def __repr__(self):
+        return f"ComplianceCube({self.vet_id}, {self.day}, '{self.category}', '{self.compliance_state}')"
     
     
 # class Flag(db.Model):
@@ -2114,4 +2295,83 @@ class ProcessingStatus(db.Model):
     duration_ms = db.Column(BigInteger)
     job_id = db.Column(db.String, nullable=True)
     extra_json = db.Column(db.String, nullable=True)
-    updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
\ No newline at end of file
+    updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
+
+class ChangeEvent(db.Model):
+    """
+    Outbox row describing one ORM-level change, written in the same transaction as the change.
+
+    Attributes:
+        id (int): Primary key.
+        txid (int): Writing transaction id (Postgres ``txid_current()``), used for gap-free consumption.
+        created_at (DateTime): Time of the change.
+        table_name (str): Table of the changed row.
+        op (str): insert|update|delete.
+        record_pk (str): Primary key of the changed row (JSON list for composite keys).
+        dog_id (int): Owning dog, when the row carries one.
+        changed_columns (JSONB): Columns changed by an update; null for insert/delete.
+        group_hash (str): New ``group_hash`` of the row, when it has one.
+    """
+    __tablename__ = "change_events"
+    __table_args__ = (
+        Index("ix_change_events_txid_id", "txid", "id"),
+        Index("ix_change_events_table_txid", "table_name", "txid", "id"),
+        Index("ix_change_events_created_at", "created_at"),
+        Index("ix_change_events_dog_id", "dog_id", "id"),
+        {"extend_existing": True},
+    )
+
+    id = db.Column(db.BigInteger, primary_key=True)
+    txid = db.Column(db.BigInteger, nullable=False, default=0)
+    created_at = db.Column(db.DateTime(timezone=True), server_default=func.now(), nullable=False)
+
+    table_name = db.Column(db.String(64), nullable=False)
+    op = db.Column(db.String(8), nullable=False)
+    record_pk = db.Column(db.Text, nullable=False)
+    dog_id = db.Column(db.Integer, nullable=True)
+    changed_columns = db.Column(JSONB, nullable=True)
+    group_hash = db.Column(db.String(180), nullable=True)
+
+    def __repr__(self):
+        return f"<ChangeEvent {self.id} {self.op} {self.table_name}:{self.record_pk}>"
+
+class ChangeFeedOffset(db.Model):
+    """
+    Position of a named consumer in the ``change_events`` feed.
+
+    Attributes:
+        consumer (str): Consumer name, primary key.
+        last_txid (int): ``txid`` of the last event handled.
+        last_event_id (int): ``id`` of the last event handled.
+        updated_at (DateTime): When the offset last moved.
+    """
+    __tablename__ = "change_feed_offsets"
+    __table_args__ = {"extend_existing": True}
+
+    consumer = db.Column(db.String(120), primary_key=True)
+    last_txid = db.Column(db.BigInteger, nullable=False, default=0)
+    last_event_id = db.Column(db.BigInteger, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+    def __repr__(self):
+        return f"ChangeFeedOffset('{self.consumer}', {self.last_txid}, {self.last_event_id})"
+
+
+class AggregateWatermark(db.Model):
+    """
+    High-water mark of an incrementally refreshed aggregate.
+
+    Attributes:
+        name (str): Aggregate name, primary key.
+        watermark (DateTime): Latest source timestamp folded into the aggregate.
+        updated_at (DateTime): When the aggregate was last refreshed.
+    """
+    __tablename__ = "aggregate_watermarks"
+    __table_args__ = {"extend_existing": True}
+
+    name = db.Column(db.String(120), primary_key=True)
+    watermark = db.Column(db.DateTime(timezone=True), nullable=True)
+    updated_at = db.Column(db.DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+    def __repr__(self):
+        return f"AggregateWatermark('{self.name}', {self.watermark})"
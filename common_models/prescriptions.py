@@ -0,0 +1,365 @@
+"""
+Normalization of free-text prescriptions to ``Drugs`` and ``ActiveIngredients``.
+
+``FormularyIndex`` holds every ``Drugs.brand_name`` and ``ActiveIngredients.name``
+with an exact-name map, a token map and a trigram posting index. A raw name is
+resolved by exact match, then by a single formulary token it contains ("Rimadyl
+75mg chewable" -> Rimadyl), then by trigram Dice similarity computed for all
+formulary entries at once with ``np.bincount`` over the posting lists.
+
+Results are memoized in ``PrescriptionNormalization`` keyed by the normalized
+(name, strength, form), so each distinct raw prescription is matched once
+across all clinics and again only when the formulary changes.
+
+Usage:
+
+    from common_models.prescriptions import normalize_prescriptions, resolve_prescription_ids
+
+    matches = normalize_prescriptions([('Rimadyl', '75 mg', 'chewable tablet')])
+    stats = resolve_prescription_ids(dog_ids=clinic_dog_ids)
+"""
+import hashlib
+import re
+import threading
+import time
+from collections import defaultdict, namedtuple
+
+import numpy as np
+from sqlalchemy import event, func, select, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import Session, object_session
+
+from common_models.changes import emit_change_events
+from common_models.db import db
+from common_models.models import (
+    ActiveIngredients, DosageForms, Drugs, PatientPrescriptions, PrescriptionNormalization,
+)
+
+MIN_CONFIDENCE = 0.45
+
+FORM_BONUS = 0.05
+
+_INFO_PENDING = '_formulary_changes'
+
+_STRENGTH = re.compile(r'\b\d+(?:\.\d+)?\s*(?:mg/ml|mg/kg|mcg|mg|ml|g|iu|units?|%)(?=\W|$)')
+_NON_WORD = re.compile(r'[^a-z0-9]+')
+
+Match = namedtuple('Match', ['drug_id', 'ingredient_id', 'confidence', 'method'])
+Match.__doc__ = """
+Resolution of one raw prescription.
+
+Attributes:
+    drug_id (int): Matched drug, or None.
+    ingredient_id (int): Matched ingredient (the drug's ingredient for drug matches), or None.
+    confidence (float): Score in [0, 1].
+    method (str): 'exact', 'token', 'trigram' or 'none'.
+"""
+
+NO_MATCH = Match(None, None, 0.0, 'none')
+
+
+def normalize_name(text):
+    """Lower-case, strip strengths and punctuation: "Rimadyl 75mg Chewable" -> "rimadyl chewable"."""
+    text = _STRENGTH.sub(' ', (text or '').lower())
+    return ' '.join(_NON_WORD.sub(' ', text).split())
+
+
+def normalize_strength(text):
+    return ''.join((text or '').lower().split())
+
+
+def trigrams(text):
+    """pg_trgm style trigrams: each word padded with two leading spaces and one trailing."""
+    grams = set()
+    for word in text.split():
+        padded = f'  {word} '
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+def raw_key(name, strength, form):
+    payload = '|'.join((normalize_name(name), normalize_strength(strength), normalize_name(form)))
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def _formulary_rows():
+    """The indexed columns of Drugs, ActiveIngredients and DosageForms, in primary key order."""
+    return (
+        db.session.execute(
+            select(Drugs.drug_id, Drugs.brand_name, Drugs.active_ingredient_id).order_by(Drugs.drug_id)
+        ).all(),
+        db.session.execute(
+            select(ActiveIngredients.ingredient_id, ActiveIngredients.name).order_by(ActiveIngredients.ingredient_id)
+        ).all(),
+        db.session.execute(
+            select(DosageForms.drug_id, DosageForms.dosage_form)
+            .where(DosageForms.drug_id.isnot(None))
+            .order_by(DosageForms.dosage_form_id)
+        ).all(),
+    )
+
+
+def _digest(drugs, ingredients, forms):
+    digest = hashlib.sha256()
+    for rows in (drugs, ingredients, forms):
+        for row in rows:
+            digest.update(repr(tuple(row)).encode('utf-8'))
+            digest.update(b'\n')
+        digest.update(b'\x00')
+    return digest.hexdigest()
+
+
+def formulary_version():
+    """
+    Digest of the indexed formulary content.
+
+    Covers every name, ingredient and dosage form the index reads, so a rename
+    (e.g. a ``Drugs.brand_name`` edit) changes it, not only inserts and deletes.
+    """
+    return _digest(*_formulary_rows())
+
+
+class FormularyIndex:
+    """
+    Name index over drugs and active ingredients.
+
+    Attributes:
+        names (list): Normalized name of each entry.
+        entries (list): (drug_id, ingredient_id) of each entry; drug_id is None for ingredients.
+        version (str): ``formulary_version()`` at load time.
+    """
+
+    def __init__(self, drugs=(), ingredients=(), drug_forms=None, version=None):
+        self.names = []
+        self.entries = []
+        self.version = version
+        self.drug_forms = drug_forms or {}
+        self._exact = defaultdict(list)
+        self._tokens = defaultdict(list)
+        postings = defaultdict(list)
+        sizes = []
+        for drug_id, name, ingredient_id in drugs:
+            self._add(normalize_name(name), (drug_id, ingredient_id), postings, sizes)
+        for ingredient_id, name in ingredients:
+            self._add(normalize_name(name), (None, ingredient_id), postings, sizes)
+        self._postings = {gram: np.array(ids, dtype=np.int32) for gram, ids in postings.items()}
+        self._sizes = np.array(sizes, dtype=np.float32)
+
+    def _add(self, name, entry, postings, sizes):
+        if not name:
+            return
+        i = len(self.entries)
+        self.names.append(name)
+        self.entries.append(entry)
+        self._exact[name].append(i)
+        for token in name.split():
+            self._tokens[token].append(i)
+        grams = trigrams(name)
+        for gram in grams:
+            postings[gram].append(i)
+        sizes.append(len(grams))
+
+    @classmethod
+    def load(cls):
+        """Build from Drugs, ActiveIngredients and DosageForms in three queries, versioned by their content."""
+        drugs, ingredients, forms = _formulary_rows()
+        drug_forms = defaultdict(set)
+        for drug_id, form in forms:
+            drug_forms[drug_id].add(normalize_name(form))
+        return cls(drugs, ingredients, drug_forms, _digest(drugs, ingredients, forms))
+
+    def _best(self, candidates, confidence, method, form):
+        """Prefer drugs over ingredients, then drugs sold in ``form``."""
+        def rank(i):
+            drug_id = self.entries[i][0]
+            has_form = bool(form) and drug_id is not None and any(
+                form in known or known in form for known in self.drug_forms.get(drug_id, ())
+            )
+            return (drug_id is not None, has_form, -i)
+        best = max(candidates, key=rank)
+        drug_id, ingredient_id = self.entries[best]
+        if rank(best)[1]:
+            confidence = min(1.0, confidence + FORM_BONUS)
+        return Match(drug_id, ingredient_id, round(float(confidence), 4), method)
+
+    def match(self, name, strength=None, form=None, min_confidence=MIN_CONFIDENCE):
+        """Resolve one raw prescription. Returns a ``Match``."""
+        name = normalize_name(name)
+        form = normalize_name(form)
+        if not name or not self.entries:
+            return NO_MATCH
+        exact = self._exact.get(name)
+        if exact:
+            return self._best(exact, 1.0, 'exact', form)
+        hits = defaultdict(list)
+        for token in name.split():
+            for i in self._tokens.get(token, ()):
+                hits[self.names[i]].append(i)
+        # A formulary name contained whole in the raw name, e.g. brand plus form words.
+        contained = [ids for entry_name, ids in hits.items() if f' {entry_name} ' in f' {name} ']
+        if contained:
+            return self._best([i for ids in contained for i in ids], 0.9, 'token', form)
+
+        grams = trigrams(name)
+        posting = [self._postings[g] for g in grams if g in self._postings]
+        if not posting:
+            return NO_MATCH
+        shared = np.bincount(np.concatenate(posting), minlength=len(self.entries))
+        dice = 2.0 * shared / (len(grams) + self._sizes)
+        top = float(dice.max())
+        if top < min_confidence:
+            return NO_MATCH
+        return self._best(np.flatnonzero(dice >= top - 1e-6).tolist(), top, 'trigram', form)
+
+
+_lock = threading.Lock()
+_index = None
+
+
+def formulary_index():
+    """Process-wide ``FormularyIndex``, loaded on first use and dropped when formulary writes commit."""
+    global _index
+    with _lock:
+        if _index is None:
+            _index = FormularyIndex.load()
+        return _index
+
+
+def invalidate_formulary_index(*args):
+    global _index
+    with _lock:
+        _index = None
+
+
+def _mark_changed(mapper, connection, target):
+    # Reloading at flush could cache names that roll back; drop the index on commit.
+    session = object_session(target)
+    if session is not None:
+        session.info[_INFO_PENDING] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_pending(session):
+    if session.info.pop(_INFO_PENDING, False):
+        invalidate_formulary_index()
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _drop_pending(session, previous_transaction):
+    session.info.pop(_INFO_PENDING, None)
+
+
+for _model in (Drugs, ActiveIngredients, DosageForms):
+    for _event in ('after_insert', 'after_update', 'after_delete'):
+        event.listen(_model, _event, _mark_changed)
+
+
+def _store(rows):
+    if not rows:
+        return
+    table = PrescriptionNormalization.__table__
+    if db.session.get_bind().dialect.name == 'postgresql':
+        stmt = pg_insert(table).values(rows)
+        db.session.execute(stmt.on_conflict_do_update(
+            index_elements=['raw_key'],
+            set_={
+                'drug_id': stmt.excluded.drug_id,
+                'ingredient_id': stmt.excluded.ingredient_id,
+                'confidence': stmt.excluded.confidence,
+                'method': stmt.excluded.method,
+                'formulary_version': stmt.excluded.formulary_version,
+                'updated_at': func.now(),
+            },
+        ))
+    else:
+        for row in rows:
+            db.session.merge(PrescriptionNormalization(**row))
+
+
+def normalize_prescriptions(raws, chunk_size=1000):
+    """
+    Resolve raw (name, strength, form) tuples, matching each distinct one at most once.
+
+    Memo entries made against the current formulary are reused; the rest are
+    matched with ``formulary_index()`` and written back to the memo table.
+
+    Returns:
+        dict: (name, strength, form) -> ``Match``.
+    """
+    raws = list(dict.fromkeys(tuple(raw) for raw in raws))
+    index = formulary_index()
+    keys = {raw: raw_key(*raw) for raw in raws}
+    memo = {}
+    distinct = list(dict.fromkeys(keys.values()))
+    for i in range(0, len(distinct), chunk_size):
+        rows = db.session.execute(
+            select(PrescriptionNormalization.raw_key, PrescriptionNormalization.drug_id,
+                   PrescriptionNormalization.ingredient_id, PrescriptionNormalization.confidence,
+                   PrescriptionNormalization.method)
+            .where(PrescriptionNormalization.raw_key.in_(distinct[i:i + chunk_size]))
+            .where(PrescriptionNormalization.formulary_version == index.version)
+        ).all()
+        memo.update({row[0]: Match(*row[1:]) for row in rows})
+
+    new_rows = []
+    for raw in raws:
+        key = keys[raw]
+        if key in memo:
+            continue
+        name, strength, form = raw
+        memo[key] = found = index.match(name, strength, form)
+        new_rows.append({
+            'raw_key': key, 'raw_name': name, 'raw_strength': strength, 'raw_form': form,
+            'drug_id': found.drug_id, 'ingredient_id': found.ingredient_id,
+            'confidence': found.confidence, 'method': found.method, 'formulary_version': index.version,
+        })
+    for i in range(0, len(new_rows), chunk_size):
+        _store(new_rows[i:i + chunk_size])
+    return {raw: memo[keys[raw]] for raw in raws}
+
+
+def resolve_prescription_ids(dog_ids=None, min_confidence=0.8, overwrite=False, batch_size=5000, commit=True):
+    """
+    Fill ``PatientPrescriptions.drug_id`` / ``ingredient_id`` from the normalizer in bulk.
+
+    Args:
+        dog_ids (iterable): Restrict to these dogs; all prescriptions if None.
+        min_confidence (float): Lowest confidence written to a prescription.
+        overwrite (bool): Also re-resolve prescriptions that already have ids.
+        batch_size (int): Prescriptions per batch.
+        commit (bool): Commit after each batch.
+
+    Returns:
+        dict: ``prescriptions``, ``distinct``, ``updated`` and ``ms``.
+    """
+    table = PatientPrescriptions.__table__
+    stmt = select(table.c.id, table.c.dog_id, table.c.name, table.c.strength, table.c.form).where(table.c.name.isnot(None))
+    if dog_ids is not None:
+        stmt = stmt.where(table.c.dog_id.in_(list(dog_ids)))
+    if not overwrite:
+        stmt = stmt.where(table.c.drug_id.is_(None), table.c.ingredient_id.is_(None))
+    start = time.perf_counter()
+    stats = {'prescriptions': 0, 'distinct': 0, 'updated': 0}
+    rows = db.session.execute(stmt.order_by(table.c.id)).all()
+    for i in range(0, len(rows), batch_size):
+        batch = rows[i:i + batch_size]
+        matches = normalize_prescriptions(row[2:] for row in batch)
+        dog_of = {}
+        changes = []
+        for row in batch:
+            found = matches[tuple(row[2:])]
+            if found.confidence >= min_confidence and (found.drug_id or found.ingredient_id):
+                changes.append({'id': row[0], 'drug_id': found.drug_id, 'ingredient_id': found.ingredient_id})
+                dog_of[row[0]] = row[1]
+        if changes:
+            db.session.execute(update(PatientPrescriptions), changes)
+            # Bulk updates skip the session hooks; emit the outbox events ourselves.
+            emit_change_events(PatientPrescriptions.__tablename__, 'update', dog_of.items(),
+                               ['drug_id', 'ingredient_id'])
+        if commit:
+            db.session.commit()
+        stats['prescriptions'] += len(batch)
+        stats['distinct'] += len(matches)
+        stats['updated'] += len(changes)
+    stats['ms'] = int((time.perf_counter() - start) * 1000)
+    return stats
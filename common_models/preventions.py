@@ -0,0 +1,282 @@
+"""
+Prevention coverage and gap computation.
+
+``PatientPreventions`` rows are grouped per dog and per prevention (the
+``prevention_type``, falling back to the record ``name``). Each administration
+covers ``[administered_date, coverage end)`` where the end is the record's
+``due_date``, else ``administered_date`` plus its parsed ``duration``, else the
+default interval for the prevention type. ``compute_coverage`` sweeps every
+group at once with pandas: a running maximum of coverage ends per group gives
+each record its gap (or overlap) against everything given before it, the
+covered intervals fall out of the same pass, and the latest end per group
+gives the next-due date.
+
+Gap semantics:
+    * ``coverage_gap_type`` is 'initial' for the first administration of a group,
+      'gap' when it was given after earlier coverage ran out, 'overlap' when it was
+      given before, and 'continuous' when it was given on the day coverage ended.
+    * ``coverage_gap_days`` is the uncovered days before the record (0 unless 'gap').
+    * ``status`` of the latest record per group is 'Overdue' once its coverage has
+      ended, 'Due' within ``due_soon_days`` of the end, else 'Administered'; older
+      records are 'Administered'.
+    * Records without an ``administered_date`` are left untouched.
+
+Usage:
+
+    from common_models.preventions import update_prevention_coverage
+
+    stats = update_prevention_coverage(dog_ids=clinic_dog_ids)
+    # stats == {'dogs': 812, 'records': 5120, 'updated': 431, 'dogs_updated': 97, ...}
+"""
+import re
+import threading
+import time
+from datetime import date
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import select, update
+
+from common_models.changes import emit_change_events
+from common_models.db import db
+from common_models.models import Dog, PatientPreventions, dog_vet_association
+
+# Columns written back by ``update_prevention_coverage``.
+COVERAGE_COLUMNS = ['coverage_gap_days', 'coverage_gap_type', 'status']
+
+# Used when a record has neither a due_date nor a parseable duration.
+DEFAULT_INTERVAL_DAYS = {
+    'vaccine': 365,
+    'heartworm': 30,
+    'flea': 30,
+    'tick': 30,
+    'flea and tick': 30,
+    'antiparasitic': 30,
+    'dewormer': 90,
+    'dental': 365,
+    'exam': 365,
+}
+
+_UNIT_DAYS = {
+    'd': 1, 'day': 1, 'days': 1,
+    'w': 7, 'wk': 7, 'wks': 7, 'week': 7, 'weeks': 7,
+    'm': 30, 'mo': 30, 'mos': 30, 'month': 30, 'months': 30,
+    'y': 365, 'yr': 365, 'yrs': 365, 'year': 365, 'years': 365,
+}
+
+_WORD_DAYS = {
+    'daily': 1, 'weekly': 7, 'biweekly': 14, 'monthly': 30, 'bimonthly': 60,
+    'quarterly': 91, 'semiannually': 182, 'semi-annually': 182, 'biannually': 182,
+    'annually': 365, 'annual': 365, 'yearly': 365, 'triennially': 1095, 'triennial': 1095,
+}
+
+_QUANTITY = re.compile(r'(\d+(?:\.\d+)?)\s*-?\s*([a-z]+)')
+
+_interval_lock = threading.Lock()
+_interval_table = {}
+
+
+def parse_interval_days(text):
+    """
+    Days covered by a duration/interval string, or None.
+
+    Accepts "30 days", "3 months", "1 yr", "every 6 weeks", "q12mo", "Annually",
+    "Monthly", "3-year".
+    """
+    text = (text or '').strip().lower()
+    if not text:
+        return None
+    for word, days in _WORD_DAYS.items():
+        if re.search(rf'\b{re.escape(word)}\b', text):
+            return days
+    match = _QUANTITY.search(text)
+    if match:
+        number, unit = match.groups()
+        factor = _UNIT_DAYS.get(unit) or _UNIT_DAYS.get(unit.rstrip('s'))
+        if factor:
+            return int(round(float(number) * factor))
+    return None
+
+
+def interval_days(values):
+    """
+    ``parse_interval_days`` over a Series, parsing each distinct string once per process.
+
+    Returns:
+        pd.Series: float days (NaN where unparseable), aligned with ``values``.
+    """
+    values = values.fillna('').astype(str)
+    with _interval_lock:
+        for text in values.unique():
+            if text not in _interval_table:
+                _interval_table[text] = parse_interval_days(text)
+        table = dict(_interval_table)
+    return values.map(table).astype(float)
+
+
+def _default_days(prevention_keys):
+    defaults = {}
+    for key in prevention_keys.unique():
+        defaults[key] = next((days for name, days in DEFAULT_INTERVAL_DAYS.items() if name in key), np.nan)
+    return prevention_keys.map(defaults).astype(float)
+
+
+def load_prevention_frame(dog_ids=None, vet_id=None):
+    """
+    The PatientPreventions columns the engine needs, in one query.
+
+    Args:
+        dog_ids (iterable): Restrict to these dogs.
+        vet_id (int): Restrict to the dogs of one vet (clinic-wide run).
+    """
+    table = PatientPreventions.__table__
+    stmt = select(
+        table.c.record_id, table.c.dog_id, table.c.prevention_type, table.c.name,
+        table.c.administered_date, table.c.due_date, table.c.duration,
+        table.c.coverage_gap_days, table.c.coverage_gap_type, table.c.status,
+    ).where(table.c.administered_date.isnot(None))
+    if dog_ids is not None:
+        stmt = stmt.where(table.c.dog_id.in_(list(dog_ids)))
+    if vet_id is not None:
+        stmt = stmt.where(table.c.dog_id.in_(
+            select(dog_vet_association.c.dog_id).where(dog_vet_association.c.vet_id == vet_id)
+        ))
+    rows = db.session.execute(stmt).all()
+    return pd.DataFrame(rows, columns=[c.name for c in stmt.selected_columns])
+
+
+def compute_coverage(frame, today=None, due_soon_days=30):
+    """
+    Coverage, gaps and status for every record in one vectorized pass.
+
+    Args:
+        frame (pd.DataFrame): As returned by ``load_prevention_frame``.
+        today (date): Reference date for status; defaults to today.
+        due_soon_days (int): Days before the coverage end at which a record becomes 'Due'.
+
+    Returns:
+        tuple: (records, intervals, next_due)
+            records: frame with ``prevention_key``, ``coverage_end`` and the new
+                ``coverage_gap_days`` / ``coverage_gap_type`` / ``status`` values.
+            intervals: one row per merged covered interval: dog_id, prevention_key, start, end.
+            next_due: Series dog_id -> earliest coverage end among each prevention's latest record.
+    """
+    today = pd.Timestamp(today or date.today())
+    df = frame.copy()
+    if df.empty:
+        empty = pd.DataFrame(columns=['dog_id', 'prevention_key', 'start', 'end'])
+        return df.assign(prevention_key=[], coverage_end=[]), empty, pd.Series(dtype='datetime64[ns]')
+
+    df['prevention_key'] = (
+        df['prevention_type'].where(df['prevention_type'].notna() & (df['prevention_type'] != ''), df['name'])
+        .fillna('').astype(str).str.strip().str.lower()
+    )
+    start = pd.to_datetime(df['administered_date'])
+    due = pd.to_datetime(df['due_date'])
+    days = interval_days(df['duration']).fillna(_default_days(df['prevention_key']))
+    df['coverage_start'] = start
+    df['coverage_end'] = due.where(due > start, start + pd.to_timedelta(days, unit='D'))
+    # Nothing known about how long it lasts: it covers its own day only.
+    df['coverage_end'] = df['coverage_end'].fillna(start)
+
+    df = df.sort_values(['dog_id', 'prevention_key', 'coverage_start', 'record_id'], kind='mergesort')
+    group = df.groupby(['dog_id', 'prevention_key'], sort=False)
+    covered_until = group['coverage_end'].cummax()
+    previous_end = covered_until.groupby([df['dog_id'], df['prevention_key']], sort=False).shift(1)
+    delta = (df['coverage_start'] - previous_end).dt.days
+
+    first = previous_end.isna()
+    df['coverage_gap_type'] = np.select(
+        [first, delta > 0, delta < 0], ['initial', 'gap', 'overlap'], default='continuous'
+    )
+    df['coverage_gap_days'] = np.where(first, 0, delta.clip(lower=0).fillna(0)).astype(int)
+
+    latest = ~df.duplicated(['dog_id', 'prevention_key'], keep='last')
+    group_end = covered_until.where(latest)
+    df['status'] = 'Administered'
+    df.loc[latest & (group_end <= today + pd.Timedelta(days=due_soon_days)), 'status'] = 'Due'
+    df.loc[latest & (group_end < today), 'status'] = 'Overdue'
+
+    interval_no = (first | (delta > 0)).cumsum()
+    intervals = (
+        df.assign(interval_no=interval_no, covered_until=covered_until)
+        .groupby('interval_no', sort=False)
+        .agg(dog_id=('dog_id', 'first'), prevention_key=('prevention_key', 'first'),
+             start=('coverage_start', 'min'), end=('covered_until', 'max'))
+        .reset_index(drop=True)
+    )
+    next_due = covered_until[latest].groupby(df.loc[latest, 'dog_id']).min()
+    return df.drop(columns=['coverage_start']), intervals, next_due
+
+
+def _changed_records(before, after):
+    columns = COVERAGE_COLUMNS
+    merged = after[['record_id', *columns]].merge(before[['record_id', *columns]], on='record_id', suffixes=('', '_old'))
+    changed = np.zeros(len(merged), dtype=bool)
+    for column in columns:
+        old = merged[f'{column}_old']
+        changed |= (merged[column].astype(object) != old.astype(object)) | old.isna()
+    rows = merged.loc[changed, ['record_id', *columns]]
+    return [
+        {'record_id': int(r.record_id), 'coverage_gap_days': int(r.coverage_gap_days),
+         'coverage_gap_type': r.coverage_gap_type, 'status': r.status}
+        for r in rows.itertuples(index=False)
+    ]
+
+
+def update_prevention_coverage(dog_ids=None, vet_id=None, today=None, due_soon_days=30, commit=True):
+    """
+    Recompute coverage for a clinic (or any set of dogs) and write the results in bulk.
+
+    Only records whose ``coverage_gap_days`` / ``coverage_gap_type`` / ``status``
+    change are updated, and only dogs whose ``next_due`` changes are touched.
+
+    Args:
+        dog_ids (iterable): Dogs to process; every dog with preventions if None.
+        vet_id (int): Process the dogs of this vet.
+        today (date): Reference date for status and next-due.
+        due_soon_days (int): See ``compute_coverage``.
+        commit (bool): Commit after writing.
+
+    Returns:
+        dict: ``dogs``, ``records``, ``updated``, ``dogs_updated``, ``load_ms``,
+        ``compute_ms`` and ``write_ms``.
+    """
+    stats = {'dogs': 0, 'records': 0, 'updated': 0, 'dogs_updated': 0}
+
+    start = time.perf_counter()
+    frame = load_prevention_frame(dog_ids, vet_id)
+    stats['load_ms'] = int((time.perf_counter() - start) * 1000)
+
+    start = time.perf_counter()
+    records, _, next_due = compute_coverage(frame, today, due_soon_days)
+    changed = _changed_records(frame, records) if len(records) else []
+    due_rows = []
+    if len(next_due):
+        stored = dict(db.session.execute(
+            select(Dog.dog_id, Dog.next_due).where(Dog.dog_id.in_([int(d) for d in next_due.index]))
+        ).all())
+        for dog_id, value in next_due.items():
+            dog_id, value = int(dog_id), value.date()
+            if dog_id in stored and stored[dog_id] != value:
+                due_rows.append({'dog_id': dog_id, 'next_due': value})
+    stats['compute_ms'] = int((time.perf_counter() - start) * 1000)
+    stats['dogs'] = int(records['dog_id'].nunique()) if len(records) else 0
+    stats['records'] = len(records)
+
+    start = time.perf_counter()
+    if changed:
+        db.session.execute(update(PatientPreventions), changed)
+        # Bulk updates skip the session hooks; emit the outbox events ourselves.
+        dog_of = dict(zip(records['record_id'].astype(int), records['dog_id'].astype(int)))
+        emit_change_events(PatientPreventions.__tablename__, 'update',
+                           ((r['record_id'], int(dog_of[r['record_id']])) for r in changed), COVERAGE_COLUMNS)
+    if due_rows:
+        db.session.execute(update(Dog), due_rows)
+        emit_change_events(Dog.__tablename__, 'update', ((r['dog_id'], r['dog_id']) for r in due_rows), ['next_due'])
+    if commit:
+        db.session.commit()
+    stats['write_ms'] = int((time.perf_counter() - start) * 1000)
+    stats['updated'] = len(changed)
+    stats['dogs_updated'] = len(due_rows)
+    return stats
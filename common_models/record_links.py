@@ -0,0 +1,324 @@
+"""
+Cross-record links between patient records.
+
+``PatientRecordLink`` rows are an adjacency list over (record_type, record_id)
+nodes, where the type is the record's table name (see ``RECORD_MODELS``). The
+forward and reverse composite indexes on the table serve ``linked`` for either
+side of a link; ``link_graph(dog_id)`` holds a dog's links as an undirected
+in-memory graph so repeated traversals during a visit cost one query.
+
+``suggest_links`` proposes links between a dog's diagnoses and its
+prescriptions, lab results and symptoms. Candidates are every same-dog pair
+within ``window_days``; each is scored from date proximity and from whether the
+knowledge graph relates the two (drug_condition, condition_lab via the lab
+test's component, condition_symptom), with the whole batch scored as arrays.
+
+Usage:
+
+    from common_models.record_links import link_graph, suggest_links
+
+    graph = link_graph(dog_id)
+    graph.neighbors(('patient_diagnoses', diagnosis_id))
+
+    stats = suggest_links(clinic_dog_ids)
+"""
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import and_, event, insert, select
+from sqlalchemy.orm import Session, object_session
+
+from common_models.db import db
+from common_models.models import (
+    ConditionLab, ConditionSymptom, LabTests, PatientDiagnoses, PatientLabResult,
+    PatientPrescriptions, PatientRecordLink, PatientSymptoms, drug_condition,
+)
+
+RECORD_MODELS = {
+    'patient_diagnoses': PatientDiagnoses,
+    'patient_prescriptions': PatientPrescriptions,
+    'patient_lab_results': PatientLabResult,
+    'patient_symptoms': PatientSymptoms,
+}
+
+# Target kind -> (pk, knowledge-graph key, date) columns read for suggestions.
+SUGGESTION_TARGETS = {
+    'patient_prescriptions': ('id', 'drug_id', 'start_date'),
+    'patient_lab_results': ('lab_result_id', 'component_id', 'date'),
+    'patient_symptoms': ('symptom_entry_id', 'symptom_id', 'symptom_start'),
+}
+
+_INFO_PENDING = '_link_graph_changes'
+
+
+def linked(record_type, record_id):
+    """
+    Every link touching one record, on either side, with one indexed query.
+
+    Returns:
+        list: (other_type, other_id, score, confirmed) tuples.
+    """
+    table = PatientRecordLink.__table__
+    forward = select(table.c.target_type, table.c.target_id, table.c.score, table.c.confirmed).where(
+        and_(table.c.record_type == record_type, table.c.record_id == record_id)
+    )
+    reverse = select(table.c.record_type, table.c.record_id, table.c.score, table.c.confirmed).where(
+        and_(table.c.target_type == record_type, table.c.target_id == record_id)
+    )
+    return [tuple(row) for row in db.session.execute(forward.union_all(reverse)).all()]
+
+
+class DogLinkGraph:
+    """
+    One dog's links as an undirected graph.
+
+    Attributes:
+        dog_id (int): Dog the links belong to.
+        adjacency (dict): (type, id) -> {(type, id): (score, confirmed)}.
+    """
+
+    def __init__(self, dog_id, rows=()):
+        self.dog_id = dog_id
+        self.adjacency = defaultdict(dict)
+        for record_type, record_id, target_type, target_id, score, confirmed in rows:
+            a, b = (record_type, record_id), (target_type, target_id)
+            self.adjacency[a][b] = self.adjacency[b][a] = (score, bool(confirmed))
+
+    @classmethod
+    def load(cls, dog_id):
+        table = PatientRecordLink.__table__
+        rows = db.session.execute(
+            select(table.c.record_type, table.c.record_id, table.c.target_type, table.c.target_id,
+                   table.c.score, table.c.confirmed).where(table.c.dog_id == dog_id)
+        ).all()
+        return cls(dog_id, rows)
+
+    def neighbors(self, node, record_type=None, min_score=None, confirmed_only=False):
+        """Directly linked nodes, optionally filtered by type, score and confirmation."""
+        result = []
+        for other, (score, confirmed) in self.adjacency.get(node, {}).items():
+            if record_type is not None and other[0] != record_type:
+                continue
+            if confirmed_only and not confirmed:
+                continue
+            if min_score is not None and (score is None or score < min_score) and not confirmed:
+                continue
+            result.append(other)
+        return result
+
+    def component(self, node, confirmed_only=False):
+        """Every node reachable from ``node`` (including it)."""
+        seen, stack = {node}, [node]
+        while stack:
+            for other in self.neighbors(stack.pop(), confirmed_only=confirmed_only):
+                if other not in seen:
+                    seen.add(other)
+                    stack.append(other)
+        return seen
+
+
+class LinkGraphCache:
+    """
+    Per-dog ``DogLinkGraph`` objects, least recently used evicted first.
+
+    Attributes:
+        max_dogs (int): Graphs kept in memory.
+    """
+
+    def __init__(self, max_dogs=2000):
+        self.max_dogs = max_dogs
+        self._lock = threading.Lock()
+        self._graphs = OrderedDict()
+
+    def get(self, dog_id):
+        with self._lock:
+            graph = self._graphs.get(dog_id)
+            if graph is not None:
+                self._graphs.move_to_end(dog_id)
+                return graph
+        graph = DogLinkGraph.load(dog_id)
+        with self._lock:
+            self._graphs[dog_id] = graph
+            while len(self._graphs) > self.max_dogs:
+                self._graphs.popitem(last=False)
+        return graph
+
+    def invalidate(self, dog_id=None):
+        with self._lock:
+            if dog_id is None:
+                self._graphs.clear()
+            else:
+                self._graphs.pop(dog_id, None)
+
+    def _on_change(self, mapper, connection, target):
+        # Evicting at flush would let a read before commit re-cache uncommitted
+        # links; queue the dog and evict once the transaction commits.
+        session = object_session(target)
+        if session is not None:
+            session.info.setdefault(_INFO_PENDING, set()).add(target.dog_id)
+
+
+link_graph_cache = LinkGraphCache()
+
+
+def link_graph(dog_id):
+    """Cached link graph for ``dog_id``."""
+    return link_graph_cache.get(dog_id)
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_pending(session):
+    for dog_id in session.info.pop(_INFO_PENDING, ()):
+        link_graph_cache.invalidate(dog_id)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _drop_pending(session, previous_transaction):
+    session.info.pop(_INFO_PENDING, None)
+
+
+for _event in ('after_insert', 'after_update', 'after_delete'):
+    event.listen(PatientRecordLink, _event, link_graph_cache._on_change)
+
+
+# -- suggestions ------------------------------------------------------------
+
+def knowledge_graph_pairs():
+    """(condition_id, key) pairs related in the knowledge graph, per suggestion target, in three queries."""
+    lab_pairs = db.session.execute(
+        select(ConditionLab.condition_id, LabTests.component_id)
+        .join(LabTests, LabTests.lab_test_id == ConditionLab.lab_test_id)
+        .where(LabTests.component_id.isnot(None))
+    ).all()
+    return {
+        'patient_prescriptions': db.session.execute(
+            select(drug_condition.c.condition_id, drug_condition.c.drug_id)
+        ).all(),
+        'patient_lab_results': lab_pairs,
+        'patient_symptoms': db.session.execute(
+            select(ConditionSymptom.condition_id, ConditionSymptom.symptom_id)
+        ).all(),
+    }
+
+
+def _frame(model, columns, dog_ids):
+    table = model.__table__
+    stmt = select(*[table.c[c] for c in columns]).where(table.c.dog_id.in_(dog_ids))
+    return pd.DataFrame(db.session.execute(stmt).all(), columns=columns)
+
+
+def _int_keys(frame):
+    return frame.assign(**{c: pd.to_numeric(frame[c], errors='coerce').astype('Int64') for c in ('condition_id', 'key')})
+
+
+def score_candidates(diagnoses, targets, kg_pairs, window_days=30, time_weight=0.4, kg_weight=0.6):
+    """
+    Score every same-dog (diagnosis, target) pair within ``window_days``.
+
+    Args:
+        diagnoses (pd.DataFrame): dog_id, diagnosis_id, condition_id, diagnosis_date.
+        targets (pd.DataFrame): dog_id, target_id, key, date.
+        kg_pairs (iterable): (condition_id, key) pairs related in the knowledge graph.
+
+    Returns:
+        pd.DataFrame: dog_id, diagnosis_id, target_id, days, score.
+    """
+    pairs = diagnoses.merge(targets, on='dog_id')
+    if pairs.empty:
+        return pairs.assign(days=[], score=[])[['dog_id', 'diagnosis_id', 'target_id', 'days', 'score']]
+    days = (pd.to_datetime(pairs['date']) - pd.to_datetime(pairs['diagnosis_date'])).dt.days.to_numpy(dtype=float)
+    within = np.abs(days) <= window_days
+    pairs, days = pairs[within], days[within]
+
+    # An all-NULL column comes back as object dtype and refuses to merge with int64,
+    # and NULL keys must not match each other; join on nullable ints without them.
+    kg = _int_keys(pd.DataFrame(list(kg_pairs), columns=['condition_id', 'key'])).dropna().drop_duplicates()
+    adjacent = _int_keys(pairs[['condition_id', 'key']]).merge(
+        kg.assign(adjacent=True), on=['condition_id', 'key'], how='left'
+    )['adjacent']
+    adjacent = adjacent.fillna(False).to_numpy(dtype=bool)
+
+    proximity = 1.0 - np.abs(days) / max(window_days, 1)
+    score = time_weight * proximity + kg_weight * adjacent
+    return pd.DataFrame({
+        'dog_id': pairs['dog_id'].to_numpy(),
+        'diagnosis_id': pairs['diagnosis_id'].to_numpy(),
+        'target_id': pairs['target_id'].to_numpy(),
+        'days': days.astype(int),
+        'score': np.round(score, 4),
+    })
+
+
+def _existing_links(dog_ids):
+    table = PatientRecordLink.__table__
+    rows = db.session.execute(
+        select(table.c.record_type, table.c.record_id, table.c.target_type, table.c.target_id)
+        .where(table.c.dog_id.in_(dog_ids))
+    ).all()
+    existing = set()
+    for record_type, record_id, target_type, target_id in rows:
+        existing.add((record_type, record_id, target_type, target_id))
+        existing.add((target_type, target_id, record_type, record_id))
+    return existing
+
+
+def suggest_links(dog_ids, window_days=30, min_score=0.6, batch_size=500, commit=True, **weights):
+    """
+    Propose unconfirmed diagnosis links for ``dog_ids`` and insert them in bulk.
+
+    Pairs that are already linked, in either direction, are skipped.
+
+    Args:
+        dog_ids (iterable): Dogs to process, e.g. a clinic's patients.
+        window_days (int): Largest distance in days between the two records' dates.
+        min_score (float): Lowest score inserted.
+        batch_size (int): Dogs per batch.
+        commit (bool): Commit after each batch.
+        **weights: ``time_weight`` / ``kg_weight`` for ``score_candidates``.
+
+    Returns:
+        dict: ``dogs``, ``candidates``, ``inserted``, ``load_ms``, ``score_ms`` and ``write_ms``.
+    """
+    dog_ids = list(dict.fromkeys(dog_ids))
+    stats = {'dogs': len(dog_ids), 'candidates': 0, 'inserted': 0, 'load_ms': 0, 'score_ms': 0, 'write_ms': 0}
+    kg = knowledge_graph_pairs()
+    for i in range(0, len(dog_ids), batch_size):
+        batch = dog_ids[i:i + batch_size]
+
+        start = time.perf_counter()
+        diagnoses = _frame(PatientDiagnoses, ['dog_id', 'diagnosis_id', 'condition_id', 'diagnosis_date'], batch)
+        diagnoses = diagnoses[diagnoses['diagnosis_date'].notna()]
+        targets = {}
+        for kind, (pk, key, date_column) in SUGGESTION_TARGETS.items():
+            frame = _frame(RECORD_MODELS[kind], ['dog_id', pk, key, date_column], batch)
+            targets[kind] = frame.set_axis(['dog_id', 'target_id', 'key', 'date'], axis=1).dropna(subset=['date'])
+        existing = _existing_links(batch)
+        stats['load_ms'] += int((time.perf_counter() - start) * 1000)
+
+        start = time.perf_counter()
+        rows = []
+        for kind, frame in targets.items():
+            scored = score_candidates(diagnoses, frame, kg[kind], window_days, **weights)
+            stats['candidates'] += len(scored)
+            for dog_id, diagnosis_id, target_id, _, score in scored[scored['score'] >= min_score].itertuples(index=False):
+                key = ('patient_diagnoses', int(diagnosis_id), kind, int(target_id))
+                if key in existing:
+                    continue
+                existing.add(key)
+                rows.append({'dog_id': int(dog_id), 'record_type': key[0], 'record_id': key[1],
+                             'target_type': kind, 'target_id': key[3], 'score': float(score), 'confirmed': False})
+        stats['score_ms'] += int((time.perf_counter() - start) * 1000)
+
+        start = time.perf_counter()
+        if rows:
+            db.session.execute(insert(PatientRecordLink.__table__), rows)
+            for dog_id in {row['dog_id'] for row in rows}:
+                link_graph_cache.invalidate(dog_id)
+        if commit:
+            db.session.commit()
+        stats['write_ms'] += int((time.perf_counter() - start) * 1000)
+        stats['inserted'] += len(rows)
+    return stats
@@ -0,0 +1,224 @@
+"""
+Appointment interval index per vet.
+
+``VetSchedule`` holds a vet's appointments in a time window as sorted numpy
+arrays of start/end seconds plus the running maximum of end times. Because the
+running maximum is monotone, the appointments overlapping any interval are
+found with two binary searches and a short slice, so overlap checks, free-slot
+search and conflict checks cost O(log n + k) per query.
+
+Loading reads only the window from the ``(vet_id, startTime)`` index, reaching
+back by ``MAX_APPOINTMENT_MINUTES`` to catch appointments that started before
+the window, so the cost depends on the window and not on the vet's history.
+(A GiST index over ``tstzrange(startTime, startTime + duration)`` is not
+possible: timestamptz + interval is not immutable.)
+
+Usage:
+
+    from common_models.schedule import VetSchedule, find_conflicts
+
+    schedule = VetSchedule.load(vet_id, day_start, day_end)
+    schedule.free_slots(day_start, day_end, minutes=30)
+
+    conflicts = find_conflicts(imported_rows)   # PiMS import, all vets in one pass
+"""
+from collections import defaultdict, namedtuple
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+from sqlalchemy import and_, func, select
+
+from common_models.db import db
+from common_models.models import Appointments
+
+# Longest appointment considered when reaching back before a window.
+MAX_APPOINTMENT_MINUTES = 24 * 60
+
+INACTIVE_STATUSES = ('cancelled', 'canceled', 'deleted', 'no show', 'no-show')
+
+Conflict = namedtuple('Conflict', ['index', 'vet_id', 'start', 'end', 'appointment_id', 'other_index'])
+Conflict.__doc__ = """
+A candidate appointment overlapping another appointment.
+
+Attributes:
+    index (int): Position of the candidate in the checked batch.
+    vet_id (int): Vet of both appointments.
+    start (datetime): Candidate start.
+    end (datetime): Candidate end.
+    appointment_id (int): Stored appointment it overlaps, or None.
+    other_index (int): Position of the other candidate it overlaps, or None.
+"""
+
+
+def _seconds(value):
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+
+def _datetime(seconds):
+    return datetime.fromtimestamp(float(seconds), tz=timezone.utc)
+
+
+def _active():
+    return func.lower(Appointments.status).notin_(INACTIVE_STATUSES)
+
+
+class VetSchedule:
+    """
+    Sorted interval index over one vet's appointments.
+
+    Attributes:
+        vet_id (int): Vet.
+        appointment_ids (np.ndarray): Appointment ids, ordered by start.
+        starts (np.ndarray): Start times, epoch seconds.
+        ends (np.ndarray): End times (start + duration), epoch seconds.
+        pims_ids (list): ``appointment_pims_id`` per appointment.
+    """
+
+    def __init__(self, vet_id, rows=()):
+        rows = sorted(rows, key=lambda r: (_seconds(r[1]), r[0]))
+        self.vet_id = vet_id
+        self.appointment_ids = np.array([r[0] for r in rows], dtype=np.int64)
+        self.starts = np.array([_seconds(r[1]) for r in rows], dtype=np.float64)
+        self.ends = self.starts + np.array([(r[2] or 0) * 60 for r in rows], dtype=np.float64)
+        self.pims_ids = [r[3] if len(r) > 3 else None for r in rows]
+        self._reach = np.maximum.accumulate(self.ends) if len(rows) else self.ends
+
+    @classmethod
+    def load(cls, vet_id, start, end):
+        """Active appointments of ``vet_id`` that can overlap [start, end), in one index range scan."""
+        return load_schedules([vet_id], start, end)[vet_id]
+
+    def _overlapping(self, start, end):
+        """Positions of appointments with start < ``end`` and end > ``start`` (epoch seconds)."""
+        hi = np.searchsorted(self.starts, end, side='left')
+        lo = np.searchsorted(self._reach[:hi], start, side='right')
+        positions = np.arange(lo, hi)
+        return positions[self.ends[lo:hi] > start]
+
+    def overlapping(self, start, end):
+        """Appointment ids overlapping [start, end)."""
+        return self.appointment_ids[self._overlapping(_seconds(start), _seconds(end))].tolist()
+
+    def is_free(self, start, end):
+        return self._overlapping(_seconds(start), _seconds(end)).size == 0
+
+    def busy(self, start, end):
+        """Merged busy intervals clipped to [start, end), as (start, end) datetimes."""
+        s, e = _seconds(start), _seconds(end)
+        positions = self._overlapping(s, e)
+        merged = []
+        for a, b in zip(np.maximum(self.starts[positions], s), np.minimum(self.ends[positions], e)):
+            if merged and a <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], b)
+            else:
+                merged.append([a, b])
+        return [(_datetime(a), _datetime(b)) for a, b in merged]
+
+    def free_slots(self, start, end, minutes=30, step_minutes=None, open_hours=None):
+        """
+        Free slots of ``minutes`` in [start, end).
+
+        Args:
+            step_minutes (int): Slot grid; slots start on multiples of it from
+                ``start``. None returns the free gaps themselves.
+            open_hours (list): (open, close) datetime pairs limiting the search,
+                e.g. each day's opening hours; None searches the whole range.
+
+        Returns:
+            list: (slot_start, slot_end) datetimes.
+        """
+        windows = open_hours or [(start, end)]
+        length = minutes * 60
+        slots = []
+        for window_start, window_end in windows:
+            s, e = max(_seconds(window_start), _seconds(start)), min(_seconds(window_end), _seconds(end))
+            if e - s < length:
+                continue
+            cursor = s
+            gaps = []
+            for busy_start, busy_end in self.busy(_datetime(s), _datetime(e)):
+                gaps.append((cursor, _seconds(busy_start)))
+                cursor = _seconds(busy_end)
+            gaps.append((cursor, e))
+            for a, b in gaps:
+                if b - a < length:
+                    continue
+                if step_minutes is None:
+                    slots.append((_datetime(a), _datetime(b)))
+                    continue
+                step = step_minutes * 60
+                first = _seconds(start) + np.ceil((a - _seconds(start)) / step) * step
+                for slot in np.arange(first, b - length + 1e-6, step):
+                    slots.append((_datetime(slot), _datetime(slot + length)))
+        return slots
+
+
+def load_schedules(vet_ids, start, end):
+    """``VetSchedule`` per vet for [start, end), all vets in one query."""
+    vet_ids = list(dict.fromkeys(vet_ids))
+    rows = db.session.execute(
+        select(Appointments.vet_id, Appointments.appointment_id, Appointments.startTime,
+               Appointments.duration, Appointments.appointment_pims_id)
+        .where(and_(
+            Appointments.vet_id.in_(vet_ids),
+            Appointments.startTime >= start - timedelta(minutes=MAX_APPOINTMENT_MINUTES),
+            Appointments.startTime < end,
+            _active(),
+        ))
+    ).all()
+    by_vet = defaultdict(list)
+    for vet_id, *row in rows:
+        by_vet[vet_id].append(row)
+    return {vet_id: VetSchedule(vet_id, by_vet[vet_id]) for vet_id in vet_ids}
+
+
+def find_conflicts(candidates, check_batch=True):
+    """
+    Overlaps of a batch of new appointments with stored ones and with each other.
+
+    Stored appointments with the candidate's own ``appointment_pims_id`` are not
+    counted (a re-import of the same appointment is not a conflict).
+
+    Args:
+        candidates (list): Dicts (or objects) with vet_id, startTime, duration and
+            optionally appointment_pims_id.
+        check_batch (bool): Also report overlaps between candidates.
+
+    Returns:
+        list: ``Conflict`` tuples.
+    """
+    def get(row, key):
+        return row.get(key) if isinstance(row, dict) else getattr(row, key, None)
+
+    if not candidates:
+        return []
+    starts = [get(c, 'startTime') for c in candidates]
+    ends = [s + timedelta(minutes=get(c, 'duration') or 0) for s, c in zip(starts, candidates)]
+    schedules = load_schedules({get(c, 'vet_id') for c in candidates}, min(starts), max(ends))
+
+    conflicts = []
+    by_vet = defaultdict(list)
+    for i, candidate in enumerate(candidates):
+        by_vet[get(candidate, 'vet_id')].append(i)
+    for vet_id, indexes in by_vet.items():
+        schedule = schedules[vet_id]
+        s = np.array([_seconds(starts[i]) for i in indexes])
+        e = np.array([_seconds(ends[i]) for i in indexes])
+        for k, i in enumerate(indexes):
+            pims_id = get(candidates[i], 'appointment_pims_id')
+            for position in schedule._overlapping(s[k], e[k]):
+                if pims_id is not None and schedule.pims_ids[position] == pims_id:
+                    continue
+                conflicts.append(Conflict(i, vet_id, starts[i], ends[i], int(schedule.appointment_ids[position]), None))
+        if check_batch and len(indexes) > 1:
+            # Sweep the vet's candidates in start order against the running max end.
+            order = np.argsort(s, kind='stable')
+            open_until, open_index = -np.inf, None
+            for k in order:
+                if s[k] < open_until:
+                    conflicts.append(Conflict(indexes[k], vet_id, starts[indexes[k]], ends[indexes[k]], None, open_index))
+                if e[k] > open_until:
+                    open_until, open_index = e[k], indexes[k]
+    return sorted(conflicts, key=lambda c: c.index)
@@ -0,0 +1,217 @@
+"""
+Incremental patient screening.
+
+Screening reads a dog's survey columns, its patient records and the knowledge
+graph, and writes ``Dog.screen_status``, ``last_screen``, ``imminent_conditions``
+and ``PatientAlerts``. ``run_incremental_screening`` fingerprints those inputs per
+dog, compares the fingerprint with the one stored in ``ScreeningInput`` at the
+last run, and only hands dogs whose inputs changed to the screening function.
+
+Usage:
+
+    from common_models.screening import run_incremental_screening
+
+    stats = run_incremental_screening(dog_ids, screen_dogs, batch_run=batch)
+    # stats == {'considered': 1200, 'skipped': 1130, 'recomputed': 70, ...}
+"""
+import hashlib
+import json
+import time
+
+from sqlalchemy import Text, cast, func, literal_column, select
+from sqlalchemy.dialects.postgresql import aggregate_order_by, insert as pg_insert
+
+from common_models.db import db
+from common_models.models import (
+    CausalEdge, Condition, ConditionAffiliated, ConditionImaging, ConditionLab, ConditionSign,
+    ConditionSignalment, ConditionSymptom, Dog, Entry, Link, PatientDiagnoses, PatientDiagnostics,
+    PatientLabResult, PatientPreventions, PatientPrescriptions, PatientSymptoms, ScreeningInput, Step,
+)
+from common_models.models import Exception as ConditionException
+
+# Dog columns written by screening or irrelevant to it; every other column is an input.
+SCREENING_EXCLUDED_COLUMNS = frozenset({
+    'dog_id', 'owner_id', 'image_status', 'screen_status', 'last_screen', 'imminent_conditions',
+    'status', 'next_due', 'date_enrolled', 'source_id', 'origin',
+})
+
+SCREENING_INPUT_COLUMNS = tuple(
+    c.name for c in Dog.__table__.columns if c.name not in SCREENING_EXCLUDED_COLUMNS
+)
+
+# Patient record tables whose group_hash values feed screening: (model, primary key column).
+SCREENING_RECORD_MODELS = (
+    (PatientDiagnoses, PatientDiagnoses.diagnosis_id),
+    (PatientSymptoms, PatientSymptoms.symptom_entry_id),
+    (PatientPrescriptions, PatientPrescriptions.id),
+    (PatientPreventions, PatientPreventions.record_id),
+    (PatientDiagnostics, PatientDiagnostics.diagnostic_id),
+    (PatientLabResult, PatientLabResult.lab_result_id),
+)
+
+# Knowledge-graph tables: (model, primary key column).
+KNOWLEDGE_GRAPH_MODELS = (
+    (Condition, Condition.condition_id),
+    (ConditionSignalment, ConditionSignalment.condition_signalment_id),
+    (ConditionSymptom, ConditionSymptom.condition_symptom_id),
+    (ConditionSign, ConditionSign.condition_sign_id),
+    (ConditionLab, ConditionLab.condition_lab_id),
+    (ConditionImaging, ConditionImaging.condition_imaging_id),
+    (ConditionAffiliated, ConditionAffiliated.id),
+    (ConditionException, ConditionException.exception_id),
+    (Step, Step.id),
+    (Entry, Entry.id),
+    (Link, Link.id),
+    (CausalEdge, CausalEdge.id),
+)
+
+
+def _digest(payload):
+    encoded = json.dumps(payload, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+
+def _table_digests_postgres():
+    """Per-table md5 over every row's text form, ordered by primary key, in one query."""
+    columns = []
+    for model, pk in KNOWLEDGE_GRAPH_MODELS:
+        row_text = cast(literal_column(f'"{model.__table__.name}"'), Text)
+        columns.append(
+            select(func.md5(func.string_agg(func.md5(row_text), aggregate_order_by(literal_column("','"), pk))))
+            .select_from(model.__table__)
+            .scalar_subquery()
+        )
+    return list(db.session.execute(select(*columns)).one())
+
+
+def _table_digests():
+    """Per-table sha256 over every row, ordered by primary key, streamed."""
+    digests = []
+    for model, pk in KNOWLEDGE_GRAPH_MODELS:
+        table = model.__table__
+        digest = hashlib.sha256()
+        result = db.session.execute(
+            select(table).order_by(pk).execution_options(yield_per=5000)
+        )
+        for row in result:
+            digest.update(json.dumps(list(row), separators=(',', ':'), default=str).encode('utf-8'))
+            digest.update(b'\n')
+        digests.append(digest.hexdigest())
+    return digests
+
+
+def knowledge_graph_version():
+    """
+    Version string for the knowledge graph and causal edges.
+
+    The knowledge-graph tables carry no update timestamps, so the version is a
+    digest of their content: any insert, delete or in-place edit (an association
+    weight, an exception value, a KB release applied with Core statements)
+    changes it. On Postgres the rows are digested in the database with one query.
+    """
+    if db.session.get_bind().dialect.name == 'postgresql':
+        return _digest(_table_digests_postgres())
+    return _digest(_table_digests())
+
+
+def compute_input_digests(dog_ids, kg_version):
+    """
+    Input digest per dog for ``dog_ids``, using one query for Dog and one per record table.
+
+    Returns:
+        dict: dog_id -> sha256 hex digest. Dogs that do not exist are omitted.
+    """
+    dog_ids = list(dog_ids)
+    columns = [Dog.__table__.c[name] for name in SCREENING_INPUT_COLUMNS]
+    survey = {
+        row[0]: list(row[1:])
+        for row in db.session.query(Dog.dog_id, *columns).filter(Dog.dog_id.in_(dog_ids))
+    }
+    records = {dog_id: {} for dog_id in survey}
+    for model, pk in SCREENING_RECORD_MODELS:
+        rows = db.session.query(model.dog_id, model.group_hash, pk).filter(model.dog_id.in_(dog_ids))
+        for dog_id, group_hash, record_id in rows:
+            if dog_id in records:
+                # Rows without a group_hash still count, keyed by id, so inserts and deletes register.
+                records[dog_id].setdefault(model.__tablename__, []).append(group_hash or f"id:{record_id}")
+    return {
+        dog_id: _digest([values, {table: sorted(hashes) for table, hashes in records[dog_id].items()}, kg_version])
+        for dog_id, values in survey.items()
+    }
+
+
+def _store_digests(digests, kg_version, batch_id=None):
+    rows = [
+        {'dog_id': dog_id, 'input_digest': digest, 'kg_version': kg_version, 'batch_id': batch_id}
+        for dog_id, digest in digests.items()
+    ]
+    if not rows:
+        return
+    if db.session.get_bind().dialect.name == 'postgresql':
+        stmt = pg_insert(ScreeningInput.__table__).values(rows)
+        db.session.execute(stmt.on_conflict_do_update(
+            index_elements=['dog_id'],
+            set_={
+                'input_digest': stmt.excluded.input_digest,
+                'kg_version': stmt.excluded.kg_version,
+                'batch_id': stmt.excluded.batch_id,
+                'screened_at': func.now(),
+            },
+        ))
+    else:
+        for row in rows:
+            db.session.merge(ScreeningInput(**row))
+
+
+def run_incremental_screening(dog_ids, screen, batch_run=None, force=False, chunk_size=500):
+    """
+    Screen only the dogs whose screening inputs changed since their last run.
+
+    Args:
+        dog_ids (iterable): Candidate dogs, e.g. every dog in a clinic's batch.
+        screen (callable): ``screen(changed_dog_ids)``; performs the actual screening.
+            Digests are stored only after it returns, so a failed chunk is retried
+            on the next run.
+        batch_run (BatchRun): If given, counts are recorded under ``metrics['screening']``.
+        force (bool): Re-screen every dog regardless of its digest.
+        chunk_size (int): Dogs digested and screened per round trip.
+
+    Returns:
+        dict: ``considered``, ``skipped``, ``recomputed``, ``digest_ms`` and ``screen_ms``.
+    """
+    dog_ids = list(dict.fromkeys(dog_ids))
+    batch_id = batch_run.batch_id if batch_run is not None else None
+    stats = {'considered': 0, 'skipped': 0, 'recomputed': 0, 'digest_ms': 0, 'screen_ms': 0}
+
+    start = time.perf_counter()
+    kg_version = knowledge_graph_version()
+    stats['digest_ms'] += int((time.perf_counter() - start) * 1000)
+    stats['kg_version'] = kg_version
+
+    for i in range(0, len(dog_ids), chunk_size):
+        chunk = dog_ids[i:i + chunk_size]
+
+        start = time.perf_counter()
+        digests = compute_input_digests(chunk, kg_version)
+        stored = dict(
+            db.session.query(ScreeningInput.dog_id, ScreeningInput.input_digest)
+            .filter(ScreeningInput.dog_id.in_(list(digests)))
+        )
+        changed = {d: h for d, h in digests.items() if force or stored.get(d) != h}
+        stats['digest_ms'] += int((time.perf_counter() - start) * 1000)
+        stats['considered'] += len(digests)
+        stats['skipped'] += len(digests) - len(changed)
+
+        if not changed:
+            continue
+        start = time.perf_counter()
+        screen(list(changed))
+        _store_digests(changed, kg_version, batch_id)
+        db.session.commit()
+        stats['screen_ms'] += int((time.perf_counter() - start) * 1000)
+        stats['recomputed'] += len(changed)
+
+    if batch_run is not None:
+        batch_run.metrics = dict(batch_run.metrics or {}, screening=stats)
+        db.session.commit()
+    return stats
@@ -0,0 +1,780 @@
+"""
+Deterministic synthetic data for the whole schema.
+
+``SyntheticDataset`` generates a practice group clinic by clinic: vets, owners,
+dogs with survey answers drawn from realistic distributions, appointments,
+patient records (diagnoses, symptoms, prescriptions, preventions, diagnostics
+with lab results, weights, vitals) with ``group_hash``es, interventions and the
+invoices that bill them, error logs and support tickets.
+
+Each clinic draws from its own generator seeded with ``(seed, clinic index)``,
+and ids are allocated in clinic order, so a dataset is reproducible from its
+seed and scale, and the first clinics of a large dataset are identical to a
+small one with the same seed. Dates are relative to ``as_of``, a fixed day, not
+today. When the database has a codebook, coded ``Dog`` columns without an
+explicit distribution are sampled from their codebook values, so output also
+depends on the codebook version.
+
+Dogs near a clinic share its census, climate and pollution values (with a
+little noise), weight follows breed, and age drives life stage and chronic
+conditions, so cohort and screening queries see realistic skew rather than
+uniform noise.
+
+``load_synthetic`` inserts a dataset in foreign-key order, one transaction per
+clinic, and on Postgres moves the id sequences past the loaded rows.
+
+Usage:
+
+    from common_models.synthetic import SyntheticDataset, load_synthetic
+
+    dataset = SyntheticDataset(seed=7, clinics=1)        # one clinic, ~1k dogs
+    stats = load_synthetic(dataset)
+
+    SyntheticDataset(seed=7, clinics=2000, dogs_per_vet=150)   # production scale
+"""
+import hashlib
+import time
+import zlib
+from collections import OrderedDict
+from datetime import date, datetime, time as dt_time, timedelta, timezone
+
+import numpy as np
+from sqlalchemy import Float, Integer, Numeric, insert, select, text
+
+from common_models.db import db
+from common_models.models import Dog, LinkType, SignalType, TicketPriority, TicketSource, TicketStatus, TicketType
+
+AS_OF = date(2025, 6, 30)
+
+HISTORY_DAYS = 3 * 365
+
+# Tables in insert (foreign-key) order.
+SYNTHETIC_TABLES = (
+    'user', 'vet', 'dog', 'dog_vet', 'appointments',
+    'patient_diagnoses', 'patient_symptoms', 'patient_prescriptions', 'patient_preventions',
+    'patient_diagnostics', 'patient_lab_results', 'weights', 'patient_vitals',
+    'patient_interventions', 'invoice_header_fact', 'invoice_line_fact', 'intervention_fact',
+    'appt_invoice_link', 'error_logs', 'tickets', 'ticket_linked_signals', 'ticket_events',
+)
+
+SURVEY_PREFIXES = ('ss_', 'de_', 'df_', 'pa_', 'mp_', 'hs_')
+
+# (breed, mean adult weight in lbs, share of dogs)
+BREEDS = (
+    ('Mixed', 45, 0.38), ('Labrador Retriever', 70, 0.09), ('Golden Retriever', 65, 0.06),
+    ('German Shepherd', 75, 0.05), ('French Bulldog', 24, 0.04), ('Poodle', 50, 0.04),
+    ('Beagle', 25, 0.04), ('Dachshund', 20, 0.04), ('Chihuahua', 6, 0.04), ('Yorkshire Terrier', 7, 0.03),
+    ('Boxer', 65, 0.03), ('Shih Tzu', 13, 0.03), ('Australian Shepherd', 50, 0.03), ('Border Collie', 42, 0.03),
+    ('Pit Bull Terrier', 55, 0.04), ('Great Dane', 140, 0.01), ('Siberian Husky', 50, 0.02),
+)
+
+DOG_NAMES = (
+    'Bella', 'Max', 'Luna', 'Charlie', 'Lucy', 'Cooper', 'Daisy', 'Milo', 'Bailey', 'Rocky', 'Sadie',
+    'Buddy', 'Molly', 'Tucker', 'Stella', 'Bear', 'Zoe', 'Duke', 'Lola', 'Jack', 'Ruby', 'Teddy', 'Rosie',
+)
+
+STREETS = ('Oak St', 'Maple Ave', 'Cedar Ln', 'Pine Rd', 'Elm St', 'Lakeview Dr', 'Hillcrest Rd', 'Park Ave')
+
+# column or prefix -> ('binary', p) | ('choice', values, weights) | ('normal', mean, sd, low, high)
+DOG_DISTRIBUTIONS = {
+    'ss_household_dog_count': ('choice', (1, 2, 3, 4), (0.55, 0.3, 0.1, 0.05)),
+    'hs_health_conditions_': ('binary', 0.06),
+    'df_daily_supplements_': ('binary', 0.1),
+    'de_recent_toxins_or_hazards_ingested_': ('binary', 0.03),
+    'hs_general_health': ('choice', (1, 2, 3, 4, 5), (0.35, 0.4, 0.17, 0.06, 0.02)),
+    'hs_new_condition_diagnosed_recently': ('binary', 0.12),
+    'hs_congenital_condition_present': ('binary', 0.04),
+    'pa_activity_level': ('choice', (1, 2, 3), (0.2, 0.55, 0.25)),
+    'pa_avg_activity_intensity': ('choice', (1, 2, 3), (0.3, 0.5, 0.2)),
+    'df_feedings_per_day': ('choice', (1, 2, 3), (0.2, 0.7, 0.1)),
+    'df_appetite': ('choice', (1, 2, 3), (0.8, 0.15, 0.05)),
+    'mp_vaccination_status': ('choice', (1, 2, 3), (0.85, 0.1, 0.05)),
+    'mp_flea_and_tick_treatment': ('binary', 0.75),
+    'mp_heartworm_preventative': ('binary', 0.7),
+    'de_dogpark': ('binary', 0.35),
+    'de_eats_feces': ('binary', 0.15),
+    'de_drinks_outdoor_water': ('binary', 0.4),
+    'de_nighttime_sleep_avg_hours': ('normal', 9, 1.5, 4, 14),
+    'de_daytime_sleep_avg_hours': ('normal', 4, 1.5, 0, 10),
+    'de_routine_hours_per_day_': ('normal', 3, 2, 0, 12),
+    'de_stairs_avg_flights_per_day': ('normal', 2, 2, 0, 15),
+    'de_dogpark_days_per_month': ('normal', 4, 3, 0, 30),
+    'de_recreational_spaces_days_per_month': ('normal', 6, 4, 0, 30),
+    'mp_dental_cleaning_months_ago': ('normal', 14, 8, 1, 60),
+    'mp_dental_extraction_months_ago': ('normal', 20, 12, 1, 80),
+    'df_primary_diet_component_change_months_ago': ('normal', 10, 8, 0, 60),
+}
+
+# Per clinic area: (mean, sd, low, high); dogs get the clinic's value plus 2% noise.
+ENVIRONMENT = {
+    'cv_population_density': (1800, 1500, 5, 25000),
+    'cv_gini_index': (0.45, 0.04, 0.3, 0.65),
+    'cv_median_income': (72000, 22000, 20000, 250000),
+    'cv_population_estimate': (40000, 25000, 500, 300000),
+    'cv_pct_female': (0.51, 0.015, 0.4, 0.6),
+    'cv_pct_owner_occupied': (0.64, 0.12, 0.1, 0.95),
+    'cv_pct_nothispanic_white': (0.6, 0.2, 0.02, 0.98),
+    'cv_pct_nothispanic_black': (0.12, 0.1, 0.0, 0.9),
+    'cv_pct_nothispanic_asian': (0.06, 0.05, 0.0, 0.6),
+    'cv_pct_hispanic': (0.18, 0.14, 0.0, 0.95),
+    'cv_pct_below_125povline': (0.16, 0.07, 0.01, 0.6),
+    'cv_pct_less_than_100k': (0.62, 0.14, 0.1, 0.98),
+    'cv_pct_same_house_1yrago': (0.86, 0.05, 0.5, 0.98),
+    'tp_tmpc_norm_07': (25, 3.5, 12, 36),
+    'tp_tmpc_norm_12': (3, 7, -18, 22),
+    'pv_no2': (9, 4, 1, 40),
+    'pv_o3': (41, 4, 25, 60),
+    'pv_pm10': (18, 6, 3, 60),
+    'pv_pm25': (8, 2, 2, 25),
+    'pv_so2': (1.2, 0.8, 0.05, 8),
+}
+
+# (name, site) with relative frequency
+CONDITIONS = (
+    ('Otitis externa', 'ear', 10), ('Periodontal disease', 'oral', 9), ('Atopic dermatitis', 'skin', 8),
+    ('Obesity', None, 7), ('Osteoarthritis', 'joint', 6), ('Gastroenteritis', 'gastrointestinal', 6),
+    ('Anal sac impaction', 'anal sac', 4), ('Hypothyroidism', 'endocrine', 3), ('Chronic kidney disease', 'kidney', 2),
+    ('Mitral valve disease', 'heart', 2), ('Diabetes mellitus', 'endocrine', 1), ('Lymphoma', None, 1),
+)
+
+SYMPTOMS = (
+    ('Vomiting', 'gastrointestinal', 8), ('Diarrhea', 'gastrointestinal', 8), ('Itching', 'skin', 9),
+    ('Lethargy', None, 6), ('Coughing', 'respiratory', 4), ('Limping', 'limb', 5), ('Head shaking', 'ear', 5),
+    ('Decreased appetite', None, 5), ('Increased thirst', None, 3), ('Bad breath', 'oral', 4),
+)
+
+# (name, strength, form, weight)
+PRESCRIPTIONS = (
+    ('Apoquel', '16 mg', 'tablet', 6), ('Carprofen', '75 mg', 'tablet', 6), ('Cephalexin', '500 mg', 'capsule', 5),
+    ('Metronidazole', '250 mg', 'tablet', 4), ('Gabapentin', '100 mg', 'capsule', 4), ('Prednisone', '5 mg', 'tablet', 3),
+    ('Levothyroxine', '0.5 mg', 'tablet', 2), ('Cytopoint', '20 mg', 'injection', 3), ('Enalapril', '5 mg', 'tablet', 1),
+)
+
+# (name, prevention_type, interval days, weight)
+PREVENTIONS = (
+    ('Rabies vaccine', 'vaccine', 365, 8), ('DHPP vaccine', 'vaccine', 365, 8), ('Leptospirosis vaccine', 'vaccine', 365, 5),
+    ('Bordetella vaccine', 'vaccine', 365, 5), ('Heartgard Plus', 'heartworm', 30, 6), ('NexGard', 'flea_tick', 30, 6),
+    ('Simparica Trio', 'parasite', 30, 4), ('Bravecto', 'flea_tick', 90, 3),
+)
+
+# panel -> (result name, unit, reference low, reference high)
+LAB_PANELS = {
+    'CBC': (('WBC', 'K/uL', 5.5, 16.9), ('RBC', 'M/uL', 5.5, 8.5), ('HCT', '%', 37.0, 55.0), ('PLT', 'K/uL', 175, 500)),
+    'Chemistry': (('BUN', 'mg/dL', 7, 27), ('CREA', 'mg/dL', 0.5, 1.8), ('ALT', 'U/L', 10, 125), ('GLU', 'mg/dL', 74, 143)),
+    'Thyroid': (('T4', 'ug/dL', 1.0, 4.0),),
+    'Urinalysis': (('USG', '', 1.015, 1.045), ('pH', '', 5.5, 7.5)),
+}
+
+VITALS = (('temperature', 'F', 101.5, 0.8), ('heart_rate', 'bpm', 100, 20), ('respiratory_rate', 'brpm', 24, 6))
+
+# (code, name, category, subcategory, price, weight)
+INVOICE_ITEMS = (
+    ('EXAM', 'Wellness exam', 'exam', 'wellness', 65, 10), ('RAB1', 'Rabies vaccine', 'vaccines', 'core', 28, 5),
+    ('DHPP', 'DHPP vaccine', 'vaccines', 'core', 32, 5), ('LEPTO', 'Leptospirosis vaccine', 'vaccines', 'non-core', 30, 3),
+    ('BORD', 'Bordetella vaccine', 'vaccines', 'non-core', 27, 3), ('HWT', '4Dx heartworm test', 'diagnostics', 'screening', 55, 4),
+    ('CBC', 'CBC', 'diagnostics', 'bloodwork', 75, 3), ('CHEM', 'Chemistry panel', 'diagnostics', 'bloodwork', 110, 3),
+    ('UA', 'Urinalysis', 'diagnostics', 'urine', 48, 2), ('HGP', 'Heartgard Plus 6 pack', 'preventives', 'heartworm', 62, 4),
+    ('NXG', 'NexGard 6 pack', 'preventives', 'flea_tick', 120, 4), ('DENT', 'Dental cleaning', 'dental', 'procedure', 450, 1),
+    ('APQ', 'Apoquel 30 ct', 'medications', 'dermatology', 95, 2), ('CARP', 'Carprofen 60 ct', 'medications', 'pain', 70, 2),
+)
+
+# (service, route, function, message template, http status, weight)
+ERROR_TEMPLATES = (
+    ('api', '/appointments/sync', 'sync_appointments', 'PiMS timeout after {n}s', 504, 12),
+    ('api', '/dogs/<id>/screen', 'screen_dog', 'KeyError: condition {n}', 500, 6),
+    ('worker', None, 'run_batch', 'TaskRun {n} exceeded retries', None, 5),
+    ('api', '/invoices/reconcile', 'reconcile', 'Decimal conversion failed for line {n}', 500, 4),
+    ('web', '/display/<id>', 'load_display', 'Display {n} not found', 404, 8),
+    ('api', '/auth/refresh', 'refresh_token', 'PiMS token refresh rejected ({n})', 401, 3),
+    ('worker', None, 'extract_ehr', 'EHR extraction failed: page {n} unreadable', None, 2),
+)
+
+RELEASES = ('2025.4.1', '2025.5.0', '2025.5.2', '2025.6.0')
+
+TICKET_STATUS_WEIGHTS = (
+    (TicketStatus.open, 0.25), (TicketStatus.in_progress, 0.15), (TicketStatus.waiting_on_customer, 0.08),
+    (TicketStatus.blocked, 0.04), (TicketStatus.resolved, 0.28), (TicketStatus.closed, 0.2),
+)
+
+TICKET_PRIORITY_WEIGHTS = (
+    (TicketPriority.p0, 0.03), (TicketPriority.p1, 0.17), (TicketPriority.p2, 0.55), (TicketPriority.p3, 0.25),
+)
+
+SLA_HOURS = {TicketPriority.p0: 4, TicketPriority.p1: 24, TicketPriority.p2: 72, TicketPriority.p3: 168}
+
+TIMEZONES = ('America/New_York', 'America/Chicago', 'America/Denver', 'America/Los_Angeles')
+
+PIMS = ('ezyvet', 'cornerstone', 'avimark', 'impromed')
+
+
+def group_hash(kind, dog_id, *parts):
+    """sha1 grouping key of one patient record: kind, dog and its identifying fields."""
+    payload = '|'.join([kind, str(dog_id), *('' if p is None else str(p) for p in parts)])
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+def _weights(values):
+    weights = np.asarray(values, dtype=float)
+    return weights / weights.sum()
+
+
+def _pick(rng, table, size, weight_index=-1):
+    """Indices into ``table`` drawn by each entry's weight (its last field by default)."""
+    return rng.choice(len(table), size=size, p=_weights([row[weight_index] for row in table]))
+
+
+def _money(value):
+    return round(float(value), 2)
+
+
+def _distribution(column):
+    spec = DOG_DISTRIBUTIONS.get(column)
+    if spec is not None:
+        return spec
+    for key, spec in DOG_DISTRIBUTIONS.items():
+        if key.endswith('_') and column.startswith(key):
+            return spec
+    return None
+
+
+class SyntheticDataset:
+    """
+    Reproducible synthetic practice group.
+
+    Attributes:
+        seed (int): Base seed; clinic k draws from ``default_rng((seed, k))``.
+        clinics (int): Clinics generated.
+        vets_per_clinic (int): Vets per clinic.
+        dogs_per_vet (int): Mean dogs per vet (Poisson).
+        appointments_per_dog (float): Mean appointments per dog over the history.
+        records_per_dog (float): Mean patient records per dog, spread over the record kinds.
+        errors_per_vet (float): Mean error logs per vet in the last 30 days.
+        tickets_per_vet (float): Mean manual support tickets per vet.
+        missing_rate (float): Share of survey answers left empty.
+        id_offset (int): Added to every integer id, to load next to existing rows.
+        as_of (date): "Today" of the dataset; history runs back ``HISTORY_DAYS``.
+    """
+
+    def __init__(self, seed=0, clinics=1, vets_per_clinic=4, dogs_per_vet=250, appointments_per_dog=6,
+                 records_per_dog=12, errors_per_vet=40, tickets_per_vet=3, missing_rate=0.08,
+                 id_offset=0, as_of=AS_OF, codebook=None):
+        self.seed = seed
+        self.clinics = clinics
+        self.vets_per_clinic = vets_per_clinic
+        self.dogs_per_vet = dogs_per_vet
+        self.appointments_per_dog = appointments_per_dog
+        self.records_per_dog = records_per_dog
+        self.errors_per_vet = errors_per_vet
+        self.tickets_per_vet = tickets_per_vet
+        self.missing_rate = missing_rate
+        self.id_offset = id_offset
+        self.as_of = as_of
+        self._codebook = codebook
+        self._ids = {}
+
+    def _next_ids(self, table, count):
+        start = self._ids.get(table, self.id_offset)
+        self._ids[table] = start + count
+        return np.arange(start + 1, start + count + 1, dtype=np.int64)
+
+    def _date(self, offset):
+        """``as_of`` plus ``offset`` days."""
+        return self.as_of + timedelta(days=int(offset))
+
+    def _days_ago(self, rng, size, max_days=HISTORY_DAYS):
+        """Day offsets (<= 0) spread uniformly over the history."""
+        return -rng.integers(0, max_days + 1, size=size)
+
+    def _codebook_codes(self):
+        """Dog column -> sorted codes from the codebook; empty when ``codebook=False``."""
+        if self._codebook is None:
+            from common_models.codebook import compiled_codebook
+            self._codebook = compiled_codebook()
+        if not self._codebook:
+            return {}
+        return {column: sorted(self._codebook.codes(column).labels) for column in self._codebook.dog_columns()}
+
+    def __iter__(self):
+        return self.iter_clinics()
+
+    def iter_clinics(self):
+        """(clinic index, OrderedDict table name -> rows) per clinic, in order."""
+        self._ids = {}
+        codes = self._codebook_codes()
+        for clinic in range(self.clinics):
+            yield clinic, self.clinic(clinic, codes)
+
+    def clinic(self, index, codes=None):
+        """All rows of clinic ``index``. Only reproducible when clinics are generated in order."""
+        rng = np.random.default_rng((self.seed, index))
+        tables = OrderedDict((name, []) for name in SYNTHETIC_TABLES)
+        vets = self._vets(rng, index, tables)
+        dogs = self._dogs(rng, index, vets, tables, codes if codes is not None else {})
+        appointments = self._appointments(rng, dogs, vets, tables)
+        self._records(rng, dogs, tables)
+        self._billing(rng, appointments, tables)
+        self._errors_and_tickets(rng, vets, dogs, tables)
+        return tables
+
+    def _vets(self, rng, clinic, tables):
+        vet_ids = self._next_ids('vet', self.vets_per_clinic)
+        clinic_name = f'Synthetic Animal Hospital {clinic + 1}'
+        tz = TIMEZONES[clinic % len(TIMEZONES)]
+        lat, lng = 30 + rng.random() * 15, -120 + rng.random() * 45
+        for vet_id in vet_ids.tolist():
+            tables['vet'].append({
+                'vet_id': vet_id, 'vet_email': f'vet{vet_id}@synthetic.test', 'vet_password': 'x' * 60,
+                'clinic': clinic_name, 'clinic_address': f'{100 + clinic} Main St', 'timezone': tz,
+                'lat': round(lat, 6), 'lng': round(lng, 6), 'pims': PIMS[clinic % len(PIMS)], 'integrated': True,
+                'onboarding': 0, 'vet_date_enrolled': datetime.combine(self._date(-HISTORY_DAYS), dt_time(), timezone.utc),
+                'last_login': datetime.combine(self.as_of, dt_time(9), timezone.utc),
+            })
+        environment = {
+            name: float(np.clip(rng.normal(mean, sd), low, high)) for name, (mean, sd, low, high) in ENVIRONMENT.items()
+        }
+        return {'ids': vet_ids, 'lat': lat, 'lng': lng, 'environment': environment}
+
+    def _dogs(self, rng, clinic, vets, tables, codes):
+        n = int(rng.poisson(self.dogs_per_vet * self.vets_per_clinic))
+        dog_ids = self._next_ids('dog', n)
+        # Owners: a household has one to three dogs.
+        household = np.cumsum(rng.random(n) < 0.7)
+        household -= household[0] if n else 0
+        owner_ids = self._next_ids('user', int(household[-1]) + 1 if n else 0)
+        owners = owner_ids[household] if n else owner_ids
+        primary_vet = vets['ids'][rng.integers(0, len(vets['ids']), size=n)]
+
+        breed = _pick(rng, BREEDS, n)
+        mixed = np.array([BREEDS[b][0] == 'Mixed' for b in breed.tolist()], dtype=bool)
+        age = np.clip(rng.gamma(2.2, 3.0, size=n), 0.2, 18).round(1)
+        adult_weight = np.array([BREEDS[b][1] for b in breed.tolist()], dtype=float)
+        growth = np.clip(age / 1.2, 0.25, 1.0)
+        overweight = rng.random(n) < 0.3
+        weight = adult_weight * growth * rng.normal(1.0, 0.12, size=n) * np.where(overweight, 1.2, 1.0)
+        underweight = ~overweight & (rng.random(n) < 0.05)
+        weight = np.clip(np.where(underweight, weight * 0.85, weight), 2, 220).round(1)
+        chronic = rng.random(n) < np.clip(0.08 + 0.035 * age, 0, 0.7)
+        enrolled = self._days_ago(rng, n)
+        female = rng.random(n) < 0.5
+        fixed = rng.random(n) < 0.8
+
+        columns = {}
+        table = Dog.__table__
+        for column in table.columns:
+            name = column.name
+            if not name.startswith(SURVEY_PREFIXES) or name in ('hs_chronic_condition_present',):
+                continue
+            spec = _distribution(name)
+            if spec is None and name in codes:
+                column_rng = np.random.default_rng((self.seed, zlib.crc32(name.encode())))
+                values = codes[name]
+                spec = ('choice', values, column_rng.dirichlet(np.ones(len(values))))
+            if spec is None:
+                if not isinstance(column.type, (Integer, Float, Numeric)):
+                    continue
+                spec = ('choice', (0, 1, 2, 3, 4), (0.3, 0.3, 0.2, 0.12, 0.08))
+            if spec[0] == 'binary':
+                values = (rng.random(n) < spec[1]).astype(np.int64)
+            elif spec[0] == 'choice':
+                values = np.asarray(spec[1])[rng.choice(len(spec[1]), size=n, p=_weights(spec[2]))]
+            else:
+                _, mean, sd, low, high = spec
+                values = np.clip(rng.normal(mean, sd, size=n), low, high).round()
+            values = values.astype(object)
+            values[rng.random(n) < self.missing_rate] = None
+            columns[name] = values
+        columns['hs_chronic_condition_present'] = chronic.astype(np.int64).astype(object)
+        for name, value in vets['environment'].items():
+            if name in table.c:
+                columns[name] = (value * rng.normal(1.0, 0.02, size=n)).round(4).astype(object)
+
+        lifestage = np.select([age < 1, age < 3, age < 7, age < 11], ['Puppy', 'Young adult', 'Mature adult', 'Senior'], 'Geriatric')
+        names = rng.integers(0, len(DOG_NAMES), size=n)
+        streets = rng.integers(0, len(STREETS), size=n)
+        numbers = rng.integers(1, 9999, size=n)
+        lat = vets['lat'] + rng.normal(0, 0.08, size=n)
+        lng = vets['lng'] + rng.normal(0, 0.08, size=n)
+        chips = rng.integers(10 ** 14, 10 ** 15, size=n)
+        dogs = tables['dog']
+        for i, dog_id in enumerate(dog_ids.tolist()):
+            row = {name: values[i] for name, values in columns.items()}
+            row.update({
+                'dog_id': dog_id, 'owner_id': int(owners[i]), 'image_status': 0, 'screen_status': None,
+                'last_screen': None, 'dd_dog_name': DOG_NAMES[names[i]], 'dd_microchip': str(chips[i]),
+                'dd_sex': 'Female' if female[i] else 'Male', 'dd_spayed_or_neutered': int(fixed[i]),
+                'dd_age_years': float(age[i]), 'dd_dob': self._date(-int(age[i] * 365.25)),
+                'dd_lifestage': str(lifestage[i]), 'dd_weight_lbs': float(weight[i]),
+                'is_overweight': bool(overweight[i]), 'is_underweight': bool(underweight[i]),
+                'off_weight_by': round(float(weight[i] - adult_weight[i]), 1),
+                'breed': BREEDS[breed[i]][0], 'dd_breed_pure_or_mixed': 2 if mixed[i] else 1,
+                'address': f'{numbers[i]} {STREETS[streets[i]]}',
+                'lat': round(float(lat[i]), 6), 'lng': round(float(lng[i]), 6),
+                'status': 'active', 'date_enrolled': self._date(enrolled[i]),
+                'source_id': f'syn-dog-{dog_id}', 'origin': 'synthetic',
+            })
+            dogs.append(row)
+        for owner_id in owner_ids.tolist():
+            tables['user'].append({
+                'id': owner_id, 'email': f'owner{owner_id}@synthetic.test', 'name': f'Owner{owner_id}',
+                'last_name': 'Synthetic',
+            })
+        tables['dog_vet'].extend(
+            {'dog_id': dog_id, 'vet_id': vet_id} for dog_id, vet_id in zip(dog_ids.tolist(), primary_vet.tolist())
+        )
+        return {'ids': dog_ids, 'owners': owners, 'vet': primary_vet, 'enrolled': enrolled, 'age': age, 'weight': weight}
+
+    def _appointments(self, rng, dogs, vets, tables):
+        counts = rng.poisson(self.appointments_per_dog, size=len(dogs['ids'])) + 1
+        index = np.repeat(np.arange(len(dogs['ids'])), counts)
+        n = len(index)
+        ids = self._next_ids('appointments', n)
+        # Most visits are with the dog's own vet; about a third of the rest is in the next 30 days.
+        other = rng.random(n) < 0.1
+        vet = np.where(other, vets['ids'][rng.integers(0, len(vets['ids']), size=n)], dogs['vet'][index])
+        days = np.where(rng.random(n) < 0.05, rng.integers(1, 31, size=n), self._days_ago(rng, n))
+        hour = rng.integers(8, 18, size=n)
+        minute = rng.choice((0, 15, 30, 45), size=n)
+        duration = rng.choice((15, 30, 30, 30, 45, 60), size=n)
+        status = np.where(
+            days > 0, 'Booked',
+            np.asarray(('Completed', 'Cancelled', 'No Show'))[rng.choice(3, size=n, p=(0.88, 0.07, 0.05))],
+        )
+        rows = tables['appointments']
+        for i, appointment_id in enumerate(ids.tolist()):
+            start = datetime.combine(self._date(days[i]), dt_time(int(hour[i]), int(minute[i])), timezone.utc)
+            rows.append({
+                'appointment_id': appointment_id, 'appointment_pims_id': f'syn-appt-{appointment_id}',
+                'vet_id': int(vet[i]), 'dog_id': int(dogs['ids'][index[i]]), 'owner_id': int(dogs['owners'][index[i]]),
+                'created': start.date() - timedelta(days=14), 'updated': start.date(),
+                'status': str(status[i]), 'trackingStatus': 'checked_out' if status[i] == 'Completed' else 'scheduled',
+                'startTime': start, 'duration': int(duration[i]), 'notes': None, 'is_pointer_appt': False,
+            })
+        return rows
+
+    def _records(self, rng, dogs, tables):
+        n = len(dogs['ids'])
+        # Share of ``records_per_dog`` per kind; older dogs have more history.
+        share = {'diagnoses': 0.2, 'symptoms': 0.2, 'prescriptions': 0.15, 'preventions': 0.25,
+                 'diagnostics': 0.08, 'weights': 0.07, 'vitals': 0.05}
+        scale = np.clip(dogs['age'] / 6, 0.3, 2.0)
+
+        def draw(kind):
+            counts = rng.poisson(self.records_per_dog * share[kind] * scale)
+            index = np.repeat(np.arange(n), counts)
+            return index, self._days_ago(rng, len(index))
+
+        index, days = draw('diagnoses')
+        picks = _pick(rng, CONDITIONS, len(index))
+        resolved = rng.random(len(index)) < 0.55
+        for i, record_id in enumerate(self._next_ids('patient_diagnoses', len(index)).tolist()):
+            dog_id = int(dogs['ids'][index[i]])
+            name, site, _ = CONDITIONS[picks[i]]
+            on = self._date(days[i])
+            tables['patient_diagnoses'].append({
+                'diagnosis_id': record_id, 'dog_id': dog_id, 'condition_name': name, 'condition_site': site,
+                'diagnosis_date': on, 'diagnosis_end': on + timedelta(days=21) if resolved[i] else None,
+                'clinical_status': 'resolved' if resolved[i] else 'active', 'source': 'synthetic',
+                'group_hash': group_hash('diagnosis', dog_id, name, on),
+            })
+
+        index, days = draw('symptoms')
+        picks = _pick(rng, SYMPTOMS, len(index))
+        lengths = rng.integers(1, 15, size=len(index))
+        for i, record_id in enumerate(self._next_ids('patient_symptoms', len(index)).tolist()):
+            dog_id = int(dogs['ids'][index[i]])
+            name, site, _ = SYMPTOMS[picks[i]]
+            on = self._date(days[i])
+            tables['patient_symptoms'].append({
+                'symptom_entry_id': record_id, 'dog_id': dog_id, 'symptom_name': name, 'symptom_site': site,
+                'symptom_start': on, 'symptom_end': on + timedelta(days=int(lengths[i])),
+                'duration_days': int(lengths[i]), 'clinical_status': 'resolved', 'source': 'synthetic',
+                'group_hash': group_hash('symptom', dog_id, name, on),
+            })
+
+        index, days = draw('prescriptions')
+        picks = _pick(rng, PRESCRIPTIONS, len(index))
+        for i, record_id in enumerate(self._next_ids('patient_prescriptions', len(index)).tolist()):
+            dog_id = int(dogs['ids'][index[i]])
+            name, strength, form, _ = PRESCRIPTIONS[picks[i]]
+            on = self._date(days[i])
+            tables['patient_prescriptions'].append({
+                'id': record_id, 'dog_id': dog_id, 'name': name, 'strength': strength, 'form': form,
+                'dosage': '1 ' + form, 'start_date': on, 'end_date': on + timedelta(days=30),
+                'duration': '30 days', 'status': 'completed' if days[i] < -30 else 'active',
+                'group_hash': group_hash('prescription', dog_id, name, strength, on),
+            })
+
+        index, days = draw('preventions')
+        picks = _pick(rng, PREVENTIONS, len(index))
+        for i, record_id in enumerate(self._next_ids('patient_preventions', len(index)).tolist()):
+            dog_id = int(dogs['ids'][index[i]])
+            name, kind, interval, _ = PREVENTIONS[picks[i]]
+            on = self._date(days[i])
+            due = on + timedelta(days=interval)
+            tables['patient_preventions'].append({
+                'record_id': record_id, 'dog_id': dog_id, 'name': name, 'prevention_type': kind,
+                'source': 'synthetic', 'administered_date': on, 'due_date': due,
+                'duration': f'{interval} days', 'status': 'Overdue' if due < self.as_of else 'Administered',
+                'group_hash': group_hash('prevention', dog_id, name, on),
+            })
+
+        index, days = draw('diagnostics')
+        panels = list(LAB_PANELS)
+        picks = rng.integers(0, len(panels), size=len(index))
+        for i, diagnostic_id in enumerate(self._next_ids('patient_diagnostics', len(index)).tolist()):
+            dog_id = int(dogs['ids'][index[i]])
+            panel = panels[picks[i]]
+            on = self._date(days[i])
+            results = LAB_PANELS[panel]
+            result_ids = self._next_ids('patient_lab_results', len(results)).tolist()
+            # Values mostly inside the reference range, with a tail on either side.
+            values = rng.normal(0.5, 0.3, size=len(results))
+            abnormal_any = False
+            for result_id, (result, uom, low, high), value in zip(result_ids, results, values.tolist()):
+                abnormal = value < 0 or value > 1
+                abnormal_any |= abnormal
+                tables['patient_lab_results'].append({
+                    'lab_result_id': result_id, 'diagnostic_id': diagnostic_id, 'dog_id': dog_id,
+                    'result_name': result, 'result_value': f'{low + value * (high - low):.3g}', 'uom': uom,
+                    'reference_low': str(low), 'reference_high': str(high), 'reference_range': f'{low}-{high}',
+                    'indicator': 'Low' if value < 0 else 'High' if value > 1 else 'Normal',
+                    'is_abnormal': abnormal, 'date': on,
+                    'group_hash': group_hash('lab_result', dog_id, panel, result, on),
+                })
+            tables['patient_diagnostics'].append({
+                'diagnostic_id': diagnostic_id, 'dog_id': dog_id, 'diagnostic_type': 'lab', 'source': 'synthetic',
+                'name': panel, 'laboratory': 'In-house', 'status': 'completed',
+                'result': 'abnormal' if abnormal_any else 'negative', 'diagnostic_date': on,
+                'is_abnormal': abnormal_any, 'group_hash': group_hash('diagnostic', dog_id, panel, on),
+            })
+
+        index, days = draw('weights')
+        drift = rng.normal(1.0, 0.05, size=len(index))
+        for i, record_id in enumerate(self._next_ids('weights', len(index)).tolist()):
+            tables['weights'].append({
+                'id': record_id, 'dog_id': int(dogs['ids'][index[i]]),
+                'weight': round(float(dogs['weight'][index[i]] * drift[i]), 1), 'record_date': self._date(days[i]),
+            })
+
+        index, days = draw('vitals')
+        picks = rng.integers(0, len(VITALS), size=len(index))
+        noise = rng.normal(0, 1, size=len(index))
+        for i, record_id in enumerate(self._next_ids('patient_vitals', len(index)).tolist()):
+            kind, uom, mean, sd = VITALS[picks[i]]
+            value = mean + sd * noise[i]
+            tables['patient_vitals'].append({
+                'id': record_id, 'dog_id': int(dogs['ids'][index[i]]), 'type': kind, 'value': f'{value:.1f}',
+                'uom': uom, 'indicator': 'Normal' if abs(noise[i]) < 2 else 'Abnormal', 'record_date': self._date(days[i]),
+            })
+
+    def _billing(self, rng, appointments, tables):
+        """Interventions recommended at completed visits, the invoices that bill them and the links between."""
+        completed = [a for a in appointments if a['status'] == 'Completed']
+        n = len(completed)
+        recommended = rng.random(n) < 0.6
+        invoiced = rng.random(n) < 0.85
+        intervention_ids = iter(self._next_ids('patient_interventions', int(recommended.sum())).tolist())
+        states = np.asarray(('selected', 'declined', 'discussed', 'not_selected'))
+        for i, appointment in enumerate(completed):
+            appointment_id, vet_id, dog_id = appointment['appointment_id'], appointment['vet_id'], appointment['dog_id']
+            start = appointment['startTime']
+            facts = []
+            if recommended[i]:
+                intervention_id = next(intervention_ids)
+                items = _pick(rng, INVOICE_ITEMS, int(rng.integers(1, 5)))
+                tables['patient_interventions'].append({
+                    'id': intervention_id, 'vet_id': vet_id, 'dog_id': dog_id, 'appointment_id': appointment_id,
+                    'status': 'completed', 'date': start,
+                    'data': {'interventions': [INVOICE_ITEMS[k][1] for k in items.tolist()]},
+                })
+                state = states[rng.choice(4, size=len(items), p=(0.55, 0.2, 0.1, 0.15))]
+                for k, fact_id, fact_state in zip(items.tolist(), self._next_ids('intervention_fact', len(items)).tolist(), state.tolist()):
+                    code, name, category, subcategory, price, _ = INVOICE_ITEMS[k]
+                    facts.append((k, {
+                        'fact_id': fact_id, 'appointment_id': appointment_id, 'vet_id': vet_id, 'dog_id': str(dog_id),
+                        'appt_date': start, 'name': name, 'category': category, 'subcategory': subcategory,
+                        'selected': fact_state == 'selected', 'product_name': name, 'compliance_state': fact_state,
+                        'patient_intervention_id': intervention_id, 'created_ts': start,
+                        'matched_invoice_id': None, 'matched_line_id': None, 'matched_amount': None, 'match_score': None,
+                    }))
+            tables['intervention_fact'].extend(fact for _, fact in facts)
+            if not invoiced[i]:
+                continue
+
+            invoice_id = f'syn-inv-{appointment_id}'
+            lines = [(fact, k) for k, fact in facts if fact['selected']]
+            lines += [(None, k) for k in _pick(rng, INVOICE_ITEMS, int(rng.poisson(1.5)) + 1).tolist()]
+            total = attributed = 0.0
+            for number, (fact, k) in enumerate(lines):
+                code, name, category, subcategory, price, _ = INVOICE_ITEMS[k]
+                line_id = f'{invoice_id}-{number + 1}'
+                amount = _money(price * rng.normal(1.0, 0.05))
+                declined = fact is None and rng.random() < 0.04
+                total += 0 if declined else amount
+                if fact is not None:
+                    attributed += amount
+                    fact.update(matched_invoice_id=invoice_id, matched_line_id=line_id, matched_amount=amount,
+                                match_score=round(float(rng.uniform(0.8, 1.0)), 2))
+                tables['invoice_line_fact'].append({
+                    'line_id': line_id, 'vet_id': vet_id, 'dog_id': dog_id, 'client_id': str(appointment['owner_id']),
+                    'invoice_id': invoice_id, 'line_source_id': line_id, 'line_type': 'item', 'code_id': code,
+                    'code_name': name, 'description': name, 'line_date': start, 'quantity': 1,
+                    'line_amount': amount, 'discount_amount': 0, 'fee_amount': 0, 'is_posted': True,
+                    'is_declined': declined, 'reco_name': fact['name'] if fact else None,
+                    'reco_category': category if fact else None, 'reco_subcategory': subcategory if fact else None,
+                    'match_tier': 1 if fact else None, 'match_score': fact['match_score'] if fact else None,
+                    'attributed_to_ptr': fact is not None, 'category_name': category,
+                    'reco_appt_id': appointment_id if fact else None, 'created_ts': start, 'updated_ts': start,
+                })
+            tables['invoice_header_fact'].append({
+                'invoice_id': invoice_id, 'vet_id': vet_id, 'dog_id': dog_id, 'client_id': str(appointment['owner_id']),
+                'patient_id': str(dog_id), 'number': str(appointment_id), 'invoice_date': start.date(),
+                'created_ts': start, 'updated_ts': start, 'is_open': False, 'total_amount': _money(total),
+                'tax_amount': _money(total * 0.07), 'currency': 'USD', 'is_deleted': False,
+            })
+            tables['appt_invoice_link'].append({
+                'vet_id': vet_id, 'appointment_id': appointment_id, 'invoice_id': invoice_id,
+                'link_type': 'same_day', 'attribution_win': 'ptr' if attributed else 'none', 'linked_ts': start,
+                'pr_amount': _money(attributed), 'rr_amount': 0, 'line_count': len(lines),
+                'matched_count': sum(1 for fact, _ in lines if fact is not None),
+            })
+
+    def _errors_and_tickets(self, rng, vets, dogs, tables):
+        n = int(rng.poisson(self.errors_per_vet * len(vets['ids'])))
+        templates = _pick(rng, ERROR_TEMPLATES, n)
+        ids = self._next_ids('error_logs', n).tolist()
+        seconds = rng.integers(0, 30 * 86400, size=n)
+        vet = vets['ids'][rng.integers(0, len(vets['ids']), size=n)]
+        dog = rng.integers(0, max(len(dogs['ids']), 1), size=n)
+        params = rng.integers(1, 500, size=n)
+        latency = rng.lognormal(5.5, 0.8, size=n).astype(int)
+        release = rng.integers(0, len(RELEASES), size=n)
+        end = datetime.combine(self.as_of, dt_time(), timezone.utc)
+        by_fingerprint = OrderedDict()
+        titles = {}
+        for i, error_id in enumerate(ids):
+            service, route, function, template, status, _ = ERROR_TEMPLATES[templates[i]]
+            fingerprint = hashlib.sha1(f'{service}|{function}|{template}'.encode()).hexdigest()
+            created = end - timedelta(seconds=int(seconds[i]))
+            by_fingerprint.setdefault(fingerprint, []).append((error_id, created, int(vet[i])))
+            titles[fingerprint] = f'{function}: {template}'
+            tables['error_logs'].append({
+                'id': error_id, 'created_at': created, 'level': 'ERROR' if status != 404 else 'WARNING',
+                'message': template.format(n=int(params[i])), 'message_template': template,
+                'message_params': {'n': int(params[i])}, 'environment': 'prod', 'service': service,
+                'release_version': RELEASES[release[i]], 'route': route, 'function_name': function,
+                'http_method': 'POST' if route else None, 'http_status': status,
+                'latency_ms': int(latency[i]), 'request_id': f'{error_id:016x}',
+                'vet_id': int(vet[i]),
+                'dog_id': int(dogs['ids'][dog[i]]) if route and '<id>' in route and len(dogs['ids']) else None,
+                'fingerprint': fingerprint, 'tags': {'synthetic': True}, 'silenced': False,
+            })
+
+        # One auto ticket per recurring fingerprint, plus manual support tickets.
+        specs = [
+            (TicketSource.auto_error, TicketType.bug, errors[0][2], errors[0][1], titles[fingerprint], errors)
+            for fingerprint, errors in by_fingerprint.items() if len(errors) >= 3 and rng.random() < 0.5
+        ]
+        for _ in range(int(rng.poisson(self.tickets_per_vet * len(vets['ids'])))):
+            created = end - timedelta(seconds=int(rng.integers(0, 90 * 86400)))
+            vet_id = int(vets['ids'][rng.integers(0, len(vets['ids']))])
+            specs.append((TicketSource.manual, TicketType.support, vet_id, created, f'Support request from vet {vet_id}', ()))
+        ticket_ids = self._next_ids('tickets', len(specs)).tolist()
+        statuses = [s for s, _ in TICKET_STATUS_WEIGHTS]
+        priorities = [p for p, _ in TICKET_PRIORITY_WEIGHTS]
+        status_picks = rng.choice(len(statuses), size=len(specs), p=_weights([w for _, w in TICKET_STATUS_WEIGHTS]))
+        priority_picks = rng.choice(len(priorities), size=len(specs), p=_weights([w for _, w in TICKET_PRIORITY_WEIGHTS]))
+        for ticket_id, (source, kind, vet_id, created, title, errors), s, p in zip(ticket_ids, specs, status_picks, priority_picks):
+            status, priority = statuses[s], priorities[p]
+            done = status in (TicketStatus.resolved, TicketStatus.closed)
+            responded = created + timedelta(hours=float(rng.exponential(SLA_HOURS[priority] / 3)))
+            tables['tickets'].append({
+                'id': ticket_id, 'short_code': ticket_id, 'created_at': created, 'updated_at': responded,
+                'type': kind, 'source': source, 'status': status, 'priority': priority,
+                'title': title, 'summary': None, 'team': 'platform' if errors else 'support', 'vet_id': vet_id,
+                'sla_deadline_at': created + timedelta(hours=SLA_HOURS[priority]),
+                'first_response_at': responded if status != TicketStatus.open else None,
+                'resolved_at': responded + timedelta(hours=float(rng.exponential(48))) if done else None,
+                'resolution_category': 'bugfix' if done and errors else 'education' if done else None,
+            })
+            for error_id, _, _ in errors[:5]:
+                tables['ticket_linked_signals'].append({
+                    'ticket_id': ticket_id, 'signal_type': SignalType.error, 'signal_id': error_id,
+                    'link_type': LinkType.evidence, 'created_at': created,
+                })
+            tables['ticket_events'].append({
+                'ticket_id': ticket_id, 'ts': created, 'event_type': 'created', 'payload': {'source': source.value},
+            })
+            if status != TicketStatus.open:
+                tables['ticket_events'].append({
+                    'ticket_id': ticket_id, 'ts': responded, 'event_type': 'status_changed',
+                    'payload': {'from': 'open', 'to': status.value},
+                })
+
+
+def _advance_sequences(tables):
+    """On Postgres, move serial sequences past the loaded ids so later inserts do not collide."""
+    connection = db.session.connection()
+    if connection.dialect.name != 'postgresql':
+        return
+    for table in tables:
+        pk = list(table.primary_key.columns)
+        if len(pk) != 1 or not isinstance(pk[0].type, Integer):
+            continue
+        connection.execute(text(
+            f"SELECT setval(pg_get_serial_sequence('{table.name}', '{pk[0].name}'), "
+            f"(SELECT COALESCE(MAX({pk[0].name}), 1) FROM {table.name}))"
+        ))
+    connection.execute(text(
+        "SELECT setval('ticket_short_code_seq', (SELECT COALESCE(MAX(short_code), 1) FROM tickets))"
+    ))
+
+
+def load_synthetic(dataset, batch_size=5000, tables=None):
+    """
+    Insert ``dataset`` clinic by clinic, committing after each clinic.
+
+    Args:
+        dataset (SyntheticDataset): What to load.
+        batch_size (int): Rows per insert statement.
+        tables (iterable): Only load these tables (they and their parents must exist).
+
+    Returns:
+        dict: ``rows`` per table, ``clinics``, ``ms`` and ``rows_per_s``.
+    """
+    wanted = set(tables) if tables is not None else set(SYNTHETIC_TABLES)
+    metadata = db.metadata.tables
+    counts = OrderedDict((name, 0) for name in SYNTHETIC_TABLES if name in wanted)
+    start = time.perf_counter()
+    clinics = 0
+    try:
+        for _, rows_by_table in dataset.iter_clinics():
+            for name, rows in rows_by_table.items():
+                if name not in wanted or not rows:
+                    continue
+                table = metadata[name]
+                # executemany takes its column list from the first row: every row of a table has the same keys.
+                for i in range(0, len(rows), batch_size):
+                    db.session.execute(insert(table), rows[i:i + batch_size])
+                counts[name] += len(rows)
+            db.session.commit()
+            clinics += 1
+        _advance_sequences([metadata[name] for name in counts])
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    elapsed = time.perf_counter() - start
+    total = sum(counts.values())
+    return {
+        'rows': dict(counts), 'clinics': clinics, 'ms': int(elapsed * 1000),
+        'rows_per_s': int(total / elapsed) if elapsed else 0,
+    }
+
+
+def synthetic_dog_ids(limit=None):
+    """Ids of loaded synthetic dogs, in id order."""
+    stmt = select(Dog.dog_id).where(Dog.origin == 'synthetic').order_by(Dog.dog_id)
+    if limit is not None:
+        stmt = stmt.limit(limit)
+    return db.session.execute(stmt).scalars().all()
@@ -0,0 +1,274 @@
+"""
+Vet-scoped tenant guard for ORM queries.
+
+Once ``enable_tenant_guard`` is installed, every ORM ``SELECT`` (and bulk
+``UPDATE`` / ``DELETE``) run inside ``tenant_scope(vet_id)`` gets tenant
+criteria added to each scoped model it touches, including joined and
+relationship-loaded ones:
+
+    models with ``vet_id``   vet_id = :vet_id                 (ix_<table>_vet_id)
+    models with ``dog_id``   dog_id IN (the vet's dog ids)    (ix_<table>_dog_id)
+    ``Dog``                  dog_id IN (the vet's dog ids)    (primary key)
+
+Criteria are plain column comparisons against constants, not correlated
+subqueries, so the planner can use the per-table index. A vet's dogs are those
+linked through ``dog_vet`` or with an appointment at the vet; the set is cached
+per vet, dropped once changes to the vet's links or appointments commit through
+the ORM, and reloaded after ``max_age`` seconds to pick up writes from other
+processes.
+
+Core statements on tables (``select(Model.__table__)``) and raw SQL are not
+scoped. Pass ``execution_options(skip_tenant_scope=True)`` for deliberate
+cross-tenant ORM queries.
+
+Usage:
+
+    from common_models.tenancy import enable_tenant_guard, tenant_scope
+
+    enable_tenant_guard()                         # once, at app start-up
+
+    with tenant_scope(current_vet_id):
+        PatientDiagnoses.query.filter_by(condition_id=7).all()   # only this vet's dogs
+"""
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from sqlalchemy import Integer, event, inspect, select, text, union
+from sqlalchemy.orm import Session, object_session, with_loader_criteria
+
+from common_models.db import db
+from common_models.models import Appointments, Dog, dog_vet_association
+
+_INFO_VET = 'tenant_vet_id'
+_INFO_PENDING = '_tenant_dog_changes'
+
+# Infrastructure tables that carry dog_id / vet_id but are read across tenants.
+EXEMPT_TABLES = ('change_events', 'change_feed_offsets', 'aggregate_watermarks', 'audit_log', 'task_runs')
+
+
+def scoped_models(exempt=EXEMPT_TABLES):
+    """
+    Mapped classes that get tenant criteria.
+
+    Returns:
+        dict: class -> 'vet' (filtered on vet_id) or 'dog' (filtered on dog_id).
+    """
+    scopes = {}
+    for mapper in db.Model.registry.mappers:
+        table = mapper.local_table
+        if table is None or table.name in exempt:
+            continue
+        columns = table.c
+        if 'vet_id' in columns:
+            scopes[mapper.class_] = 'vet'
+        elif 'dog_id' in columns and isinstance(columns['dog_id'].type, Integer):
+            scopes[mapper.class_] = 'dog'
+    return scopes
+
+
+class TenantDogCache:
+    """
+    Per-vet dog id sets, least recently used evicted first.
+
+    Attributes:
+        max_vets (int): Vets kept in memory.
+        max_age (float): Seconds before a vet's set is reloaded.
+    """
+
+    def __init__(self, max_vets=500, max_age=300.0):
+        self.max_vets = max_vets
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._sets = OrderedDict()
+
+    @staticmethod
+    def load(vet_id):
+        """The vet's dog ids from ``dog_vet`` and ``appointments``, in one query."""
+        linked = select(dog_vet_association.c.dog_id).where(dog_vet_association.c.vet_id == vet_id)
+        booked = select(Appointments.__table__.c.dog_id).where(Appointments.__table__.c.vet_id == vet_id)
+        rows = db.session.execute(
+            union(linked, booked), execution_options={'skip_tenant_scope': True}
+        ).scalars()
+        return tuple(sorted(rows))
+
+    def get(self, vet_id):
+        now = time.monotonic()
+        with self._lock:
+            cached = self._sets.get(vet_id)
+            if cached is not None and now - cached[0] < self.max_age:
+                self._sets.move_to_end(vet_id)
+                return cached[1]
+        dog_ids = self.load(vet_id)
+        with self._lock:
+            self._sets[vet_id] = (now, dog_ids)
+            self._sets.move_to_end(vet_id)
+            while len(self._sets) > self.max_vets:
+                self._sets.popitem(last=False)
+        return dog_ids
+
+    def invalidate(self, vet_id=None):
+        with self._lock:
+            if vet_id is None:
+                self._sets.clear()
+            else:
+                self._sets.pop(vet_id, None)
+
+    # Changed vets wait on the session until commit: ``load`` is a Core query
+    # without autoflush, so evicting earlier would re-cache the old set.
+
+    @staticmethod
+    def _queue(session, vet_ids):
+        session.info.setdefault(_INFO_PENDING, set()).update(v for v in vet_ids if v is not None)
+
+    def _on_appointment(self, mapper, connection, target):
+        session = object_session(target)
+        if session is not None:
+            # An appointment moved to another vet leaves the old vet's set too.
+            self._queue(session, [target.vet_id, *inspect(target).attrs.vet_id.history.deleted])
+
+    def _after_flush(self, session, flush_context):
+        # Dog.vets changes are written to dog_vet by this flush; history is still intact here.
+        for obj in (*session.new, *session.dirty, *session.deleted):
+            if isinstance(obj, Dog):
+                history = inspect(obj).attrs.vets.history
+                self._queue(session, [getattr(vet, 'vet_id', None) for vet in (*history.added, *history.deleted)])
+
+
+tenant_dog_cache = TenantDogCache()
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_pending(session):
+    for vet_id in session.info.pop(_INFO_PENDING, ()):
+        tenant_dog_cache.invalidate(vet_id)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _drop_pending(session, previous_transaction):
+    session.info.pop(_INFO_PENDING, None)
+
+
+event.listen(Appointments, 'after_insert', tenant_dog_cache._on_appointment)
+event.listen(Appointments, 'after_update', tenant_dog_cache._on_appointment)
+event.listen(Appointments, 'after_delete', tenant_dog_cache._on_appointment)
+event.listen(Session, 'after_flush', tenant_dog_cache._after_flush)
+
+
+def tenant_dog_ids(vet_id):
+    """Cached dog ids of ``vet_id``."""
+    return tenant_dog_cache.get(vet_id)
+
+
+class TenantGuard:
+    """
+    ``do_orm_execute`` hook adding tenant criteria for the session's current vet.
+
+    Attributes:
+        scopes (dict): class -> 'vet' | 'dog', from ``scoped_models``.
+    """
+
+    def __init__(self, scopes=None):
+        self.scopes = scopes if scopes is not None else scoped_models()
+
+    def criteria(self, vet_id):
+        """Loader criteria options for ``vet_id``."""
+        options = []
+        dog_ids = None
+        for cls, scope in self.scopes.items():
+            if scope == 'vet':
+                options.append(with_loader_criteria(cls, lambda c: c.vet_id == vet_id, include_aliases=True))
+            else:
+                if dog_ids is None:
+                    dog_ids = tenant_dog_ids(vet_id)
+                options.append(with_loader_criteria(cls, lambda c: c.dog_id.in_(dog_ids), include_aliases=True))
+        return options
+
+    def do_orm_execute(self, state):
+        vet_id = state.session.info.get(_INFO_VET)
+        if vet_id is None or state.execution_options.get('skip_tenant_scope'):
+            return
+        # Column loads refresh objects that were already scoped when first loaded.
+        if state.is_column_load or not (state.is_select or state.is_update or state.is_delete):
+            return
+        state.statement = state.statement.options(*self.criteria(vet_id))
+
+    def install(self, target):
+        event.listen(target, 'do_orm_execute', self.do_orm_execute)
+        return self
+
+
+_guard = None
+
+
+def enable_tenant_guard(target=None, scopes=None):
+    """
+    Start scoping ORM queries on ``target`` (defaults to ``db.session``). Idempotent.
+
+    Returns:
+        TenantGuard: The installed guard.
+    """
+    global _guard
+    if _guard is None:
+        _guard = TenantGuard(scopes).install(target if target is not None else db.session)
+    return _guard
+
+
+@contextmanager
+def tenant_scope(vet_id, session=None):
+    """Scope ORM queries on ``session`` (default ``db.session``) to ``vet_id`` for the block."""
+    session = session if session is not None else db.session
+    previous = session.info.get(_INFO_VET)
+    session.info[_INFO_VET] = vet_id
+    try:
+        yield
+    finally:
+        if previous is None:
+            session.info.pop(_INFO_VET, None)
+        else:
+            session.info[_INFO_VET] = previous
+
+
+def current_tenant(session=None):
+    return (session if session is not None else db.session).info.get(_INFO_VET)
+
+
+def benchmark_tenant_queries(vet_id, models=None, repeat=5, limit=100):
+    """
+    Time a scoped ``SELECT`` per model and, on Postgres, check its plan for index use.
+
+    Args:
+        models (iterable): Classes to benchmark; every scoped model if None.
+        repeat (int): Runs per model; the median is reported.
+
+    Returns:
+        list: Dicts with ``table``, ``scope``, ``rows``, ``median_ms`` and
+        ``uses_index`` (None off Postgres), slowest first.
+    """
+    guard = _guard or TenantGuard()
+    scopes = guard.scopes if models is None else {cls: guard.scopes[cls] for cls in models}
+    postgres = db.session.get_bind().dialect.name == 'postgresql'
+    report = []
+    for cls, scope in scopes.items():
+        stmt = select(cls).limit(limit)
+        timings = []
+        rows = 0
+        with tenant_scope(vet_id):
+            for _ in range(repeat):
+                start = time.perf_counter()
+                rows = len(db.session.execute(stmt).scalars().all())
+                timings.append((time.perf_counter() - start) * 1000)
+        uses_index = None
+        if postgres:
+            sql = stmt.options(*guard.criteria(vet_id)).compile(
+                dialect=db.session.get_bind().dialect, compile_kwargs={'literal_binds': True}
+            )
+            plan = '\n'.join(db.session.execute(text(f'EXPLAIN {sql}')).scalars())
+            uses_index = 'Index' in plan and f'Seq Scan on {cls.__table__.name} ' not in plan + ' '
+        timings.sort()
+        report.append({
+            'table': cls.__table__.name, 'scope': scope, 'rows': rows,
+            'median_ms': round(timings[len(timings) // 2], 3), 'uses_index': uses_index,
+        })
+    return sorted(report, key=lambda r: -r['median_ms'])
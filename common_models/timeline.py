@@ -0,0 +1,212 @@
+"""
+Materialized patient timeline.
+
+Every dated record of the sources in ``TIMELINE_SOURCES`` has one
+``PatientTimeline`` row (date, kind, ref_id, one-line summary). A dog's
+timeline is then one range scan of the covering ``(dog_id, date, id)`` index,
+read newest first with keyset pagination, instead of ten queries merged and
+sorted in Python.
+
+The table is kept current from the ``change_events`` outbox: the
+``patient_timeline`` consumer re-reads the source rows named by a batch of
+events, one query per source table, and upserts or deletes their timeline rows.
+Bulk writers that bypass the session (coverage, episodes, prescription and lab
+backfills) emit their events with ``emit_change_events``, so they reach it too.
+``rebuild_timeline`` backfills or repairs whole dogs.
+
+Usage:
+
+    from common_models.timeline import apply_timeline_events, timeline_consumer, timeline_page
+
+    timeline_consumer().consume(apply_timeline_events)   # from a worker loop
+
+    rows, cursor = timeline_page(dog_id, limit=50)
+    more, cursor = timeline_page(dog_id, limit=50, before=cursor)
+"""
+import time
+from datetime import datetime
+
+from sqlalchemy import delete, func, insert, select, tuple_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from common_models.changes import ChangeFeedConsumer
+from common_models.db import db
+from common_models.models import (
+    Appointments, PatientAlerts, PatientDiagnoses, PatientDiagnostics, PatientLabResult,
+    PatientPreventions, PatientPrescriptions, PatientSymptoms, PatientTimeline, PatientVitals, Weights,
+)
+
+SUMMARY_LENGTH = 500
+
+# kind -> (model, primary key, date columns in order of preference, summary columns)
+TIMELINE_SOURCES = {
+    'appointment': (Appointments, 'appointment_id', ('startTime',), ('status', 'notes')),
+    'diagnosis': (PatientDiagnoses, 'diagnosis_id', ('diagnosis_date',), ('condition_name', 'clinical_status')),
+    'symptom': (PatientSymptoms, 'symptom_entry_id', ('symptom_start',), ('symptom_name', 'symptom_severity')),
+    'prescription': (PatientPrescriptions, 'id', ('start_date',), ('name', 'strength', 'status')),
+    'prevention': (PatientPreventions, 'record_id', ('administered_date', 'due_date'), ('name', 'status')),
+    'diagnostic': (PatientDiagnostics, 'diagnostic_id', ('diagnostic_date',), ('name', 'diagnostic_type', 'result')),
+    'lab_result': (PatientLabResult, 'lab_result_id', ('date',), ('result_name', 'result_value', 'uom', 'indicator')),
+    'weight': (Weights, 'id', ('record_date',), ('weight',)),
+    'vital': (PatientVitals, 'id', ('record_date',), ('type', 'value', 'uom')),
+    'alert': (PatientAlerts, 'alert_id', ('alert_date',), ('alert_type', 'message')),
+}
+
+TIMELINE_TABLES = {spec[0].__tablename__: kind for kind, spec in TIMELINE_SOURCES.items()}
+
+CONSUMER_NAME = 'patient_timeline'
+
+
+def _summary(values):
+    text = ' · '.join(str(v).strip() for v in values if v is not None and str(v).strip())
+    return text[:SUMMARY_LENGTH] or None
+
+
+def _source_rows(kind, where):
+    """Timeline rows for the dated source records of ``kind`` matching ``where``."""
+    model, pk, date_columns, summary_columns = TIMELINE_SOURCES[kind]
+    table = model.__table__
+    columns = [table.c[pk], table.c.dog_id, *[table.c[c] for c in date_columns],
+               *[table.c[c] for c in summary_columns]]
+    rows = []
+    for record in db.session.execute(select(*columns).where(where)).all():
+        ref_id, dog_id = record[0], record[1]
+        dates = record[2:2 + len(date_columns)]
+        day = next((d for d in dates if d is not None), None)
+        if day is None:
+            continue
+        if isinstance(day, datetime):
+            day = day.date()
+        rows.append({
+            'dog_id': dog_id, 'date': day, 'kind': kind, 'ref_id': ref_id,
+            'summary': _summary(record[2 + len(date_columns):]),
+        })
+    return rows
+
+
+def _upsert(rows):
+    if not rows:
+        return
+    table = PatientTimeline.__table__
+    if db.session.get_bind().dialect.name == 'postgresql':
+        stmt = pg_insert(table).values(rows)
+        db.session.execute(stmt.on_conflict_do_update(
+            constraint='uq_patient_timeline_ref',
+            set_={
+                'dog_id': stmt.excluded.dog_id,
+                'date': stmt.excluded.date,
+                'summary': stmt.excluded.summary,
+                'updated_at': func.now(),
+            },
+        ))
+    else:
+        _delete(rows[0]['kind'], [row['ref_id'] for row in rows])
+        db.session.execute(insert(table), rows)
+
+
+def _delete(kind, ref_ids):
+    if ref_ids:
+        table = PatientTimeline.__table__
+        db.session.execute(delete(table).where(table.c.kind == kind, table.c.ref_id.in_(list(ref_ids))))
+
+
+def refresh_timeline_records(refs):
+    """
+    Bring the timeline rows of specific source records up to date.
+
+    Args:
+        refs (dict): kind -> iterable of source primary keys. Keys no longer
+            present in the source (or without a date) lose their timeline row.
+
+    Returns:
+        int: Timeline rows written.
+    """
+    written = 0
+    for kind, ref_ids in refs.items():
+        ref_ids = set(ref_ids)
+        if not ref_ids:
+            continue
+        model, pk, _, _ = TIMELINE_SOURCES[kind]
+        rows = _source_rows(kind, model.__table__.c[pk].in_(list(ref_ids)))
+        _upsert(rows)
+        _delete(kind, ref_ids - {row['ref_id'] for row in rows})
+        written += len(rows)
+    return written
+
+
+def apply_timeline_events(events):
+    """``ChangeFeedConsumer`` handler: refresh the timeline rows named by ``events``."""
+    refs = {}
+    for change in events:
+        kind = TIMELINE_TABLES.get(change.table_name)
+        if kind is not None:
+            refs.setdefault(kind, set()).add(int(change.record_pk))
+    return refresh_timeline_records(refs)
+
+
+def timeline_consumer(batch_size=1000):
+    """The change-feed consumer that maintains ``patient_timeline``."""
+    return ChangeFeedConsumer(CONSUMER_NAME, tables=list(TIMELINE_TABLES), batch_size=batch_size)
+
+
+def rebuild_timeline(dog_ids, batch_size=500, commit=True):
+    """
+    Recreate the timeline of ``dog_ids`` from the source tables.
+
+    Each batch deletes the dogs' rows, reads the sources with one query per
+    table and reinserts everything with a single multi-row insert.
+
+    Returns:
+        dict: ``dogs``, ``rows`` and ``ms``.
+    """
+    dog_ids = list(dict.fromkeys(dog_ids))
+    table = PatientTimeline.__table__
+    start = time.perf_counter()
+    total = 0
+    for i in range(0, len(dog_ids), batch_size):
+        batch = dog_ids[i:i + batch_size]
+        db.session.execute(delete(table).where(table.c.dog_id.in_(batch)))
+        rows = []
+        for kind, (model, _, _, _) in TIMELINE_SOURCES.items():
+            rows.extend(_source_rows(kind, model.__table__.c.dog_id.in_(batch)))
+        rows.sort(key=lambda row: (row['dog_id'], row['date']))
+        if rows:
+            db.session.execute(insert(table), rows)
+        total += len(rows)
+        if commit:
+            db.session.commit()
+    return {'dogs': len(dog_ids), 'rows': total, 'ms': int((time.perf_counter() - start) * 1000)}
+
+
+def timeline_page(dog_id, limit=50, before=None, kinds=None, since=None):
+    """
+    One page of a dog's timeline, newest first.
+
+    Args:
+        dog_id (int): Dog.
+        limit (int): Rows per page.
+        before (tuple): Cursor returned by the previous page; None for the first page.
+        kinds (iterable): Restrict to these kinds.
+        since (date): Stop at this date (inclusive).
+
+    Returns:
+        tuple: (rows, cursor). ``rows`` are dicts with date, kind, ref_id and
+        summary; ``cursor`` is None on the last page.
+    """
+    table = PatientTimeline.__table__
+    stmt = select(table.c.id, table.c.date, table.c.kind, table.c.ref_id, table.c.summary).where(
+        table.c.dog_id == dog_id
+    )
+    if before is not None:
+        stmt = stmt.where(tuple_(table.c.date, table.c.id) < tuple_(*before))
+    if since is not None:
+        stmt = stmt.where(table.c.date >= since)
+    if kinds:
+        stmt = stmt.where(table.c.kind.in_(list(kinds)))
+    records = db.session.execute(stmt.order_by(table.c.date.desc(), table.c.id.desc()).limit(limit + 1)).all()
+    cursor = None
+    if len(records) > limit:
+        records = records[:limit]
+        cursor = (records[-1].date, records[-1].id)
+    rows = [{'date': r.date, 'kind': r.kind, 'ref_id': r.ref_id, 'summary': r.summary} for r in records]
+    return rows, cursor
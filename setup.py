@@ -6,6 +6,15 @@ setup(
     packages=find_packages(),
     install_requires=[
         'Flask',
-        'Flask-SQLAlchemy'
-    ]
+        'Flask-SQLAlchemy',
+        'numpy',
+        'pandas'
+    ],
+    extras_require={
+        'async': [
+            'sqlalchemy[asyncio]',
+            'asyncpg',
+            'aiosqlite'
+        ]
+    }
 )
@@ -0,0 +1,89 @@
+"""
+Replica routing and pool metrics of ``common_models.db``, with two SQLite files
+standing in for the primary and a read replica.
+
+Each database holds a ``role`` row naming it, so a read shows which one served it.
+"""
+import pytest
+from flask import Flask
+from sqlalchemy import select
+
+from common_models.db import configure_pool, db, pinned_to_primary, pool_metrics, read_replica
+from common_models.models import Role
+
+
+@pytest.fixture
+def app(tmp_path):
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{tmp_path / 'primary.db'}"
+    app.config['SQLALCHEMY_BINDS'] = {'replica_1': f"sqlite:///{tmp_path / 'replica.db'}"}
+    configure_pool(app, 'web', pool_size=2, max_overflow=0)
+    db.init_app(app)
+    pool_metrics.reset()
+    with app.app_context():
+        for key, name in ((None, 'primary'), ('replica_1', 'replica')):
+            engine = db.engines[key]
+            Role.__table__.create(engine)
+            with engine.begin() as connection:
+                connection.execute(Role.__table__.insert().values(name=name))
+        yield app
+        db.session.remove()
+
+
+def served_by(stmt=None):
+    return db.session.execute(stmt if stmt is not None else select(Role.name)).scalars().all()
+
+
+def test_reads_go_to_primary_by_default(app):
+    assert served_by() == ['primary']
+
+
+def test_read_replica_block_reads_from_replica(app):
+    with read_replica():
+        assert served_by() == ['replica']
+    assert served_by() == ['primary']
+
+
+def test_replica_execution_option_reads_from_replica(app):
+    assert served_by(select(Role.name).execution_options(replica=True)) == ['replica']
+
+
+def test_select_for_update_stays_on_primary(app):
+    with read_replica():
+        assert served_by(select(Role.name).with_for_update()) == ['primary']
+
+
+def test_dml_pins_session_to_primary(app):
+    db.session.execute(Role.__table__.insert().values(name='written'))
+    assert pinned_to_primary()
+    with read_replica():
+        assert sorted(served_by()) == ['primary', 'written']
+
+
+def test_flush_pins_session_to_primary(app):
+    db.session.add(Role(name='flushed'))
+    db.session.flush()
+    assert pinned_to_primary()
+    assert sorted(served_by(select(Role.name).execution_options(replica=True))) == ['flushed', 'primary']
+
+
+def test_close_unpins_session(app):
+    db.session.add(Role(name='flushed'))
+    db.session.commit()
+    assert pinned_to_primary()
+    db.session.close()
+    assert not pinned_to_primary()
+    with read_replica():
+        assert served_by() == ['replica']
+
+
+def test_pool_metrics_per_bind(app):
+    served_by()
+    with read_replica():
+        served_by()
+    stats = pool_metrics.stats()
+    assert set(stats) >= {'primary', 'replica_1'}
+    for name in ('primary', 'replica_1'):
+        assert stats[name]['checkouts'] >= 1
+        assert stats[name]['size'] == 2
+        assert stats[name]['max_wait_ms'] >= stats[name]['mean_wait_ms'] >= 0